@@ -0,0 +1,234 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection():
+    """池中的一条数据库连接，记录已准备的语句和最后使用时间"""
+    def __init__(self, raw):
+        self.raw = raw
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool():
+    """
+    有界数据库连接池（线程安全）
+    - 连接按需创建，最多 maxconn 条，用完归还复用
+    - 语句用 prepare() 注册一次，按名字执行；
+      postgres 下走服务器端 PREPARE/EXECUTE，sqlite 下依赖驱动自带的语句缓存
+    - 空闲过久的连接在借出前做健康检查，坏连接直接丢弃重建
+    使用示例：
+    >>> pool = ConnectionPool(lambda: sqlite3.connect('users.db', check_same_thread=False), dialect='sqlite')
+    >>> pool.prepare('login', 'select password from users where username = %s')
+    >>> pool.execute('login', ('张三',), fetch='one')
+    """
+    DIALECTS = ('postgres', 'sqlite')
+
+    def __init__(self, connect: Callable, dialect: str = 'postgres', minconn: int = 0,
+                 maxconn: int = 10, timeout: float = 5.0, check_after: float = 30.0,
+                 health_query: str = 'select 1'):
+        if dialect not in self.DIALECTS:
+            raise ValueError('未知的数据库类型: {}'.format(dialect))
+        if maxconn < 1 or minconn > maxconn:
+            raise ValueError('连接数范围不合法')
+        self._connect = connect
+        self.dialect = dialect
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_after = check_after
+        self.health_query = health_query
+        self._statements: Dict[str, str] = {}
+        self._idle = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._created = 0
+        self._in_use = 0
+        self._metrics = {
+            "created": 0,
+            "discarded": 0,
+            "acquired": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "health_failures": 0,
+        }
+        for i in range(minconn):
+            self._idle.append(self._new_connection())
+            self._created += 1
+
+    def prepare(self, name: str, sql: str) -> None:
+        """注册一条参数化语句，占位符统一写成 %s"""
+        self._statements[name] = sql
+
+    @contextmanager
+    def connection(self):
+        """
+        借出一条连接，退出时归还
+        归还前一律回滚未提交的事务（只读查询在 postgres 下也会开事务，不回滚会一直 idle in transaction），
+        回滚失败则丢弃该连接
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            try:
+                conn.raw.rollback()
+            except Exception:
+                self._discard(conn)
+            else:
+                self._release(conn)
+
+    def execute(self, name: str, params=(), fetch: Optional[str] = None, commit: bool = False):
+        """
+        执行已注册的语句
+        :param fetch: None / 'one' / 'all'
+        :param commit: 执行后是否提交
+        """
+        with self.connection() as conn:
+            curr = self._run(conn, name, params)
+            rows = None
+            if fetch == 'one':
+                rows = curr.fetchone()
+            elif fetch == 'all':
+                rows = curr.fetchall()
+            curr.close()
+            if commit:
+                conn.raw.commit()
+            return rows
+
+    def stats(self) -> Dict[str, float]:
+        """连接池指标快照"""
+        with self._cond:
+            data = dict(self._metrics)
+            data["in_use"] = self._in_use
+            data["idle"] = len(self._idle)
+            data["size"] = self._created
+            data["maxconn"] = self.maxconn
+        return data
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_raw(conn)
+
+    def _run(self, conn: PooledConnection, name: str, params):
+        sql = self._statements[name]
+        curr = conn.raw.cursor()
+        if self.dialect == 'sqlite':
+            curr.execute(sql.replace('%s', '?'), params)
+            return curr
+        if name not in conn.prepared:
+            count = [0]
+
+            def number(match):
+                count[0] += 1
+                return '${}'.format(count[0])
+            curr.execute('prepare {} as {}'.format(name, re.sub(r'%s', number, sql)))
+            conn.prepared.add(name)
+        if params:
+            curr.execute('execute {} ({})'.format(name, ', '.join(['%s'] * len(params))), params)
+        else:
+            curr.execute('execute {}'.format(name))
+        return curr
+
+    def _acquire(self) -> PooledConnection:
+        start = time.monotonic()
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout('连接池已关闭')
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._created < self.maxconn:
+                    self._created += 1
+                    conn = None
+                    break
+                waited = True
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._metrics["timeouts"] += 1
+                    raise PoolTimeout('等待数据库连接超时')
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._metrics["acquired"] += 1
+            if waited:
+                wait = time.monotonic() - start
+                self._metrics["waits"] += 1
+                self._metrics["wait_time_total"] += wait
+                self._metrics["wait_time_max"] = max(self._metrics["wait_time_max"], wait)
+        try:
+            if conn is None:
+                return self._new_connection()
+            if time.monotonic() - conn.last_used > self.check_after and not self._healthy(conn):
+                self._close_raw(conn)
+                with self._cond:
+                    self._metrics["discarded"] += 1
+                return self._new_connection()
+            return conn
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, conn: PooledConnection) -> None:
+        conn.last_used = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            if self._closed:
+                self._created -= 1
+            else:
+                self._idle.append(conn)
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._close_raw(conn)
+
+    def _discard(self, conn: PooledConnection) -> None:
+        with self._cond:
+            self._in_use -= 1
+            self._created -= 1
+            self._metrics["discarded"] += 1
+            self._cond.notify()
+        self._close_raw(conn)
+
+    def _healthy(self, conn: PooledConnection) -> bool:
+        try:
+            curr = conn.raw.cursor()
+            curr.execute(self.health_query)
+            curr.fetchone()
+            curr.close()
+            conn.raw.rollback()
+            return True
+        except Exception:
+            with self._cond:
+                self._metrics["health_failures"] += 1
+            return False
+
+    def _new_connection(self) -> PooledConnection:
+        conn = PooledConnection(self._connect())
+        with self._cond:
+            self._metrics["created"] += 1
+        return conn
+
+    @staticmethod
+    def _close_raw(conn: PooledConnection) -> None:
+        try:
+            conn.raw.close()
+        except Exception:
+            pass
@@ -1,3 +1,21 @@
+import heapq
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from math import log2
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
 def quicksort(arr):
     if len(arr) <= 1:
         return arr
@@ -35,6 +53,365 @@ def quicksort(arr):
     
     return quicksort(left) + middle + quicksort(right)
 
-# 示例
-arr = [3, 6, 8, 10, 1, 2, 1]
-print(quicksort(arr))  # 输出: [1, 1, 2, 3, 6, 8, 10]
+
+# 小于这个长度的区间直接插入排序
+INSERTION_CUTOFF = 16
+# 大于这个长度的区间用 ninther（九数取中）选 pivot，否则三数取中
+NINTHER_CUTOFF = 64
+
+
+def introsort(seq, key=None, reverse=False):
+    """
+    原地排序任意可变序列（list、array.array、bytearray……），用法同 list.sort，返回 None
+    - 用显式栈代替递归，先处理短的一半，栈深度 O(log n)，不会递归溢出
+    - 三数取中/九数取中选 pivot，双指针划分，等于 pivot 的元素都划到右边；
+      这样右半边左边界外就是 pivot，下一轮选出的 pivot 和它相等时说明就是区间最小值，
+      把等于它的元素一次挪到前面不再参与划分，大量重复元素也是线性的
+    - 短区间就地插入排序；划分层数超过 2*log2(n) 时改用堆排序，最坏 O(n log n)
+    - 元素之间只用 < 比较；不稳定。传 key 时先算出 (key, 序号) 再排，这时是稳定的，
+      代价是多占 O(n) 内存存放 key
+    """
+    n = len(seq)
+    if n < 2:
+        return
+    if key is None:
+        _introsort(seq, 0, n)
+        if reverse:
+            _reverse(seq, 0, n)
+        return
+    # 序号参与比较：key 相同时按原顺序，也保证永远不会去比较元素本身
+    # reverse 时序号取负，整体倒过来之后相同 key 仍保持原顺序
+    sign = -1 if reverse else 1
+    decorated = [(key(x), sign * i, x) for i, x in enumerate(seq)]
+    _introsort(decorated, 0, n)
+    if reverse:
+        _reverse(decorated, 0, n)
+    for i, item in enumerate(decorated):
+        seq[i] = item[2]
+
+
+def _introsort(a, first, last):
+    stack = [(first, last, 2 * int(log2(last - first)))]
+    while stack:
+        lo, hi, depth = stack.pop()
+        while hi - lo > INSERTION_CUTOFF:
+            if depth == 0:
+                _heapsort(a, lo, hi)
+                break
+            depth -= 1
+            p = _choose_pivot(a, lo, hi)
+            # a[lo - 1] 是上一轮的 pivot，不大于本区间的任何元素
+            if lo > first and not a[lo - 1] < a[p]:
+                lo = _partition_equal(a, lo, hi, a[p])
+                continue
+            lt, gt = _partition(a, lo, hi, p)
+            # 长的一半入栈，短的一半接着在本轮处理
+            if lt - lo < hi - gt:
+                stack.append((gt, hi, depth))
+                hi = lt
+            else:
+                stack.append((lo, lt, depth))
+                lo = gt
+        else:
+            _insertion_sort(a, lo, hi)
+
+
+def _median3(a, i, j, k):
+    """a[i]、a[j]、a[k] 中值的下标"""
+    if a[i] < a[j]:
+        if a[j] < a[k]:
+            return j
+        return k if a[i] < a[k] else i
+    if a[i] < a[k]:
+        return i
+    return k if a[j] < a[k] else j
+
+
+def _choose_pivot(a, lo, hi):
+    last = hi - 1
+    mid = lo + (hi - lo) // 2
+    if hi - lo <= NINTHER_CUTOFF:
+        return _median3(a, lo, mid, last)
+    step = (hi - lo) // 8
+    return _median3(a,
+                    _median3(a, lo, lo + step, lo + 2 * step),
+                    _median3(a, mid - step, mid, mid + step),
+                    _median3(a, last - 2 * step, last - step, last))
+
+
+def _partition(a, lo, hi, p):
+    """
+    以 a[p] 为 pivot 划分 a[lo:hi]，返回 (j, j + 1)：
+    pivot 落在 j，a[lo:j] 都小于它，a[j + 1:hi] 都不小于它
+    等于 pivot 的元素全部划到右边，交给下一轮的 _partition_equal 一次收走
+    """
+    pivot = a[p]
+    a[p] = a[lo]
+    a[lo] = pivot
+    i, j = lo + 1, hi - 1
+    while True:
+        while i <= j and a[i] < pivot:
+            i += 1
+        while i <= j and not a[j] < pivot:
+            j -= 1
+        if i >= j:
+            break
+        a[i], a[j] = a[j], a[i]
+        i += 1
+        j -= 1
+    a[lo] = a[j]
+    a[j] = pivot
+    return j, j + 1
+
+
+def _partition_equal(a, lo, hi, pivot):
+    """pivot 是 a[lo:hi] 的最小值：把等于它的元素挪到前面，返回第一个大于它的位置"""
+    i = lo
+    # 开头连续相等的一段不用交换
+    while i < hi and not pivot < a[i]:
+        i += 1
+    for j in range(i + 1, hi):
+        x = a[j]
+        if not pivot < x:
+            a[j] = a[i]
+            a[i] = x
+            i += 1
+    return i
+
+
+def _insertion_sort(a, lo, hi):
+    for i in range(lo + 1, hi):
+        x = a[i]
+        j = i - 1
+        while j >= lo and x < a[j]:
+            a[j + 1] = a[j]
+            j -= 1
+        a[j + 1] = x
+
+
+def _heapsort(a, lo, hi):
+    n = hi - lo
+    for root in range(n // 2 - 1, -1, -1):
+        _sift_down(a, lo, root, n)
+    for end in range(n - 1, 0, -1):
+        a[lo], a[lo + end] = a[lo + end], a[lo]
+        _sift_down(a, lo, 0, end)
+
+
+def _sift_down(a, lo, root, n):
+    x = a[lo + root]
+    while True:
+        child = 2 * root + 1
+        if child >= n:
+            break
+        if child + 1 < n and a[lo + child] < a[lo + child + 1]:
+            child += 1
+        if not x < a[lo + child]:
+            break
+        a[lo + root] = a[lo + child]
+        root = child
+    a[lo + root] = x
+
+
+def _reverse(a, lo, hi):
+    hi -= 1
+    while lo < hi:
+        a[lo], a[hi] = a[hi], a[lo]
+        lo += 1
+        hi -= 1
+
+
+# 外部排序：每个工作进程解析、排序一块输入时，内存大约是这块原始文本的这么多倍
+RUN_OVERHEAD = 8
+# 一次最多同时归并多少个有序段，超过就先分几轮合并成更少的段
+MAX_FAN_IN = 64
+NUMERIC_TYPES = {"int": int, "float": float}
+
+
+def external_sort(src, dst, memory_budget=256 * 2 ** 20, workers=None, numeric=None,
+                  reverse=False, tmpdir=None, use_numpy=True):
+    """
+    对每行一条记录的文本文件排序，文件可以比内存大
+    1. 按内存预算把输入切成块，交给进程池：每块解析后用 introsort 原地排好
+       （数值且装了 numpy 时用 numpy.sort），写成临时目录里的一个有序段
+    2. 用堆做 k 路归并，逐行读各段、逐行写出；段太多时先分几轮合并
+    :param memory_budget: 内存预算（字节），决定每块多大、归并时每个段的读缓冲多大
+    :param workers: 进程数，默认 CPU 核数；1 表示在当前进程里排
+    :param numeric: None 按字符串排；"int" / "float" 按数值排，输出是规范化后的数字
+    :param tmpdir: 有序段放在哪里，默认系统临时目录
+    :return: {"records": 行数, "runs": 有序段数, "seconds": 耗时}
+    """
+    if numeric is not None and numeric not in NUMERIC_TYPES:
+        raise ValueError(f"numeric 只能是 None、'int' 或 'float'：{numeric}")
+    workers = workers or os.cpu_count() or 1
+    chunk_bytes = max(2 ** 16, memory_budget // (workers * RUN_OVERHEAD))
+    start = time.perf_counter()
+    workdir = tempfile.mkdtemp(prefix="extsort-", dir=tmpdir)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    runs, records = [], 0
+    try:
+        in_flight = deque()
+        with open(src, "rb") as f:
+            while True:
+                # 整行切块：读满 chunk_bytes 后补上这一行剩下的部分
+                block = f.read(chunk_bytes)
+                if not block:
+                    break
+                block += f.readline()
+                path = os.path.join(workdir, f"run{len(runs):06d}")
+                runs.append(path)
+                args = (block, path, numeric, reverse, use_numpy)
+                if pool is None:
+                    records += _sort_run(*args)
+                    continue
+                # 在途的块不超过进程数，读输入不会跑到排序前面太多
+                in_flight.append(pool.apply_async(_sort_run, args))
+                if len(in_flight) >= workers:
+                    records += in_flight.popleft().get()
+        while in_flight:
+            records += in_flight.popleft().get()
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+        _merge_runs(runs, dst, workdir, memory_budget, numeric, reverse)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"records": records, "runs": len(runs), "seconds": time.perf_counter() - start}
+
+
+def _sort_run(block, path, numeric, reverse, use_numpy):
+    """工作进程：解析一块输入，排好序写成一个有序段，返回行数"""
+    values = None
+    if numeric is not None and use_numpy and np is not None:
+        values = _numpy_sorted(block, numeric, reverse)
+    if values is None:
+        # 只按 \n 分行（splitlines 还会在 \r、\x1c 等字符处断开），行尾的 \r 去掉
+        lines = [line[:-1] if line.endswith("\r") else line for line in block.decode("utf-8").split("\n")]
+        if not lines[-1]:
+            lines.pop()
+        values = lines if numeric is None else [NUMERIC_TYPES[numeric](line) for line in lines if line.strip()]
+        introsort(values, reverse=reverse)
+    # 有序段和输出都只用 \n 断行，记录里的 \r 原样保留
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        f.writelines(f"{value}\n" for value in values)
+    return len(values)
+
+
+def _numpy_sorted(block, numeric, reverse):
+    """
+    用 numpy 解析并排序一块数值，分行规则和纯 Python 一样（按 \n 分、去掉行尾 \r、跳过空行）
+    numpy 解析不了的（超出 int64、非 ASCII 数字、格式错误）返回 None，交给纯 Python 处理或报错
+    """
+    lines = [line[:-1] if line.endswith(b"\r") else line for line in block.split(b"\n")]
+    lines = [line for line in lines if line.strip()]
+    try:
+        values = np.sort(np.array(lines, dtype=np.bytes_).astype(np.int64 if numeric == "int" else np.float64))
+    except (ValueError, OverflowError):
+        return None
+    if reverse:
+        values = values[::-1]
+    return values.tolist()
+
+
+def _read_run(path, numeric, buffering):
+    with open(path, "r", encoding="utf-8", newline="\n", buffering=buffering) as f:
+        if numeric is None:
+            for line in f:
+                yield line[:-1]
+        else:
+            parse = NUMERIC_TYPES[numeric]
+            for line in f:
+                yield parse(line)
+
+
+def _merge_runs(runs, dst, workdir, memory_budget, numeric, reverse):
+    """k 路归并有序段；超过 MAX_FAN_IN 个段时先每 MAX_FAN_IN 个合成一个新段"""
+    level = 0
+    while len(runs) > MAX_FAN_IN:
+        merged = []
+        for i in range(0, len(runs), MAX_FAN_IN):
+            path = os.path.join(workdir, f"merge{level}-{len(merged):06d}")
+            _merge_into(runs[i:i + MAX_FAN_IN], path, memory_budget, numeric, reverse)
+            merged.append(path)
+        runs = merged
+        level += 1
+    _merge_into(runs, dst, memory_budget, numeric, reverse)
+
+
+def _merge_into(runs, path, memory_budget, numeric, reverse):
+    # 读缓冲按段数平分内存预算，输出文件也占一份
+    buffering = max(2 ** 16, memory_budget // (2 * (len(runs) + 1)))
+    streams = [_read_run(run, numeric, buffering) for run in runs]
+    with open(path, "w", encoding="utf-8", newline="\n", buffering=buffering) as out:
+        out.writelines(f"{value}\n" for value in heapq.merge(*streams, reverse=reverse))
+    for run in runs:
+        os.remove(run)
+
+
+def random_ints(n, bound=2 ** 31):
+    """n 个 [0, bound) 之间的随机整数，直接取 os.urandom 的字节"""
+    return [x % bound for x in struct.unpack(f"<{n}I", os.urandom(4 * n))]
+
+
+def benchmark(n=100000, repeat=3):
+    """
+    在几种分布上比较 quicksort、introsort 和内置 sorted 的耗时（取 repeat 次里最快的一次），
+    最后一行是随机数据上排序过程额外分配的内存峰值
+    """
+    data = random_ints(n)
+    distributions = {
+        "随机": data,
+        "已排序": sorted(data),
+        "逆序": sorted(data, reverse=True),
+        "大量重复": random_ints(n, 10),
+        "几乎有序": sorted(data)[:-n // 100] + random_ints(n // 100),
+    }
+    engines = {
+        "quicksort": lambda values: quicksort(values),
+        "introsort": lambda values: introsort(values),
+        "sorted": lambda values: sorted(values),
+    }
+    print(f"n = {n}，单位毫秒")
+    print(f"{'分布':<8}" + "".join(f"{name:>12}" for name in engines))
+    for label, values in distributions.items():
+        row = f"{label:<8}"
+        for name, engine in engines.items():
+            best = None
+            for _ in range(repeat):
+                copy = list(values)
+                start = time.perf_counter()
+                engine(copy)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            row += f"{best * 1000:>12.1f}"
+        print(row)
+    row = f"{'内存KB':<8}"
+    for engine in engines.values():
+        copy = list(data)
+        tracemalloc.start()
+        engine(copy)
+        row += f"{tracemalloc.get_traced_memory()[1] / 1024:>12.0f}"
+        tracemalloc.stop()
+    print(row)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+        sys.exit()
+    if len(sys.argv) > 3 and sys.argv[1] == "extsort":
+        # python quiksort.py extsort 输入文件 输出文件 [内存预算MB] [int|float]
+        stats = external_sort(sys.argv[2], sys.argv[3],
+                              memory_budget=int(sys.argv[4]) * 2 ** 20 if len(sys.argv) > 4 else 256 * 2 ** 20,
+                              numeric=sys.argv[5] if len(sys.argv) > 5 else None)
+        print(f"{stats['records']} 行，{stats['runs']} 个有序段，{stats['seconds']:.2f}s")
+        sys.exit()
+
+    # 示例
+    arr = [3, 6, 8, 10, 1, 2, 1]
+    print(quicksort(arr))  # 输出: [1, 1, 2, 3, 6, 8, 10]
+    introsort(arr)
+    print(arr)  # 输出: [1, 1, 2, 3, 6, 8, 10]
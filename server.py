@@ -1,11 +1,171 @@
+import bisect
+import collections
+import hashlib
+import hmac
 import json
+import logging
 import math
+import selectors
 import socket
+import stat
+import struct
+import tempfile
 import threading
-import psycopg2
 import os
-
+import re
 import time
+import zlib
+
+from dbpool import ConnectionPool
+
+log = logging.getLogger('server')
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+
+FILE_DIR = '我的文件'
+PARTIAL_DIR = '我的文件.uploads'     # 未完成的上传，断线后可续传
+CHUNK_DIR = '我的文件.chunks'        # 去重存储的数据块，按 sha256 命名
+MANIFEST_DIR = '我的文件.manifests'  # 去重存储的文件清单：文件名.json 记录由哪些块组成
+HISTORY_FILE = '聊天记录.log'         # 聊天记录的追加日志，每行一条 JSON
+DEFAULT_ROOM = 'lobby'              # 普通聊天消息所在的房间
+DB_CONFIG = dict(database='DataMy', user='postgres', password='chensiyuyi', host='127.0.0.1', port='5432')
+# users 表的列名，和实际库表不一致时在这里改
+USER_COLUMN = 'username'
+PASSWORD_COLUMN = 'password'
+
+# 分帧协议：1字节帧类型 + 4字节负载长度（网络字节序） + 负载
+FRAME_CONTROL = 1   # JSON 控制消息
+FRAME_DATA = 2      # 文件数据
+FRAME_RANGE = 3     # 区间传输的数据：负载以 传输号(4字节) + 文件偏移(8字节) 开头
+FRAME_HEADER = struct.Struct('!BI')
+RANGE_HEADER = struct.Struct('!IQ')
+FRAME_COMPRESSED = 0x80  # 帧类型上的标记：负载（区间帧是头部之后的数据）经过了协商的压缩
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# 这些类型本身已经压缩过，再压只浪费 CPU
+COMPRESSED_TYPES = frozenset((
+    '.gz', '.tgz', '.zip', '.7z', '.rar', '.xz', '.bz2', '.zst', '.lz4',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', '.mov', '.flac', '.ogg',
+    '.docx', '.xlsx', '.pptx', '.apk', '.jar',
+))
+
+
+def pack_frame(kind, payload):
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+class FrameError(ValueError):
+    pass
+
+
+def compressible(path):
+    return os.path.splitext(path)[1].lower() not in COMPRESSED_TYPES
+
+
+class StreamCodec():
+    """
+    一个连接登录时协商出的 zlib 流式压缩
+    控制消息和文件数据各用一对压缩/解压上下文，每帧做一次 Z_SYNC_FLUSH，
+    所以同一方向、同一通道的帧必须按压缩的顺序发出；压缩过的帧在类型上带 FRAME_COMPRESSED
+    """
+    NAMES = ('zlib', 'none')
+
+    def __init__(self, level=6, stats=None):
+        self.level = level
+        self.stats = stats
+        self._compress = {FRAME_CONTROL: zlib.compressobj(level), FRAME_DATA: zlib.compressobj(level)}
+        self._decompress = {FRAME_CONTROL: zlib.decompressobj(), FRAME_DATA: zlib.decompressobj()}
+
+    @staticmethod
+    def _channel(kind):
+        return FRAME_CONTROL if kind == FRAME_CONTROL else FRAME_DATA
+
+    def compress(self, kind, data):
+        c = self._compress[self._channel(kind)]
+        body = c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+        if self.stats is not None:
+            self.stats.compressed(len(data), len(body))
+        return body
+
+    def frame(self, kind, data, prefix=b''):
+        """压缩 data 并打成一帧；prefix（区间帧的传输号和偏移）不压缩"""
+        body = self.compress(kind, data)
+        return FRAME_HEADER.pack(kind | FRAME_COMPRESSED, len(prefix) + len(body)) + prefix + body
+
+    def decompress(self, kind, payload):
+        """解开一个带压缩标记的帧，返回 (帧类型, 负载)"""
+        kind &= ~FRAME_COMPRESSED
+        skip = RANGE_HEADER.size if kind == FRAME_RANGE else 0
+        d = self._decompress[self._channel(kind)]
+        data = d.decompress(payload[skip:], MAX_FRAME_SIZE)
+        if d.unconsumed_tail:
+            raise FrameError('解压后的帧过大')
+        if skip:
+            data = bytes(payload[:skip]) + data
+        return kind, data
+
+
+class FrameReader():
+    """
+    可复用的带缓冲帧解析器
+    用 recv_into 把数据读进预分配的缓冲区，一次 recv 可以解析出多个帧；
+    frames() 返回的负载是缓冲区的 memoryview，只在下一次 recv_from 之前有效
+    """
+    def __init__(self, size=256 * 1024):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def recv_from(self, sock):
+        """从套接字读一次，返回读到的字节数（0 表示对端关闭）"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            self._make_room()
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        """直接喂入已读到的字节（测试或其它传输层使用）"""
+        need = self.end + len(data)
+        if need > len(self.buf):
+            self._make_room(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        while self.end - self.start >= FRAME_HEADER.size:
+            kind, length = FRAME_HEADER.unpack_from(self.buf, self.start)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError('帧过大: {}'.format(length))
+            body = self.start + FRAME_HEADER.size
+            if self.end - body < length:
+                # 帧不完整，保证缓冲区能容纳整个帧
+                if FRAME_HEADER.size + length > len(self.buf):
+                    self._make_room(FRAME_HEADER.size + length - (self.end - self.start))
+                return
+            self.start = body + length
+            yield kind, self.view[body:self.start]
+
+    def _make_room(self, extra=0):
+        """把未解析的数据移到缓冲区开头，不够时扩容"""
+        pending = self.end - self.start
+        size = len(self.buf)
+        while pending + extra > size or pending == size:
+            size *= 2
+        if size != len(self.buf):
+            new = bytearray(size)
+            new[:pending] = self.buf[self.start:self.end]
+            self.buf = new
+            self.view = memoryview(self.buf)
+        else:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start, self.end = 0, pending
 
 
 def CheckIp():
@@ -18,12 +178,1338 @@ def CheckIp():
     return IP
 
 
-class Server():
+class Histogram():
+    """按 2 的幂分桶的耗时直方图（微秒），记录一次只是几次整数运算"""
+    BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = int(seconds * 1000000)
+        self.buckets[min(us.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """返回分位数所在桶的上界（毫秒）"""
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min((1 << i) / 1000, self.max * 1000)
+        return self.max * 1000
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class ServerStats():
+    """
+    热路径上的计数：每个命令的耗时、数据库语句耗时、收发字节数
+    快照里再补上当前连接数、发送队列深度和连接池指标
+    """
     def __init__(self):
+        self.started = time.time()
+        self.commands = collections.defaultdict(Histogram)
+        self.db = collections.defaultdict(Histogram)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages = 0
+        self.connections_total = 0
+        self.compress_raw = 0
+        self.compress_wire = 0
+        self.pings = 0
+        self.reaped = collections.Counter()
+        self._lock = threading.Lock()
+
+    def command(self, name, seconds):
+        with self._lock:
+            self.messages += 1
+            self.commands[name].add(seconds)
+
+    def db_call(self, name, seconds):
+        with self._lock:
+            self.db[name].add(seconds)
+
+    def received(self, n):
+        with self._lock:
+            self.bytes_in += n
+
+    def sent(self, n):
+        with self._lock:
+            self.bytes_out += n
+
+    def connected(self):
+        with self._lock:
+            self.connections_total += 1
+
+    def ping(self):
+        with self._lock:
+            self.pings += 1
+
+    def reap(self, reason):
+        with self._lock:
+            self.reaped[reason] += 1
+
+    def compressed(self, raw, wire):
+        with self._lock:
+            self.compress_raw += raw
+            self.compress_wire += wire
+
+    def snapshot(self, server):
+        with self._lock:
+            data = {
+                "uptime_s": round(time.time() - self.started, 1),
+                "messages": self.messages,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "connections_total": self.connections_total,
+                "pings": self.pings,
+                "reaped": dict(self.reaped),
+                "compression": {
+                    "raw_bytes": self.compress_raw,
+                    "wire_bytes": self.compress_wire,
+                    "ratio": round(self.compress_wire / self.compress_raw, 3) if self.compress_raw else None,
+                },
+                "commands": {k: h.snapshot() for k, h in self.commands.items()},
+                "db": {k: h.snapshot() for k, h in self.db.items()},
+            }
+        with server.clients_lock:
+            conns = list(server.connections.values())
+        depths = [c.queued for c in conns]
+        data["connections"] = len(conns)
+        data["logged_in"] = len(server.user_name)
+        data["pid"] = os.getpid()
+        if server.bus is not None:
+            data["remote_users"] = sum(server.remote_users.values())
+        data["queues"] = {
+            "queued_bytes": sum(depths),
+            "max_queued_bytes": max(depths) if depths else 0,
+            "dropped": sum(c.dropped for c in conns),
+            "transfers": sum(len(c.transfers) for c in conns),
+        }
+        data["db_pool"] = server.db.stats()
+        return data
+
+
+class CredentialCache():
+    """
+    已验证登录凭据的 LRU + TTL 缓存（线程安全）
+    只保存加盐后的密码摘要，不保存明文；注册时按用户名失效
+    """
+    def __init__(self, maxsize=10000, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._salt = os.urandom(16)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _digest(self, password):
+        return hashlib.sha256(self._salt + password.encode('utf-8')).digest()
+
+    def check(self, user, password):
+        """命中且密码一致返回 True，否则返回 False（调用方再查库）"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user)
+                if hmac.compare_digest(entry[0], self._digest(password)):
+                    self.hits += 1
+                    return True
+            elif entry is not None:
+                del self._entries[user]
+            self.misses += 1
+            return False
+
+    def put(self, user, password):
+        with self._lock:
+            self._entries[user] = (self._digest(password), time.monotonic() + self.ttl)
+            self._entries.move_to_end(user)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user):
+        with self._lock:
+            self._entries.pop(user, None)
+
+
+class TimerWheel():
+    """
+    哈希时间轮（线程安全）：slots 个槽，每槽 tick 秒
+    add() 按到期时间放进对应的槽，advance() 每个 tick 只看走过的槽，都是 O(1)；
+    超过一圈的条目留在槽里，到期时间没到就等下一圈
+    连接的活动不动时间轮，到期时由调用方看最后活动时间决定重新排期还是处理
+    """
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for i in range(slots)]
+        self.current = int(time.monotonic() // tick)
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def add(self, item, deadline):
+        # 向上取整：处理第 k 槽时已经过了 k * tick，槽里的条目不会早到
+        index = max(math.ceil(deadline / self.tick), self.current + 1)
+        with self._lock:
+            self.slots[index % len(self.slots)].append((deadline, item))
+            self.size += 1
+
+    def advance(self, now):
+        """走到 now，返回到期的条目"""
+        expired = []
+        target = int(now // self.tick)
+        with self._lock:
+            steps = min(target - self.current, len(self.slots))
+            for i in range(steps):
+                index = (target - steps + 1 + i) % len(self.slots)
+                slot = self.slots[index]
+                if not slot:
+                    continue
+                keep = []
+                for entry in slot:
+                    if entry[0] <= now:
+                        expired.append(entry[1])
+                    else:
+                        keep.append(entry)
+                self.slots[index] = keep
+            self.current = max(self.current, target)
+            self.size -= len(expired)
+        return expired
+
+
+class Connection():
+    """
+    单个客户端连接的状态，线程模式和事件循环模式共用
+    所有发送都先进入该连接自己的发送队列：
+    - 线程模式下由该连接的写线程阻塞发送
+    - 事件循环模式下等待套接字可写时再发送
+    广播走 offer()，队列超过上限时按服务器的溢出策略丢消息或断开慢客户端
+    """
+    def __init__(self, server, sock, address, name, framed=False):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.name = name
+        self.path = None
+        self.file_num = 0
+        self.upload = None          # 正在接收的上传: [文件对象, 剩余分块数]
+        self.stream = None          # 正在接收的流式上传（Upload）
+        self.outbox = collections.deque()
+        self.queued = 0             # 队列中待发送的消息字节数
+        self.dropped = 0            # 因队列满被丢弃的广播条数
+        self.cond = threading.Condition()
+        self.closed = False
+        self.writing = False
+        self.transfers = collections.OrderedDict()  # 传输号 -> 区间传输（FileSlice），轮流每次发一帧
+        self.sending = None         # 正在发送某一帧的区间传输，发完这一帧前不能插入别的数据
+        self.next_tid = 1
+        self.framed = framed
+        self.reader = FrameReader() if framed else None
+        self.codec = None           # 登录时协商出的压缩（StreamCodec），只用于分帧协议
+        self.last_seen = time.monotonic()   # 最后一次收到任何数据（包括 pong）
+        self.last_active = self.last_seen   # 最后一次收到心跳以外的消息
+        self.last_sent = self.last_seen     # 最后一次写出文件数据：对端还在收，说明连接是活的
+        self.pinged = None          # 发出还没有回应的 ping 的时间
+
+    def send_msg(self, data):
+        payload = json.dumps(data).encode('utf-8')
+        if self.codec is not None:
+            self._push_compressed(payload)
+            return
+        if self.framed:
+            payload = pack_frame(FRAME_CONTROL, payload)
+        self.send(payload)
+
+    def send(self, payload):
+        """发给本客户端的回复，总是入队"""
+        self._push(memoryview(payload), len(payload))
+
+    def offer(self, payload, body=None):
+        """
+        广播消息入队；payload 由调用方预先序列化，所有接收者共享同一份
+        开了压缩的连接改用未分帧的 body 在自己的压缩流里单独压缩
+        队列已满时返回 False
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            if self.queued + len(payload) > self.server.queue_limit:
+                self.dropped += 1
+                full = True
+            else:
+                full = False
+        if full:
+            if self.server.overflow == 'disconnect':
+                self.server.drop(self)
+            return False
+        if self.codec is not None and body is not None:
+            self._push_compressed(body)
+            return True
+        self._push(payload if isinstance(payload, memoryview) else memoryview(payload), len(payload))
+        return True
+
+    def send_file(self, path, offset=0, count=None):
+        """
+        发送文件的一段（默认整个文件）
+        分帧协议下按 chunk_size 切成数据帧；能用 sendfile 时数据不经过用户态
+        """
+        chunk_size = self.server.chunk_size
+        self._push(FileSlice(path, offset, count, chunk_size if self.framed else None, chunk_size,
+                             codec=self._file_codec(path)), 0)
+
+    def start_transfer(self, path, offset=0, count=None):
+        """
+        开始一个区间传输，返回 (传输号, FileSlice)
+        分帧协议下多个传输按帧轮流发送；旧协议没法区分数据属于哪个传输，只能按顺序整段发送
+        """
+        chunk_size = self.server.chunk_size
+        with self.cond:
+            tid = self.next_tid
+            self.next_tid += 1
+        return tid, FileSlice(path, offset, count, chunk_size if self.framed else None, chunk_size, tid,
+                              codec=self._file_codec(path))
+
+    def _file_codec(self, path):
+        """已经压缩过的文件类型不再压缩，直接走 sendfile"""
+        return self.codec if self.codec is not None and compressible(getattr(path, 'name', path)) else None
+
+    def queue_transfer(self, item):
+        if not self.framed:
+            self._push(item, 0)
+            return
+        if not item.remaining:
+            item.close()
+            self.send_msg(['end', item.tid])
+            return
+        with self.cond:
+            if self.closed:
+                item.close()
+                return
+            self.transfers[item.tid] = item
+            self.cond.notify()
+        self.server.want_write(self)
+
+    def cancel_transfer(self, tid):
+        with self.cond:
+            item = self.transfers.pop(tid, None)
+            if item is None:
+                return False
+            item.cancelled = True
+            if item is not self.sending:
+                item.close()
+            return True
+
+    def _after_frame(self, item):
+        """一帧发完后：取消的关闭，发完的关闭并回复 ['end', 传输号]"""
+        if item.cancelled:
+            item.close()
+        elif not item.remaining:
+            self.transfers.pop(item.tid, None)
+            item.close()
+            self.send_msg(['end', item.tid])
+
+    def _push_compressed(self, payload):
+        """压缩和入队在同一把锁里完成，保证压缩流的顺序就是发送顺序"""
+        with self.cond:
+            if self.closed:
+                return
+            frame = memoryview(self.codec.frame(FRAME_CONTROL, payload))
+            self.outbox.append(frame)
+            self.queued += len(frame)
+            self.cond.notify()
+        self.server.want_write(self)
+
+    def _push(self, item, size):
+        with self.cond:
+            if self.closed:
+                if isinstance(item, FileSlice):
+                    item.close()
+                return
+            self.outbox.append(item)
+            self.queued += size
+            self.cond.notify()
+        self.server.want_write(self)
+
+    def _next_item(self):
+        """取下一个要发的东西：先发队列里的消息，空了再轮到下一个区间传输"""
+        if self.outbox:
+            head = self.outbox.popleft()
+            if not isinstance(head, FileSlice):
+                self.queued -= len(head)
+            return head
+        tid = next(iter(self.transfers))
+        self.transfers.move_to_end(tid)
+        self.sending = self.transfers[tid]
+        return self.sending
+
+    def write_loop(self):
+        """线程模式的写线程：阻塞地把发送队列写到套接字"""
+        while True:
+            with self.cond:
+                while not self.outbox and not self.transfers and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                head = self._next_item()
+            try:
+                if head is self.sending:
+                    before = head.offset
+                    head.send_frame(self.sock, self.server.use_sendfile, blocking=True)
+                    self._sent(head.offset - before, True)
+                    with self.cond:
+                        self.sending = None
+                        self._after_frame(head)
+                elif isinstance(head, FileSlice):
+                    try:
+                        before = head.offset
+                        head.send_blocking(self.sock, self.server.use_sendfile)
+                        self._sent(head.offset - before, True)
+                    finally:
+                        head.close()
+                else:
+                    self.sock.sendall(head)
+                    self._sent(len(head))
+            except OSError:
+                if isinstance(head, FileSlice):
+                    head.close()
+                self.server.drop(self)
+                return
+
+    def flush(self):
+        """事件循环模式：尽量写出发送队列，返回队列是否已清空"""
+        with self.cond:
+            try:
+                while True:
+                    if self.sending is not None:
+                        item = self.sending
+                        before = item.offset
+                        try:
+                            if not item.send_frame(self.sock, self.server.use_sendfile):
+                                return False
+                        finally:
+                            self._sent(item.offset - before, True)
+                        self.sending = None
+                        self._after_frame(item)
+                        continue
+                    if not self.outbox:
+                        if not self.transfers:
+                            return True
+                        self._next_item()
+                        continue
+                    head = self.outbox[0]
+                    if isinstance(head, FileSlice):
+                        before = head.offset
+                        try:
+                            if not head.send_some(self.sock, self.server.use_sendfile):
+                                return False
+                        finally:
+                            self._sent(head.offset - before, True)
+                        head.close()
+                        self.outbox.popleft()
+                        continue
+                    sent = self.sock.send(head)
+                    self._sent(sent)
+                    self.queued -= sent
+                    if sent < len(head):
+                        self.outbox[0] = head[sent:]
+                        return False
+                    self.outbox.popleft()
+            except BlockingIOError:
+                return False
+
+    def _sent(self, n, file_data=False):
+        """
+        记一次写出；只有文件数据算进 last_sent：对端不收时它很快会塞满发送缓冲区、写不动，
+        而小消息（包括 ping 本身）总能写进内核缓冲区，说明不了对端还活着
+        """
+        self.server.stats.sent(n)
+        if n and file_data:
+            self.last_sent = time.monotonic()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for item in self.outbox:
+                if isinstance(item, FileSlice):
+                    item.close()
+            for item in self.transfers.values():
+                if item is not self.sending:
+                    item.close()
+            if self.sending is not None:
+                # 线程模式下写线程可能正在锁外发这一帧，标记取消后由它在 _after_frame 里关闭；
+                # 事件循环模式的 flush 在锁内发送，这时没人在用，直接关
+                self.sending.cancelled = True
+                if self.server.mode == 'event':
+                    self.sending.close()
+                    self.sending = None
+            self.outbox.clear()
+            self.transfers.clear()
+            self.queued = 0
+            self.cond.notify_all()
+
+
+class FileSlice():
+    """
+    发送队列中的一段文件
+    frame_size 不为空时每 frame_size 字节前插入一个数据帧头，
+    tid 不为空时用带传输号和偏移的区间帧（FRAME_RANGE）；
+    copy_size 是不走 sendfile 时每次读文件的大小
+    codec 不为空时每帧读出来压缩后整帧发送；某一帧压不下去（>90%）之后剩下的不再压缩
+    """
+    def __init__(self, path, offset=0, count=None, frame_size=None, copy_size=256 * 1024, tid=None, codec=None):
+        if isinstance(path, str):
+            self.f = open(path, 'rb')
+            size = os.fstat(self.f.fileno()).st_size
+            self.zero_copy = True
+        else:
+            # 去重存储的文件（ChunkReader）由多个块拼成，只能读出来再发
+            self.f = path
+            size = path.size
+            self.zero_copy = False
+        self.size = size
+        self.offset = min(offset, size)
+        self.remaining = size - self.offset if count is None else max(0, min(count, size - self.offset))
+        self.frame_size = frame_size
+        self.frame_left = 0
+        self.header = None
+        self.copy_size = copy_size
+        self.buf = None
+        self.tid = tid
+        self.codec = codec if frame_size is not None else None
+        self.cancelled = False
+
+    def close(self):
+        self.f.close()
+
+    def _next_header(self):
+        if self.frame_size is not None and self.frame_left == 0 and self.header is None:
+            self.frame_left = min(self.frame_size, self.remaining)
+            if self.codec is not None:
+                self._compress_frame()
+            elif self.tid is None:
+                self.header = memoryview(FRAME_HEADER.pack(FRAME_DATA, self.frame_left))
+            else:
+                self.header = memoryview(FRAME_HEADER.pack(FRAME_RANGE, RANGE_HEADER.size + self.frame_left)
+                                         + RANGE_HEADER.pack(self.tid, self.offset))
+
+    def _compress_frame(self):
+        """读出这一帧的数据并压缩，压缩后的整帧当作帧头发送，文件偏移直接前进"""
+        self.f.seek(self.offset)
+        data = self.f.read(self.frame_left)
+        if len(data) < self.frame_left:
+            raise ConnectionResetError('文件在发送过程中被截断')
+        if self.tid is None:
+            frame = self.codec.frame(FRAME_DATA, data)
+        else:
+            frame = self.codec.frame(FRAME_RANGE, data, RANGE_HEADER.pack(self.tid, self.offset))
+        if len(frame) > 0.9 * len(data):
+            self.codec = None
+        self.header = memoryview(frame)
+        self._advance(len(data))
+
+    def _step(self):
+        """当前可以发送的文件字节数（未分帧时不受帧边界限制）"""
+        if self.frame_size is None:
+            return self.remaining
+        return self.frame_left
+
+    def _advance(self, n):
+        self.offset += n
+        self.remaining -= n
+        if self.frame_size is not None:
+            self.frame_left -= n
+
+    def send_blocking(self, sock, use_sendfile=True):
+        """阻塞（或带超时）套接字上一次发完"""
+        while self.remaining > 0 or self.header is not None:
+            self.send_frame(sock, use_sendfile, blocking=True)
+
+    def send_some(self, sock, use_sendfile=True):
+        """非阻塞套接字上尽量多发，发完返回 True；写满时抛 BlockingIOError 或返回 False"""
+        while self.remaining > 0 or self.header is not None:
+            if not self.send_frame(sock, use_sendfile):
+                return False
+        return True
+
+    def send_frame(self, sock, use_sendfile=True, blocking=False):
+        """
+        发当前这一帧（未分帧时就是剩下的全部），发完返回 True
+        非阻塞套接字写满时返回 False 或抛 BlockingIOError，下次从断点继续
+        """
+        use_sendfile = use_sendfile and self.zero_copy
+        self._next_header()
+        if self.header is not None:
+            if blocking:
+                sock.sendall(self.header)
+            else:
+                sent = sock.send(self.header)
+                if sent < len(self.header):
+                    self.header = self.header[sent:]
+                    return False
+            self.header = None
+        while self._step() > 0:
+            step = self._step()
+            if blocking and use_sendfile:
+                sent = sock.sendfile(self.f, self.offset, step)
+            elif use_sendfile and hasattr(os, 'sendfile'):
+                sent = os.sendfile(sock.fileno(), self.f.fileno(), self.offset, step)
+            else:
+                sent = self._send_copy(sock, step, blocking)
+            if sent == 0:
+                raise ConnectionResetError('文件在发送过程中被截断')
+            self._advance(sent)
+        return True
+
+    def _send_copy(self, sock, step, blocking):
+        """不支持 sendfile 时的回退：预分配缓冲区 + memoryview，避免每块新建 bytes"""
+        if self.buf is None:
+            self.buf = bytearray(self.copy_size)
+        view = memoryview(self.buf)
+        self.f.seek(self.offset)
+        n = self.f.readinto(view[:min(step, len(self.buf))])
+        if blocking:
+            sock.sendall(view[:n])
+            return n
+        return sock.send(view[:n])
+
+
+class Upload():
+    """
+    流式上传：写临时文件，边收边算 sha256，收满后校验并原子改名
+    临时文件按 摘要+大小 命名，断线重连后同一内容可以从已收到的位置续传
+    """
+    def __init__(self, name, size, digest, buffer_size=1024 * 1024):
+        self.name = os.path.basename(name)
+        self.digest = str(digest).lower()
+        # 摘要会拼进临时文件路径，只接受 64 位十六进制
+        if not self.name or size < 0 or not ChunkStore.DIGEST.fullmatch(self.digest):
+            raise ValueError('上传参数不合法')
+        self.size = size
+        self.target = os.path.join(FILE_DIR, self.name)
+        self.part = os.path.join(PARTIAL_DIR, '{}-{}.part'.format(self.digest, size))
+        self.hash = hashlib.sha256()
+        self.buffer_size = buffer_size
+        self.buf = None
+        os.makedirs(PARTIAL_DIR, exist_ok=True)
+        self.f = open(self.part, 'r+b' if os.path.exists(self.part) else 'w+b')
+        # 续传：已有部分重新算一遍摘要，多出来的截掉
+        self.received = 0
+        while self.received < size:
+            data_f = self.f.read(min(self.buffer_size, size - self.received))
+            if not data_f:
+                break
+            self.hash.update(data_f)
+            self.received += len(data_f)
+        self.f.seek(self.received)
+        self.f.truncate()
+
+    @property
+    def remaining(self):
+        return self.size - self.received
+
+    def recv_from(self, sock):
+        """旧协议下直接 recv_into 预分配的缓冲区，返回读到的字节数"""
+        if self.buf is None:
+            self.buf = memoryview(bytearray(self.buffer_size))
+        n = sock.recv_into(self.buf, min(self.remaining, self.buffer_size))
+        if n:
+            self.write(self.buf[:n])
+        return n
+
+    def write(self, data):
+        if len(data) > self.remaining:
+            raise ValueError('上传数据超出声明的大小')
+        self.f.write(data)
+        self.hash.update(data)
+        self.received += len(data)
+
+    def finish(self):
+        """校验摘要，成功时原子替换目标文件；失败时丢弃临时文件"""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        if self.hash.hexdigest() != self.digest:
+            os.remove(self.part)
+            return False
+        os.replace(self.part, self.target)
+        return True
+
+    def close(self):
+        """中断时只关文件，保留临时文件用于续传"""
+        self.f.close()
+
+
+class ChunkStore():
+    """
+    内容寻址、去重的分块存储
+    - 数据块按 sha256 存成 CHUNK_DIR/ab/abcd...，内容相同的块只存一份
+    - 每个文件一份清单 MANIFEST_DIR/文件名.json：大小、整体摘要、块大小和块摘要列表
+    - 上传时客户端先报块摘要，服务器只要自己没有的块；下载时按清单把块拼回文件
+    """
+    DIGEST = re.compile(r'[0-9a-f]{64}')
+    MIN_CHUNK = 4 * 1024
+    MAX_CHUNK = 8 * 1024 * 1024
+
+    def __init__(self, root=CHUNK_DIR, manifests=MANIFEST_DIR):
+        self.root = root
+        self.manifests = manifests
+        os.makedirs(root, exist_ok=True)
+        os.makedirs(manifests, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, digest, data):
+        """校验并写入一个块，已经有了就直接返回；先写临时文件再改名，不会留下半个块"""
+        if hashlib.sha256(data).hexdigest() != digest:
+            return False
+        path = self.path(digest)
+        if os.path.exists(path):
+            return True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._replace(path, data)
+        return True
+
+    @staticmethod
+    def _replace(path, data):
+        """
+        写到同目录下的唯一临时文件再改名覆盖 path
+        临时文件名用 mkstemp 取：fork 出来的工作进程线程 ident 都一样，拿 ident 取名会互相截断
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifests, name + '.json')
+
+    def manifest(self, name):
+        try:
+            with open(self.manifest_path(name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_manifest(self, name, manifest):
+        self._replace(self.manifest_path(name), json.dumps(manifest).encode('utf-8'))
+
+    def remove_manifest(self, name):
+        try:
+            os.remove(self.manifest_path(name))
+        except FileNotFoundError:
+            pass
+
+    def open(self, name, manifest=None):
+        manifest = manifest if manifest is not None else self.manifest(name)
+        return ChunkReader(self, name, manifest)
+
+    def collect(self):
+        """
+        删掉没有任何清单引用的块，返回删除的个数
+        上传中的块还没有清单引用，所以只能在服务器停着时跑：python server.py collect
+        """
+        used = set()
+        with os.scandir(self.manifests) as it:
+            for item in it:
+                if item.name.endswith('.json'):
+                    with open(item.path, 'r', encoding='utf-8') as f:
+                        used.update(json.load(f)["chunks"])
+        removed = 0
+        for sub in os.listdir(self.root):
+            for digest in os.listdir(os.path.join(self.root, sub)):
+                if digest not in used:
+                    os.remove(os.path.join(self.root, sub, digest))
+                    removed += 1
+        return removed
+
+
+class ChunkReader():
+    """
+    把清单里的块拼成一个只读的类文件对象（seek/read/readinto），给 FileSlice 发送用
+    块是定长切分的，偏移直接换算成块号，同一时间只开着一个块文件
+    """
+    def __init__(self, store, name, manifest):
+        self.store = store
+        self.name = name
+        self.size = manifest["size"]
+        self.chunk_size = manifest["chunk_size"]
+        self.chunks = manifest["chunks"]
+        self.pos = 0
+        self._index = None
+        self._f = None
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, buf):
+        """最多读到当前块的末尾，返回读到的字节数"""
+        if self.pos >= self.size or not len(buf):
+            return 0
+        index, skip = divmod(self.pos, self.chunk_size)
+        if index != self._index:
+            if self._f is not None:
+                self._f.close()
+            self._f = open(self.store.path(self.chunks[index]), 'rb')
+            self._index = index
+        self._f.seek(skip)
+        n = self._f.readinto(memoryview(buf)[:min(len(buf), self.chunk_size - skip, self.size - self.pos)])
+        if not n:
+            raise OSError('数据块缺失或被截断: {}'.format(self.chunks[index]))
+        self.pos += n
+        return n
+
+    def read(self, n=-1):
+        if n < 0:
+            n = self.size - self.pos
+        buf = bytearray(max(0, min(n, self.size - self.pos)))
+        view = memoryview(buf)
+        got = 0
+        while got < len(buf):
+            got += self.readinto(view[got:])
+        return bytes(buf)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+class ChunkedUpload():
+    """
+    去重上传：['offer', 文件名, 总字节数, sha256, 块大小, [块摘要, ...]]
+    服务器回复缺少的块序号，客户端按顺序每块发一个数据帧；块到一个存一个，
+    断线后重新 offer 只会要还没收到的块。接口和 Upload 一致，由 finish_stream 收尾
+    """
+    def __init__(self, store, name, size, digest, chunk_size, chunks):
+        self.name = os.path.basename(name)
+        ok = (self.name and size >= 0 and store.MIN_CHUNK <= chunk_size <= store.MAX_CHUNK
+              and len(chunks) == math.ceil(size / chunk_size)
+              and all(store.DIGEST.fullmatch(c) for c in chunks))
+        if not ok:
+            raise ValueError('上传参数不合法')
+        self.store = store
+        self.size = size
+        self.digest = digest.lower()
+        self.chunk_size = chunk_size
+        self.chunks = chunks
+        self.missing = []
+        seen = set()
+        for i, c in enumerate(chunks):
+            if c not in seen and not store.has(c):
+                self.missing.append(i)
+            seen.add(c)
+        self.next = 0
+        self.received = 0
+        # 还要收的字节数，每收一块减一次；每个数据帧之后都会读，不能每次重新求和
+        self.remaining = sum(self._chunk_length(i) for i in self.missing)
+
+    def _chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def write(self, data):
+        if self.next >= len(self.missing):
+            raise ValueError('上传数据超出声明的大小')
+        digest = self.chunks[self.missing[self.next]]
+        if not self.store.put(digest, data):
+            raise ValueError('数据块校验失败: {}'.format(digest))
+        self.next += 1
+        self.received += len(data)
+        self.remaining -= len(data)
+
+    def finish(self):
+        """按顺序把块再读一遍核对整体摘要，通过后写清单"""
+        manifest = {"size": self.size, "sha256": self.digest, "chunk_size": self.chunk_size, "chunks": self.chunks}
+        h = hashlib.sha256()
+        reader = self.store.open(self.name, manifest)
+        try:
+            while reader.tell() < self.size:
+                h.update(reader.read(self.chunk_size))
+        except OSError:
+            return False
+        finally:
+            reader.close()
+        if h.hexdigest() != self.digest:
+            return False
+        self.store.save_manifest(self.name, manifest)
+        return True
+
+    def close(self):
+        pass
+
+
+class FileCatalog():
+    """
+    我的文件 目录的缓存索引：文件名 -> 大小、修改时间、分块数
+    - 按 refresh_interval 轮询目录的 mtime，变了才重新扫描，只更新变化的条目
+    - 原地改写文件不会改变目录 mtime，所以每隔 full_interval 再全量核对一次
+    - 服务器自己写完的文件（上传）直接 update()，不用等轮询
+    - manifests 不为空时，去重存储里的文件（清单）也列进来，同名时以清单为准
+    - 查不到的名字记在 _missing 里，下次重新扫描前不再去 stat
+    """
+    MAX_MISSING = 4096
+
+    def __init__(self, root, chunk_size=1024, refresh_interval=2.0, full_interval=60.0, manifests=None):
+        self.root = root
+        self.manifests = manifests
+        self.chunk_size = chunk_size
+        self.refresh_interval = refresh_interval
+        self.full_interval = full_interval
+        self._entries = {}
+        self._sorted = []
+        self._dirty = False
+        self._missing = set()
+        self._dir_mtime = None
+        self._checked = 0.0
+        self._scanned = 0.0
+        self._lock = threading.RLock()
+        self.scans = 0
+        self.refresh(force=True)
+
+    def _entry(self, name, st, size=None):
+        size = st.st_size if size is None else size
+        return {
+            "name": name,
+            "size": size,
+            "mtime": st.st_mtime,
+            "chunks": math.ceil(size / self.chunk_size),
+        }
+
+    def _manifest_entry(self, name, path, st):
+        with open(path, 'r', encoding='utf-8') as f:
+            return self._entry(name, st, json.load(f)["size"])
+
+    def _dir_mtimes(self):
+        if self.manifests is None:
+            return os.stat(self.root).st_mtime_ns
+        return os.stat(self.root).st_mtime_ns, os.stat(self.manifests).st_mtime_ns
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._checked < self.refresh_interval:
+                return
+            self._checked = now
+            dir_mtime = self._dir_mtimes()
+            if not force and dir_mtime == self._dir_mtime and now - self._scanned < self.full_interval:
+                return
+            self._dir_mtime = dir_mtime
+            self._scanned = now
+            self.scans += 1
+            self._missing.clear()
+            seen = set()
+            with os.scandir(self.root) as it:
+                for item in it:
+                    if not item.is_file():
+                        continue
+                    seen.add(item.name)
+                    st = item.stat()
+                    old = self._entries.get(item.name)
+                    if old is None or old["mtime"] != st.st_mtime or old["size"] != st.st_size:
+                        self._entries[item.name] = self._entry(item.name, st)
+                        if old is None:
+                            self._dirty = True
+            if self.manifests is not None:
+                with os.scandir(self.manifests) as it:
+                    for item in it:
+                        if not item.name.endswith('.json') or not item.is_file():
+                            continue
+                        name = item.name[:-5]
+                        seen.add(name)
+                        st = item.stat()
+                        old = self._entries.get(name)
+                        if old is None or old["mtime"] != st.st_mtime:
+                            self._entries[name] = self._manifest_entry(name, item.path, st)
+                            if old is None:
+                                self._dirty = True
+            for name in list(self._entries):
+                if name not in seen:
+                    del self._entries[name]
+                    self._dirty = True
+
+    @staticmethod
+    def valid_name(name):
+        """只收目录下的普通文件名，带路径分隔符、. 和 .. 的都不要"""
+        return isinstance(name, str) and name not in ('', '.', '..') and os.path.basename(name) == name
+
+    def update(self, name):
+        """单个文件有变化（上传完成等）时直接更新条目"""
+        if not self.valid_name(name):
+            return None
+        try:
+            entry = None
+            if self.manifests is not None:
+                path = os.path.join(self.manifests, name + '.json')
+                st = os.stat(path) if os.path.exists(path) else None
+                if st is not None and stat.S_ISREG(st.st_mode):
+                    entry = self._manifest_entry(name, path, st)
+            if entry is None:
+                st = os.stat(os.path.join(self.root, name))
+                if not stat.S_ISREG(st.st_mode):
+                    raise FileNotFoundError(name)
+                entry = self._entry(name, st)
+        except FileNotFoundError:
+            self.remove(name)
+            return None
+        with self._lock:
+            if name not in self._entries:
+                self._dirty = True
+            self._missing.discard(name)
+            self._entries[name] = entry
+            return entry
+
+    def remove(self, name):
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                self._dirty = True
+
+    def get(self, name):
+        self.refresh()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None or name in self._missing or not self.valid_name(name):
+                return entry
+        # 可能是轮询间隔内刚出现的文件，查不到就记下来，直到下次扫描
+        entry = self.update(name)
+        if entry is None:
+            with self._lock:
+                if len(self._missing) >= self.MAX_MISSING:
+                    self._missing.clear()
+                self._missing.add(name)
+        return entry
+
+    def names(self):
+        self.refresh()
+        with self._lock:
+            return list(self._sorted_names())
+
+    def list(self, prefix='', page=0, page_size=100):
+        """按文件名排序后分页，prefix 用二分定位；返回 (条目列表, 匹配总数)"""
+        self.refresh()
+        with self._lock:
+            names = self._sorted_names()
+            lo = bisect.bisect_left(names, prefix)
+            hi = bisect.bisect_left(names, prefix + '\U0010ffff') if prefix else len(names)
+            start = lo + max(page, 0) * max(page_size, 0)
+            stop = min(start + page_size, hi)
+            return [self._entries[n] for n in names[start:stop]], hi - lo
+
+    def _sorted_names(self):
+        if self._dirty:
+            self._sorted = sorted(self._entries)
+            self._dirty = False
+        return self._sorted
+
+
+class ChatHistory():
+    """
+    每个房间最近 size 条聊天的环形缓冲（deque），广播路径上只做内存追加
+    落盘是 write-behind：后台线程把待写的消息攒批追加到日志文件，
+    每 flush_interval 秒或攒够 batch_size 条写一次，广播不会等磁盘
+    写失败的一批放回队首，隔 flush_interval 秒再试；积压超过 max_pending 条才丢最旧的（记日志）
+    启动时只读日志末尾 tail_bytes 字节，恢复各房间最近的消息
+    """
+    def __init__(self, path=None, size=100, batch_size=256, flush_interval=1.0, tail_bytes=4 * 1024 * 1024,
+                 max_pending=100000):
+        self.path = path
+        self.size = size
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.rooms = collections.defaultdict(lambda: collections.deque(maxlen=self.size))
+        self.pending = []
+        self.written = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        if path is not None and os.path.exists(path):
+            self._load(tail_bytes)
+
+    def _load(self, tail_bytes):
+        with open(self.path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - tail_bytes))
+            if size > tail_bytes:
+                f.readline()    # 从中间开始读，第一行可能不完整
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue    # 上次没写完的最后一行
+                self.rooms[record["room"]].append(record["msg"])
+
+    def add(self, room, message, persist=True):
+        with self._cond:
+            self.rooms[room].append(message)
+            if persist and self.path is not None:
+                self.pending.append((room, message))
+                if len(self.pending) >= self.batch_size:
+                    self._cond.notify()
+
+    def recent(self, room, n=None):
+        with self._cond:
+            messages = self.rooms.get(room)
+            if not messages:
+                return []
+            if n is None or n >= len(messages):
+                return list(messages)
+            return list(messages)[-n:] if n > 0 else []
+
+    def start(self):
+        if self.path is not None and self._thread is None:
+            self._thread = threading.Thread(name='history', target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self.pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            try:
+                self.flush()
+            except OSError:
+                if closed:
+                    return
+                time.sleep(self.flush_interval)     # flush 已经记了日志，等一会儿再重试
+                continue
+            if closed:
+                return
+
+    def flush(self):
+        """
+        把攒下的消息一次追加写入日志；多个 worker 共用一个文件时每批只有一次 write
+        写失败时这批消息放回队首（新来的排在后面，顺序不乱），记日志后把 OSError 抛给调用方
+        """
+        with self._cond:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        data = ''.join(json.dumps({"room": room, "msg": msg}, ensure_ascii=False) + '\n' for room, msg in batch)
+        try:
+            with open(self.path, 'ab') as f:
+                f.write(data.encode('utf-8'))
+        except OSError as e:
+            with self._cond:
+                self.pending[:0] = batch
+                dropped = len(self.pending) - self.max_pending
+                if dropped > 0:
+                    del self.pending[:dropped]
+                waiting = len(self.pending)
+            log.warning('写聊天记录失败，%d 条消息等待重试: %s', waiting, e)
+            if dropped > 0:
+                log.error('聊天记录积压超过 %d 条，丢弃最旧的 %d 条', self.max_pending, dropped)
+            raise
+        self.written += len(batch)
+
+    def close(self):
+        """停掉后台线程并写完剩下的消息"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        else:
+            self.flush()
+
+
+class BusHub():
+    """
+    多进程模式下主进程里的本地总线
+    每个 worker 一对 Unix 套接字，某个 worker 发来的帧原样转发给其它所有 worker；
+    收发都不阻塞，慢 worker 的待发数据排在自己的队列里，不会卡住别的 worker
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.peers = {}             # 总线这一端的套接字 -> [FrameReader, 待发送队列]
+        self.running = False
+        self.relayed = 0
+
+    def add_worker(self):
+        """新建一对套接字，返回交给 worker 的那一端"""
+        hub_end, worker_end = socket.socketpair()
+        hub_end.setblocking(False)
+        self.peers[hub_end] = [FrameReader(), collections.deque()]
+        self.selector.register(hub_end, selectors.EVENT_READ)
+        return worker_end
+
+    def run(self):
+        """转发直到 stop() 或所有 worker 都断开"""
+        self.running = True
+        try:
+            while self.running and self.peers:
+                for key, mask in self.selector.select(timeout=1):
+                    sock = key.fileobj
+                    if mask & selectors.EVENT_WRITE and sock in self.peers:
+                        self._flush(sock)
+                    if mask & selectors.EVENT_READ and sock in self.peers:
+                        self._relay(sock)
+        finally:
+            for sock in list(self.peers):
+                self._remove(sock)
+            self.selector.close()
+
+    def stop(self):
+        self.running = False
+
+    def _relay(self, sock):
+        reader = self.peers[sock][0]
+        try:
+            n = reader.recv_from(sock)
+        except BlockingIOError:
+            return
+        except OSError:
+            n = 0
+        if not n:
+            self._remove(sock)
+            return
+        for kind, payload in reader.frames():
+            frame = memoryview(pack_frame(kind, payload))
+            self.relayed += 1
+            for other in list(self.peers):
+                if other is not sock:
+                    self.peers[other][1].append(frame)
+                    self._flush(other)
+
+    def _flush(self, sock):
+        outbox = self.peers[sock][1]
+        try:
+            while outbox:
+                n = sock.send(outbox[0])
+                if n < len(outbox[0]):
+                    outbox[0] = outbox[0][n:]
+                    break
+                outbox.popleft()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._remove(sock)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if outbox else 0)
+        if self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events)
+
+    def _remove(self, sock):
+        if self.peers.pop(sock, None) is None:
+            return
+        self.selector.unregister(sock)
+        sock.close()
+
+
+class BusClient():
+    """
+    worker 这一端的总线连接
+    publish() 可以从任意线程调用；收到的消息由服务器的事件循环或总线线程读出来处理
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(True)
+        self.reader = FrameReader()
+        self._lock = threading.Lock()
+
+    def publish(self, msg):
+        frame = pack_frame(FRAME_CONTROL, json.dumps(msg).encode('utf-8'))
+        with self._lock:
+            self.sock.sendall(frame)
+
+    def receive(self):
+        """读一次并返回解出来的消息列表，总线断开时返回 None"""
+        if not self.reader.recv_from(self.sock):
+            return None
+        return [json.loads(payload.tobytes().decode('utf-8')) for kind, payload in self.reader.frames()]
+
+    def close(self):
+        self.sock.close()
+
+
+class Server():
+    MODES = ('thread', 'event')
+
+    PROTOCOLS = ('legacy', 'framed')
+
+    OVERFLOW_POLICIES = ('drop', 'disconnect')
+    MAX_TRANSFERS = 64          # 每个连接同时进行的区间传输上限
+    MAX_PAGE_SIZE = 1000        # list 每页最多返回的条目数
+
+    def __init__(self, mode='thread', protocol='legacy', db=None, login_cache=True,
+                 host=None, port=9999, chunk_size=1024, use_sendfile=True,
+                 queue_limit=1024 * 1024, overflow='drop',
+                 log_sample=100, stats_file=None, stats_interval=60.0,
+                 reuse_port=False, bus=None, compression=('zlib',), compress_level=1,
+                 history_file=HISTORY_FILE, history_size=100, replay=50,
+                 ping_interval=30.0, grace=10.0, idle_timeout=None, timer_tick=1.0):
+        if mode not in self.MODES:
+            raise ValueError('未知的服务器模式: {}'.format(mode))
+        if protocol not in self.PROTOCOLS:
+            raise ValueError('未知的协议: {}'.format(protocol))
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('未知的溢出策略: {}'.format(overflow))
+        self.mode = mode
+        self.protocol = protocol
+        # 每个客户端发送队列的上限（字节），超过后广播按 overflow 处理
+        self.queue_limit = queue_limit
+        self.overflow = overflow
+        # 每 log_sample 条消息记一条 debug 日志（0 表示不记），代替原来每条都 print
+        self.log_sample = log_sample
+        self.stats = ServerStats()
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        # 下载分块大小：旧协议客户端按 1024 字节收，分帧协议可以调大
+        self.chunk_size = chunk_size
+        self.use_sendfile = use_sendfile
+        # 允许客户端在登录时协商的压缩算法（分帧协议才有效），'none' 总是可选；
+        # 文件数据量大，默认用最快的压缩级别，文本类文件大约能压到 1/4 左右
+        self.compression = tuple(compression)
+        self.compress_level = compress_level
+        # 心跳：连接静默 ping_interval 秒后发 ['ping', n]，再过 grace 秒还没有任何数据才算死连接；
+        # idle_timeout 不为空时，只回 pong 不发别的消息超过这么久的连接也断开（默认不断）
+        # 旧协议客户端不认识 ping，只靠 TCP keepalive 探测对端是否还在
+        self.ping_interval = ping_interval
+        self.grace = grace
+        self.idle_timeout = idle_timeout
+        self.timers = TimerWheel(timer_tick)
+        self.next_tick = 0.0
         self.server = socket.socket()
         self.server.setblocking(False)
-        self.__ip = CheckIp()
-        self.server.bind((self.__ip, 9999))
+        if reuse_port:
+            # 多进程模式：每个 worker 各自绑定同一端口，由内核把新连接分给它们
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__ip = host if host is not None else CheckIp()
+        self.server.bind((self.__ip, port))
         self.server.listen(128)
         self.server_listening = False
         self.__client_cnt = 0
@@ -31,131 +1517,779 @@ class Server():
         self.clients_name = []
         self.user_name = []
         self.client_addr_name = {}
-        if not os.path.exists('我的文件'):
-            os.makedirs('我的文件')
+        self.connections = {}
+        self.clients_lock = threading.RLock()
+        self.selector = None
+        # 多进程模式下和其它 worker 相连的总线，以及其它 worker 上在线的用户
+        self.bus = BusClient(bus) if bus is not None else None
+        self.remote_users = collections.Counter()
+        # 所有线程/事件循环共用一个连接池，语句只注册一次
+        self.db = db if db is not None else self.default_pool()
+        self.db.prepare('register', "insert into users values (%s, %s)")
+        # 按用户名查单行依赖 users 表上的索引，由 migrate() 一次性建好，这里不碰表结构
+        self.db.prepare('password', "select {} from users where {} = %s".format(PASSWORD_COLUMN, USER_COLUMN))
+        self.credentials = CredentialCache() if login_cache else None
+        self.handlers = {
+            'register': self.on_register,
+            'login': self.on_login,
+            'load': self.on_load,
+            'upload': self.on_stream_upload,
+            'list': self.on_list,
+            'get': self.on_get,
+            'cancel': self.on_cancel,
+            'stats': self.on_stats,
+            'users': self.on_users,
+            'history': self.on_history,
+            'offer': self.on_offer,
+            'ping': self.on_ping,
+            'pong': self.on_pong,
+        }
+        self.bus_handlers = {
+            'broadcast': lambda msg: self.deliver(msg[1]),
+            'chat': self.on_peer_chat,
+            'join': self.on_peer_join,
+            'leave': self.on_peer_leave,
+            'invalidate': self.on_peer_register,
+            'file': lambda msg: self.catalog.update(msg[1]),
+        }
+        os.makedirs(FILE_DIR, exist_ok=True)
+        self.chunks = ChunkStore()
+        self.catalog = FileCatalog(FILE_DIR, chunk_size, manifests=self.chunks.manifests)
+        # 最近的聊天记录，登录后（分帧协议）一次性补发最近 replay 条
+        self.history = ChatHistory(history_file, history_size)
+        self.replay = replay
 
 
 
     def get_msg(self,client_socket, client_name, client_address):
+        conn = self.connections[client_socket]
         while self.server_listening:
             try:
-                data = client_socket.recv(1024).decode('utf-8')
-            except Exception:
-                self.__client_cnt -= 1
-                if client_socket in self.clients_socket:
-                    self.clients_socket.remove(client_socket)
-                    self.user_name.remove(self.client_addr_name[client_address])
-                    #for c in self.clients_socket:
-                        #c.send(('exit' + self.client_addr_name[client_address]).encode('utf-8'))
-                if client_name in self.clients_name:
-                    self.clients_name.remove(client_name)
-                if client_address in self.client_addr_name:
-                    del self.client_addr_name[client_address]
-                client_socket.close()
+                if not self.receive(conn):
+                    raise ConnectionResetError
+            except Exception as e:
+                log.debug('%s 断开: %r', conn.name, e)
+                self.drop(conn)
                 break
-            data = json.loads(data)
-            print(data)
-            if type(data) == list:
-                if data[0] == 'register':
-                    user = data[1]
-                    password = data[2]
-                    conn = psycopg2.connect(database='DataMy', user='postgres', password='123456', host='127.0.0.1', port='5432')
-                    curr = conn.cursor()
-                    curr.execute(f"insert into users values ('{user}', '{password}')")
-                    conn.commit()
-                    conn.close()
-                    client_socket.send(json.dumps('sccess').encode('utf-8'))
-                if data[0] == 'login':
-                    user = data[1]
-                    password = data[2]
-                    users_dict = {}
-                    conn = psycopg2.connect(database='DataMy', user='postgres', password='chensiyuyi', host='127.0.0.1', port='5432')
-                    curr = conn.cursor()
-                    curr.execute("select * from users")
-                    rews = curr.fetchall()
-                    for rew in rews:
-                        users_dict[rew[0]] = rew[1]
-                        print(users_dict)
-                    conn.commit()
-                    conn.close()
-                    if users_dict[user] == password:
-                        client_socket.send(json.dumps('access').encode('utf-8'))
-                        self.__client_cnt += 1
-                        self.client_addr_name[client_address] = user
-                        self.user_name.append(user)
-                        print(self.user_name)
-                        for c in self.clients_socket:
-                            c.send(json.dumps('client' + self.client_addr_name[client_address]).encode('utf-8'))
-                    else:
-                        client_socket.send(json.dumps('fail').encode('utf-8'))
-                    print(self.user_name)
-                if data[0] == 'load':
-                    file_name = data[1]
-                    self.path = os.path.abspath('我的文件' + '\\{}'.format(file_name))
-                    size = os.stat(self.path).st_size
-                    max_size = 1024
-                    self.file_num = math.ceil(size/max_size)
-                    data = [self.file_num, file_name]
-                    print(data)
-                    client_socket.send(bytes(json.dumps(data).encode('utf-8')))
-                if type(data[1]) == int:
-                    print(data)
-                    client_socket.send(json.dumps('alr').encode('utf-8'))
-                    file_path = os.path.abspath('我的文件' + '\\{}'.format(data[0]))
-                    i=0
-                    with open(file_path, "wb") as f:
-                        while i < data[1]:
-                            data_f = client_socket.recv(1024)
-                            f.write(data_f)
-                            i += 1
-                        print('wenc')
-            elif data == 'working':
-                if not client_name in self.clients_name:
-                    self.clients_name.append(client_name)
-            elif data[:8] == 'download':
-                path = os.path.abspath('我的文件')
-                file_names= os.listdir(path)
-                client_socket.send(bytes(json.dumps(file_names).encode('utf-8')))
-            elif data[:3] == 'alr':
-                while True:
-                    with open(self.path, "rb") as f:
-                        for i in range(self.file_num):
-                            data_f = f.read(1024)
-                            client_socket.send(data_f)
-                    break
+
+    def receive(self, conn):
+        """读一次套接字并处理收到的所有消息，对端关闭时返回 False"""
+        if conn.framed:
+            n = conn.reader.recv_from(conn.sock)
+            if not n:
+                return False
+            self.stats.received(n)
+            conn.last_seen = time.monotonic()
+            for kind, payload in conn.reader.frames():
+                if kind & FRAME_COMPRESSED:
+                    if conn.codec is None:
+                        raise FrameError('未协商压缩却收到压缩帧')
+                    kind, payload = conn.codec.decompress(kind, payload)
+                    payload = memoryview(payload)
+                if kind == FRAME_DATA and conn.stream is not None:
+                    self.on_stream_data(conn, payload)
+                elif kind == FRAME_DATA:
+                    self.on_upload_data(conn, payload)
+                elif kind == FRAME_CONTROL:
+                    self.dispatch(conn, json.loads(payload.tobytes().decode('utf-8')))
+                else:
+                    raise FrameError('未知帧类型: {}'.format(kind))
+            return True
+        if conn.stream is not None:
+            n = conn.stream.recv_from(conn.sock)
+            if not n:
+                return False
+            self.stats.received(n)
+            conn.last_seen = conn.last_active = time.monotonic()
+            if not conn.stream.remaining:
+                self.finish_stream(conn)
+            return True
+        # 旧协议：一次 recv 就是一条消息或一个文件分块
+        data = conn.sock.recv(1024)
+        if not data:
+            return False
+        self.stats.received(len(data))
+        conn.last_seen = time.monotonic()
+        if conn.upload is not None:
+            self.on_upload_data(conn, data)
+        else:
+            self.dispatch(conn, json.loads(data.decode('utf-8')))
+        return True
+
+    def dispatch(self, conn, data):
+        """按命令分发一条控制消息，两种模式共用"""
+        start = time.perf_counter()
+        if self.log_sample and self.stats.messages % self.log_sample == 0 and log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: %.200r', conn.name, data)
+        if type(data) == list:
+            handler = self.handlers.get(data[0])
+            if handler is not None:
+                command = data[0]
+                handler(conn, data)
+            elif type(data[1]) == int:
+                command = 'upload_chunks'
+                self.on_upload(conn, data)
             else:
-                msg_data = data
-                for c in self.clients_socket:
-                    data = (self.client_addr_name[client_address] + " " + time.strftime("%Y-%m-%d, %H:%M:%S") + "\n" + msg_data)
-                    c.send(json.dumps(data).encode('utf-8'))
+                command = 'unknown'
+        elif data == 'working':
+            command = 'working'
+            with self.clients_lock:
+                if not conn.name in self.clients_name:
+                    self.clients_name.append(conn.name)
+        elif data[:8] == 'download':
+            command = 'download'
+            self.on_download(conn, data)
+        elif data[:3] == 'alr':
+            command = 'alr'
+            self.on_alr(conn, data)
+        else:
+            command = 'chat'
+            self.on_chat(conn, data)
+        if command not in ('ping', 'pong'):
+            conn.last_active = conn.last_seen
+        self.stats.command(command, time.perf_counter() - start)
 
+    def query(self, name, params=(), **kwargs):
+        """执行连接池里注册过的语句并记录耗时"""
+        start = time.perf_counter()
+        try:
+            return self.db.execute(name, params, **kwargs)
+        finally:
+            self.stats.db_call(name, time.perf_counter() - start)
 
+    @staticmethod
+    def default_pool():
+        if psycopg2 is None:
+            raise RuntimeError('未安装 psycopg2，请传入 db 连接池')
+        return ConnectionPool(lambda: psycopg2.connect(**DB_CONFIG), dialect='postgres', maxconn=10)
 
+    def on_register(self, conn, data):
+        user = data[1]
+        password = data[2]
+        self.query('register', (user, password), commit=True)
+        if self.credentials is not None:
+            self.credentials.invalidate(user)
+        self.publish(['invalidate', user])
+        conn.send_msg('sccess')
 
+    def on_login(self, conn, data):
+        """
+        ['login', 用户名, 密码] -> 'access' / 'fail'
+        第四项可以带客户端能力 {'compress': ['zlib', 'none']}，此时回复 ['access', {'compress': 选中的算法}]，
+        之后双方都可以发带 FRAME_COMPRESSED 标记的帧
+        """
+        user = data[1]
+        password = data[2]
+        if self.check_password(user, password):
+            if len(data) > 3 and isinstance(data[3], dict):
+                codec = self.negotiate(conn, data[3])
+                conn.send_msg(['access', {'compress': codec}])
+                if codec == 'zlib':
+                    conn.codec = StreamCodec(self.compress_level, self.stats)
+            else:
+                conn.send_msg('access')
+            with self.clients_lock:
+                self.__client_cnt += 1
+                self.client_addr_name[conn.address] = user
+                self.user_name.append(user)
+            self.publish(['join', user])
+            log.info('%s 登录', user)
+            if conn.framed and self.replay:
+                # 旧协议一次只 recv 1024 字节，放不下历史记录，只给分帧协议补发
+                conn.send_msg(['history', DEFAULT_ROOM, self.history.recent(DEFAULT_ROOM, self.replay)])
+            self.broadcast('client' + user)
+        else:
+            log.info('%s 登录失败', user)
+            conn.send_msg('fail')
 
+    def negotiate(self, conn, caps):
+        """按客户端给出的顺序选第一个双方都支持的压缩算法"""
+        if not conn.framed:
+            return 'none'
+        for name in caps.get('compress', ()):
+            if name in self.compression and name in StreamCodec.NAMES:
+                return name
+        return 'none'
 
-    def Listen(self):
-        self.server_listening = True
+    def check_password(self, user, password):
+        """先查凭据缓存，未命中时按用户名查单行"""
+        if self.credentials is not None and self.credentials.check(user, password):
+            return True
+        rew = self.query('password', (user,), fetch='one')
+        if rew is None or rew[0] != password:
+            return False
+        if self.credentials is not None:
+            self.credentials.put(user, password)
+        return True
+
+    def on_load(self, conn, data):
+        # 传输状态保存在连接上，避免多个客户端互相覆盖
+        file_name = data[1]
+        entry = self.catalog.get(file_name)
+        if entry is None:
+            conn.send_msg('fail')
+            return
+        conn.path = file_name
+        conn.file_num = entry["chunks"]
+        conn.send_msg([conn.file_num, file_name])
+
+    def on_upload(self, conn, data):
+        conn.send_msg('alr')
+        file_path = os.path.abspath(os.path.join(FILE_DIR, data[0]))
+        f = open(file_path, "wb")
+        if data[1] > 0:
+            conn.upload = [f, data[1]]
+        else:
+            f.close()
+            self.file_changed(data[0])
+            log.info('上传完成: %s', data[0])
+
+    def on_upload_data(self, conn, data):
+        if conn.upload is None:
+            raise FrameError('没有进行中的上传')
+        conn.last_active = conn.last_seen
+        f, remaining = conn.upload
+        f.write(data)
+        if remaining <= 1:
+            f.close()
+            conn.upload = None
+            self.file_changed(os.path.basename(f.name))
+            log.info('上传完成: %s', os.path.basename(f.name))
+        else:
+            conn.upload[1] = remaining - 1
+
+    def on_stream_upload(self, conn, data):
+        """
+        ['upload', 文件名, 总字节数, sha256] -> ['resume', 已收到的字节数]
+        客户端从该偏移继续发送，收满后回复 ['done', 文件名] 或 ['bad', 文件名]
+        """
+        if len(data) == 2 and type(data[1]) == int:
+            # 旧协议里名为 upload 的文件
+            return self.on_upload(conn, data)
+        if conn.stream is not None:
+            conn.stream.close()
+        conn.stream = Upload(data[1], int(data[2]), data[3])
+        conn.send_msg(['resume', conn.stream.received])
+        if not conn.stream.remaining:
+            self.finish_stream(conn)
+
+    def on_stream_data(self, conn, data):
+        conn.last_active = conn.last_seen
+        conn.stream.write(data)
+        if not conn.stream.remaining:
+            self.finish_stream(conn)
+
+    def finish_stream(self, conn):
+        stream, conn.stream = conn.stream, None
+        if stream.finish():
+            self.file_changed(stream.name, manifest=isinstance(stream, ChunkedUpload))
+            log.info('上传完成: %s (%d 字节)', stream.name, stream.size)
+            conn.send_msg(['done', stream.name])
+        else:
+            log.warning('上传校验失败: %s', stream.name)
+            conn.send_msg(['bad', stream.name])
+
+    def on_offer(self, conn, data):
+        """
+        ['offer', 文件名, 总字节数, sha256, 块大小, [块摘要, ...]] -> ['need', 文件名, [缺少的块序号, ...]]
+        客户端按序号顺序每块发一个数据帧，收齐后回复 ['done', 文件名] 或 ['bad', 文件名]
+        只支持分帧协议：旧协议分不清块的边界
+        """
+        if not conn.framed:
+            conn.send_msg(['fail', data[1]])
+            return
+        if conn.stream is not None:
+            conn.stream.close()
+        conn.stream = ChunkedUpload(self.chunks, data[1], int(data[2]), data[3], int(data[4]), data[5])
+        conn.send_msg(['need', conn.stream.name, conn.stream.missing])
+        if not conn.stream.remaining:
+            self.finish_stream(conn)
+
+    def source(self, name):
+        """文件名 -> FileSlice 能读的来源：去重存储的文件给 ChunkReader，普通文件给路径"""
+        manifest = self.chunks.manifest(name)
+        if manifest is not None:
+            return self.chunks.open(name, manifest)
+        return os.path.join(FILE_DIR, name)
+
+    def file_changed(self, name, manifest=False):
+        """本进程写完一个文件：同名的另一种存储形式作废，更新目录索引，并通知其它 worker"""
+        if manifest:
+            try:
+                os.remove(os.path.join(FILE_DIR, name))
+            except FileNotFoundError:
+                pass
+        else:
+            self.chunks.remove_manifest(name)
+        self.catalog.update(name)
+        self.publish(['file', name])
+
+    def on_download(self, conn, data):
+        conn.send_msg(self.catalog.names())
+
+    def on_list(self, conn, data):
+        """
+        ['list', 前缀, 页码, 每页条数] -> ['files', 匹配总数, [[文件名, 大小, 修改时间, 分块数], ...]]
+        大目录分页返回，不再一次发整个列表
+        """
+        if len(data) == 2 and type(data[1]) == int:
+            # 旧协议里名为 list 的文件
+            return self.on_upload(conn, data)
+        prefix = data[1] if len(data) > 1 else ''
+        # 页码、每页条数由客户端给，夹到合法范围：负页码不能把切片起点带到前缀范围外面
+        page = max(int(data[2]) if len(data) > 2 else 0, 0)
+        page_size = max(1, min(int(data[3]) if len(data) > 3 else 100, self.MAX_PAGE_SIZE))
+        entries, total = self.catalog.list(prefix, page, page_size)
+        conn.send_msg(['files', total, [[e["name"], e["size"], e["mtime"], e["chunks"]] for e in entries]])
+
+    def on_get(self, conn, data):
+        """
+        ['get', 文件名, 偏移, 长度] -> ['transfer', 传输号, 文件名, 偏移, 长度, 文件大小]
+        之后是该区间的数据（分帧协议下为带传输号和偏移的 FRAME_RANGE 帧），最后 ['end', 传输号]
+        长度省略时传到文件末尾；同一连接可以同时进行多个传输，客户端也可以开多条连接并行拉取不同区间
+        """
+        if len(data) == 2 and type(data[1]) == int:
+            # 旧协议里名为 get 的文件
+            return self.on_upload(conn, data)
+        file_name = data[1]
+        offset = int(data[2]) if len(data) > 2 else 0
+        if offset < 0 or self.catalog.get(file_name) is None:
+            conn.send_msg(['fail', file_name])
+            return
+        if len(conn.transfers) >= self.MAX_TRANSFERS:
+            conn.send_msg(['busy', file_name])
+            return
+        count = int(data[3]) if len(data) > 3 and data[3] is not None else None
+        tid, item = conn.start_transfer(self.source(file_name), offset, count)
+        conn.send_msg(['transfer', tid, file_name, item.offset, item.remaining, item.size])
+        conn.queue_transfer(item)
+
+    def on_cancel(self, conn, data):
+        conn.cancel_transfer(int(data[1]))
+
+    def on_stats(self, conn, data):
+        """['stats'] -> ['stats', 快照]"""
+        conn.send_msg(['stats', self.stats.snapshot(self)])
+
+    def on_users(self, conn, data):
+        """['users'] -> ['users', 所有 worker 上的在线用户]"""
+        conn.send_msg(['users', self.online_users()])
+
+    def online_users(self):
+        with self.clients_lock:
+            users = self.user_name + list(self.remote_users.elements())
+        return sorted(users)
+
+    def dump_stats(self):
+        """把快照原子地写到 stats_file"""
+        tmp = self.stats_file + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.stats.snapshot(self), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.stats_file)
+
+    def stats_loop(self):
         while self.server_listening:
+            time.sleep(self.stats_interval)
             try:
-                client_socket, client_address = self.server.accept()
-                self.clients_socket.append(client_socket)
-                client_socket.setblocking(False)
-                client_socket.settimeout(5)
-            except BlockingIOError:
-                continue
-            except ConnectionAbortedError:
-                return '连接断开'
-            except ConnectionResetError:
-                return '连接断开'
-            print('连接成功')
+                self.dump_stats()
+            except OSError as e:
+                log.warning('写统计文件失败: %s', e)
+
+    def on_ping(self, conn, data):
+        """客户端发起的心跳：['ping', x] -> ['pong', x]"""
+        conn.send_msg(['pong'] + data[1:])
+
+    def on_pong(self, conn, data):
+        # 收到任何数据时 last_seen 已经更新，这里只清掉未回应的 ping
+        conn.pinged = None
+
+    def check_timers(self, now=None):
+        """推进时间轮，处理到期的连接；线程模式由 timers 线程调用，事件循环模式在循环里调用"""
+        now = time.monotonic() if now is None else now
+        if now < self.next_tick:
+            return
+        self.next_tick = now + self.timers.tick
+        for conn in self.timers.advance(now):
+            if not conn.closed:
+                self.on_timer(conn, now)
+
+    def on_timer(self, conn, now):
+        """
+        一个连接的时间到了：按最后收到或写出数据的时间决定发 ping、断开还是重新排期
+        收到数据只更新时间戳，不动时间轮，所以这里总要重新算下一次检查的时间
+        下载中的 ping 排在整个区间后面，对端没法及时回应；只要数据还在往外写，就当连接是活的
+        """
+        if self.idle_timeout and now - conn.last_active >= self.idle_timeout:
+            return self.reap(conn, 'idle')
+        deadline = now + self.ping_interval if self.ping_interval else None
+        if self.ping_interval and conn.framed:
+            alive = max(conn.last_seen, conn.last_sent)
+            if conn.pinged is not None and alive < conn.pinged:
+                if now - conn.pinged >= self.grace:
+                    return self.reap(conn, 'dead')
+                deadline = conn.pinged + self.grace
+            elif now - alive >= self.ping_interval:
+                conn.pinged = now
+                self.stats.ping()
+                conn.send_msg(['ping', int(now * 1000)])
+                deadline = now + self.grace
+            else:
+                conn.pinged = None
+                deadline = alive + self.ping_interval
+        if self.idle_timeout:
+            idle_at = conn.last_active + self.idle_timeout
+            deadline = idle_at if deadline is None else min(deadline, idle_at)
+        if deadline is not None:
+            self.timers.add(conn, deadline)
+
+    def reap(self, conn, reason):
+        log.info('%s %s，断开 (%s)', conn.name, '心跳超时' if reason == 'dead' else '空闲超时', conn.address)
+        self.stats.reap(reason)
+        self.drop(conn)
+
+    def timer_loop(self):
+        while self.server_listening:
+            time.sleep(self.timers.tick)
+            self.check_timers()
+
+    def on_alr(self, conn, data):
+        conn.send_file(self.source(conn.path))
+
+    def on_chat(self, conn, msg_data):
+        data = (self.client_addr_name[conn.address] + " " + time.strftime("%Y-%m-%d, %H:%M:%S") + "\n" + msg_data)
+        self.deliver(data)
+        self.history.add(DEFAULT_ROOM, data)
+        self.publish(['chat', DEFAULT_ROOM, data])
+
+    def on_peer_chat(self, msg):
+        # 别的 worker 上的聊天：转给本进程的客户端并记进内存，落盘由发出它的 worker 负责
+        self.deliver(msg[2])
+        self.history.add(msg[1], msg[2], persist=False)
+
+    def on_history(self, conn, data):
+        """['history', 房间, 条数] -> ['history', 房间, [消息, ...]]"""
+        room = data[1] if len(data) > 1 else DEFAULT_ROOM
+        n = int(data[2]) if len(data) > 2 else self.replay
+        conn.send_msg(['history', room, self.history.recent(room, n)])
+
+    def broadcast(self, data):
+        """发给本进程的所有客户端，多进程模式下再经总线发给其它 worker"""
+        self.deliver(data)
+        self.publish(['broadcast', data])
+
+    def deliver(self, data):
+        # 只序列化一次，所有接收者共享同一个 memoryview；开了压缩的连接各自压缩 body
+        body = json.dumps(data).encode('utf-8')
+        payload = body
+        if self.protocol == 'framed':
+            payload = pack_frame(FRAME_CONTROL, payload)
+        payload = memoryview(payload)
+        with self.clients_lock:
+            targets = [self.connections[c] for c in self.clients_socket if c in self.connections]
+        for conn in targets:
+            conn.offer(payload, body)
+
+    def drop(self, conn):
+        """断开并清理一个客户端，可以从任意线程重复调用"""
+        client_socket = conn.sock
+        with self.clients_lock:
+            if self.connections.pop(client_socket, None) is None:
+                return
+            self.__client_cnt -= 1
+            if client_socket in self.clients_socket:
+                self.clients_socket.remove(client_socket)
+                if conn.address in self.client_addr_name:
+                    self.user_name.remove(self.client_addr_name[conn.address])
+                    self.publish(['leave', self.client_addr_name[conn.address]])
+            if conn.name in self.clients_name:
+                self.clients_name.remove(conn.name)
+            if conn.address in self.client_addr_name:
+                del self.client_addr_name[conn.address]
+        conn.close()
+        if conn.upload is not None:
+            conn.upload[0].close()
+            conn.upload = None
+        if conn.stream is not None:
+            conn.stream.close()
+            conn.stream = None
+        if self.selector is not None:
+            try:
+                self.selector.unregister(client_socket)
+            except (KeyError, ValueError):
+                pass
+        try:
+            # 线程模式下读线程可能正阻塞在 recv 上，shutdown 才能把它叫醒
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client_socket.close()
+
+    def publish(self, msg):
+        if self.bus is None:
+            return
+        try:
+            self.bus.publish(msg)
+        except OSError as e:
+            log.warning('总线发送失败: %s', e)
+
+    def on_bus(self):
+        """处理其它 worker 经总线发来的消息；主进程退出时本 worker 也停下"""
+        try:
+            messages = self.bus.receive()
+        except OSError:
+            messages = None
+        if messages is None:
+            log.warning('总线已断开，worker 退出')
+            self.stop()
+            return False
+        for msg in messages:
+            handler = self.bus_handlers.get(msg[0])
+            if handler is not None:
+                handler(msg)
+        return True
+
+    def on_peer_join(self, msg):
+        with self.clients_lock:
+            self.remote_users[msg[1]] += 1
+
+    def on_peer_leave(self, msg):
+        with self.clients_lock:
+            self.remote_users[msg[1]] -= 1
+            if self.remote_users[msg[1]] <= 0:
+                del self.remote_users[msg[1]]
+
+    def on_peer_register(self, msg):
+        # 别的 worker 上注册/改了密码，本进程缓存的凭据作废
+        if self.credentials is not None:
+            self.credentials.invalidate(msg[1])
+
+    def bus_loop(self):
+        while self.server_listening and self.on_bus():
+            pass
+
+    def accept(self):
+        client_socket, client_address = self.server.accept()
+        # 回复和广播都是小包，关掉 Nagle，避免和客户端的延迟确认叠加出 40ms 的等待
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.keepalive(client_socket)
+        log.info('连接成功: %s', client_address)
+        self.stats.connected()
+        with self.clients_lock:
             client_name = 'client{}'.format(self.__client_cnt)
-            msg_tread = threading.Thread(name=client_name, target=self.get_msg, args=[client_socket, client_name, client_address])
-            msg_tread.setDaemon(True)
-            msg_tread.start()
+            conn = Connection(self, client_socket, client_address, client_name, framed=self.protocol == 'framed')
+            self.clients_socket.append(client_socket)
+            self.connections[client_socket] = conn
+        if self.ping_interval or self.idle_timeout:
+            self.timers.add(conn, conn.last_seen + min(t for t in (self.ping_interval, self.idle_timeout) if t))
+        return conn
+
+    def keepalive(self, sock):
+        """内核级探测，旧协议客户端回不了 ping，靠它发现已经断掉的对端"""
+        if not self.ping_interval:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(self.ping_interval)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(self.grace / 3)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+    def Listen(self):
+        self.server_listening = True
+        if self.stats_file:
+            threading.Thread(name='stats', target=self.stats_loop, daemon=True).start()
+        self.history.start()
+        if self.bus is not None and self.mode == 'thread':
+            threading.Thread(name='bus', target=self.bus_loop, daemon=True).start()
+        if self.mode == 'thread':
+            threading.Thread(name='timers', target=self.timer_loop, daemon=True).start()
+        if self.mode == 'event':
+            return self.listen_event()
+        # 线程模式：每个客户端一个线程，accept 通过 select 等待而不是空转
+        self.selector = None
+        waiter = selectors.DefaultSelector()
+        waiter.register(self.server, selectors.EVENT_READ)
+        try:
+            while self.server_listening:
+                if not waiter.select(timeout=1):
+                    continue
+                try:
+                    conn = self.accept()
+                except BlockingIOError:
+                    continue
+                except ConnectionAbortedError:
+                    return '连接断开'
+                except ConnectionResetError:
+                    return '连接断开'
+                # 阻塞读，不再设 recv 超时：空闲不等于断线，死连接由心跳（check_timers）清理
+                conn.sock.setblocking(True)
+                msg_tread = threading.Thread(name=conn.name, target=self.get_msg, args=[conn.sock, conn.name, conn.address])
+                msg_tread.daemon = True
+                msg_tread.start()
+                threading.Thread(name=conn.name + '-writer', target=conn.write_loop, daemon=True).start()
+        finally:
+            waiter.close()
+
+    def stop(self):
+        """让 Listen 在下一次 select 超时后退出，没写完的聊天记录这时落盘"""
+        self.server_listening = False
+        self.history.close()
+
+    def listen_event(self):
+        """事件循环模式：单线程用 selectors 复用所有客户端套接字"""
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        if self.bus is not None:
+            # 总线消息也在事件循环里处理，广播和本进程的发送不会并发
+            self.selector.register(self.bus.sock, selectors.EVENT_READ, self.bus)
+        try:
+            while self.server_listening:
+                for key, mask in self.selector.select(timeout=min(1, self.timers.tick)):
+                    if key.fileobj is self.server:
+                        self.on_accept()
+                        continue
+                    if key.data is self.bus:
+                        self.on_bus()
+                        continue
+                    conn = key.data
+                    if conn.closed:
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self.on_writable(conn)
+                    if mask & selectors.EVENT_READ and not conn.closed:
+                        self.on_readable(conn)
+                self.check_timers()
+        finally:
+            self.selector.close()
+            self.selector = None
 
+    def on_accept(self):
+        try:
+            conn = self.accept()
+        except (BlockingIOError, ConnectionAbortedError, ConnectionResetError):
+            return
+        conn.sock.setblocking(False)
+        self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+    def on_readable(self, conn):
+        try:
+            alive = self.receive(conn)
+        except BlockingIOError:
+            return
+        except Exception as e:
+            log.debug('%s 断开: %r', conn.name, e)
+            self.drop(conn)
+            return
+        if not alive:
+            self.drop(conn)
+
+    def on_writable(self, conn):
+        try:
+            done = conn.flush()
+        except OSError:
+            self.drop(conn)
+            return
+        if done and not conn.closed:
+            conn.writing = False
+            self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def want_write(self, conn):
+        if self.selector is not None and conn.sock in self.connections and not conn.writing:
+            conn.writing = True
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+
+
+def migrate(connect=None):
+    """
+    一次性迁移：给 users 表的用户名列建索引，登录的单行查询靠它
+    上线前手动执行一次 python server.py migrate，不在 Server 启动时做；
+    DDL 不能放进 PREPARE，这里直接用驱动执行
+    """
+    if connect is None:
+        if psycopg2 is None:
+            raise RuntimeError('未安装 psycopg2')
+        connect = lambda: psycopg2.connect(**DB_CONFIG)
+    db = connect()
+    try:
+        curr = db.cursor()
+        curr.execute("create index if not exists users_{0}_idx on users ({0})".format(USER_COLUMN))
+        curr.close()
+        db.commit()
+    finally:
+        db.close()
+
+
+def _worker_main(bus_sock, inherited, db_factory, options):
+    # fork 继承来的总线其它端口要关掉，否则主进程退出时 worker 收不到 EOF
+    for fd in inherited:
+        os.close(fd)
+    db = db_factory() if db_factory is not None else None
+    server = Server(db=db, reuse_port=True, bus=bus_sock, **options)
+    log.info('worker %d 开始监听 %s', os.getpid(), server.server.getsockname())
+    try:
+        server.Listen()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+def run_workers(workers, host=None, port=9999, db_factory=None, **options):
+    """
+    多进程模式：启动 workers 个子进程，各自用 SO_REUSEPORT 监听同一端口，
+    主进程只负责在它们之间转发广播、上下线等消息（BusHub）
+    数据库连接不能跨进程共用，每个 worker 用 db_factory() 建自己的连接池（默认连 postgres）
+    """
+    import multiprocessing
+    context = multiprocessing.get_context('fork')
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('当前系统不支持 SO_REUSEPORT，无法使用多进程模式')
+    host = host if host is not None else CheckIp()
+    os.makedirs(FILE_DIR, exist_ok=True)
+    # 主进程先占住端口但不监听（不会分到连接），port=0 时所有 worker 也能用同一个随机端口
+    reserved = socket.socket()
+    reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reserved.bind((host, port))
+    port = reserved.getsockname()[1]
+    hub = BusHub()
+    processes = []
+    for i in range(workers):
+        worker_end = hub.add_worker()
+        inherited = [sock.fileno() for sock in hub.peers] + [reserved.fileno()]
+        p = context.Process(name='worker{}'.format(i), target=_worker_main,
+                            args=(worker_end, inherited, db_factory, dict(options, host=host, port=port)))
+        p.start()
+        worker_end.close()
+        processes.append(p)
+    log.info('%d 个 worker 监听 %s:%d', workers, host, port)
+    try:
+        hub.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.stop()
+        reserved.close()
+        for p in processes:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
 
 
 if __name__ == '__main__':
-    server = Server()
-    server.Listen()
\ No newline at end of file
+    import sys
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'thread'
+    protocol = sys.argv[2] if len(sys.argv) > 2 else 'legacy'
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    if mode == 'migrate':
+        migrate()
+    elif mode == 'collect':
+        # 文件被覆盖或改成普通上传后，旧清单引用的块就没人用了
+        log.info('清理了 %d 个无用的数据块', ChunkStore().collect())
+    elif workers > 1:
+        run_workers(workers, mode=mode, protocol=protocol)
+    else:
+        server = Server(mode=mode, protocol=protocol)
+        try:
+            server.Listen()
+        finally:
+            server.stop()
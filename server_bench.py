@@ -0,0 +1,798 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import server
+from dbpool import ConnectionPool
+
+BENCH_DIR = '.bench'
+BENCHES = ('login', 'chat', 'workers', 'upload', 'dedup', 'download', 'parallel', 'compress', 'idle')
+# 结果里这些字段是测量值，其余字段用来在两次结果之间配对
+METRICS = ('mb_per_s', 'msgs_per_s', 'logins_per_s', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms',
+           'server_cpu_s', 'cpu_ms_per_conn', 'delivered', 'wire_mb', 'ratio', 'sent_mb')
+
+
+def sqlite_pool(path):
+    """本地 sqlite 代替 PostgreSQL，接口和服务器用的连接池一致"""
+    def connect():
+        db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        db.execute("create table if not exists users ({} text, {} text)".format(server.USER_COLUMN, server.PASSWORD_COLUMN))
+        db.commit()
+        return db
+    return ConnectionPool(connect, dialect='sqlite', maxconn=8)
+
+
+def seed_users(path, count):
+    """预先插入 count 个用户，模拟大用户表"""
+    db = sqlite3.connect(path)
+    db.execute("create table if not exists users ({} text, {} text)".format(server.USER_COLUMN, server.PASSWORD_COLUMN))
+    db.executemany("insert into users values (?, ?)", (('seed{}'.format(i), 'pw{}'.format(i)) for i in range(count)))
+    db.commit()
+    db.close()
+
+
+def _serve(pipe, db_path, options):
+    """子进程里跑服务器，通过管道汇报端口和 CPU 时间"""
+    sys.stdout = open(os.devnull, 'w', encoding='utf-8')
+    options = dict(options)
+    options.setdefault('host', '127.0.0.1')
+    options.setdefault('port', 0)
+    options.setdefault('history_file', os.path.join(BENCH_DIR, 'chat-{}.log'.format(os.getpid())))
+    s = server.Server(db=sqlite_pool(db_path), **options)
+    threading.Thread(target=s.Listen, daemon=True).start()
+    pipe.send(s.server.getsockname()[1])
+    while True:
+        cmd = pipe.recv()
+        if cmd == 'stop':
+            s.stop()
+            pipe.send(time.process_time())
+            return
+        pipe.send(time.process_time())
+
+
+class ServerProcess():
+    """
+    在独立进程里启动服务器，客户端在本进程里跑
+    这样服务器的 CPU 时间能单独统计，也不和客户端抢 GIL
+    workers > 1 时启动多个 SO_REUSEPORT 进程，总线（BusHub）跑在本进程的一个线程里
+    """
+    _count = 0
+
+    def __init__(self, users=0, workers=1, **options):
+        ServerProcess._count += 1
+        self.db_path = os.path.join(BENCH_DIR, 'users-{}.db'.format(ServerProcess._count))
+        if users:
+            seed_users(self.db_path, users)
+        self.hub = server.BusHub() if workers > 1 else None
+        self.pipes = []
+        self.processes = []
+        self.port = 0
+        for i in range(workers):
+            if self.hub is not None:
+                options = dict(options, port=self.port, reuse_port=True, bus=self.hub.add_worker())
+            pipe, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, args=(child, self.db_path, options), daemon=True)
+            process.start()
+            if self.hub is not None:
+                options['bus'].close()
+            # 第一个进程绑定的随机端口给后面的进程复用
+            self.port = pipe.recv()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+        if self.hub is not None:
+            threading.Thread(target=self.hub.run, daemon=True).start()
+
+    def cpu(self):
+        """服务器进程到目前为止用掉的 CPU 秒数（多进程时求和）"""
+        for pipe in self.pipes:
+            pipe.send('cpu')
+        return sum(pipe.recv() for pipe in self.pipes)
+
+    def stop(self):
+        for pipe in self.pipes:
+            pipe.send('stop')
+        cpu = sum(pipe.recv() for pipe in self.pipes)
+        for process in self.processes:
+            process.join(5)
+        if self.hub is not None:
+            self.hub.stop()
+        return cpu
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if all(p.is_alive() for p in self.processes):
+            self.stop()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def start_server(**kwargs):
+    """在回环地址的随机端口上启动服务器，返回 (server, port)"""
+    kwargs.setdefault('db', sqlite_pool(os.path.join(BENCH_DIR, 'users.db')))
+    kwargs.setdefault('history_file', os.path.join(BENCH_DIR, 'chat.log'))
+    s = server.Server(host='127.0.0.1', port=0, **kwargs)
+    threading.Thread(target=s.Listen, daemon=True).start()
+    return s, s.server.getsockname()[1]
+
+
+class Client():
+    """模拟客户端，两种协议都支持"""
+    def __init__(self, port, protocol='legacy'):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.protocol = protocol
+        self.reader = server.FrameReader() if protocol == 'framed' else None
+        self.frames = []
+        self.codec = None
+        self.wire_in = 0            # 实际收到的字节数（压缩后）
+
+    def send_msg(self, data):
+        payload = json.dumps(data).encode('utf-8')
+        if self.codec is not None:
+            payload = self.codec.frame(server.FRAME_CONTROL, payload)
+        elif self.protocol == 'framed':
+            payload = server.pack_frame(server.FRAME_CONTROL, payload)
+        self.sock.sendall(payload)
+
+    def send_data(self, data):
+        if self.protocol == 'framed':
+            self.sock.sendall(server.FRAME_HEADER.pack(server.FRAME_DATA, len(data)))
+        self.sock.sendall(data)
+
+    def recv_frame(self):
+        """分帧协议下读一帧，返回 (类型, bytes)"""
+        while not self.frames:
+            n = self.reader.recv_from(self.sock)
+            if not n:
+                raise ConnectionResetError('服务器关闭了连接')
+            self.wire_in += n
+            for kind, payload in self.reader.frames():
+                if kind & server.FRAME_COMPRESSED:
+                    # 'access' 回复后面紧跟的压缩帧可能和它在同一次 recv 里到达
+                    if self.codec is None:
+                        self.codec = server.StreamCodec()
+                    kind, payload = self.codec.decompress(kind, payload)
+                self.frames.append((kind, bytes(payload)))
+        return self.frames.pop(0)
+
+    def recv_msg(self):
+        if self.protocol == 'framed':
+            kind, payload = self.recv_frame()
+            while kind != server.FRAME_CONTROL:
+                kind, payload = self.recv_frame()
+            return json.loads(payload.decode('utf-8'))
+        return json.loads(self.sock.recv(65536).decode('utf-8'))
+
+    def wait_for(self, accept):
+        """跳过广播等无关消息（顺带回应服务器的心跳），直到收到 accept(msg) 为真的那条"""
+        while True:
+            msg = self.recv_msg()
+            if isinstance(msg, list) and msg and msg[0] == 'ping':
+                self.send_msg(['pong'] + msg[1:])
+            if accept(msg):
+                return msg
+
+    def login(self, user, password, compress=None):
+        """compress 是要协商的压缩算法列表，例如 ['zlib', 'none']"""
+        if compress is None:
+            self.send_msg(['login', user, password])
+            return self.wait_for(lambda m: m in ('access', 'fail')) == 'access'
+        self.send_msg(['login', user, password, {'compress': compress}])
+        reply = self.wait_for(lambda m: m == 'fail' or isinstance(m, list) and m[0] == 'access')
+        if reply == 'fail':
+            return False
+        if reply[1]['compress'] == 'zlib' and self.codec is None:
+            self.codec = server.StreamCodec()
+        return True
+
+    def upload(self, name, data, block=1024 * 1024):
+        """流式上传，返回服务器的最终回复"""
+        digest = hashlib.sha256(data).hexdigest()
+        self.send_msg(['upload', name, len(data), digest])
+        offset = self.wait_for(lambda m: isinstance(m, list) and m[0] == 'resume')[1]
+        view = memoryview(data)
+        for i in range(offset, len(data), block):
+            self.send_data(view[i:i + block])
+        return self.wait_for(lambda m: isinstance(m, list) and m[0] in ('done', 'bad'))
+
+    def upload_chunks(self, name, data, chunk_size=256 * 1024):
+        """去重上传：先报块摘要，只发服务器缺的块，返回 (最终回复, 实际发送的数据字节数)"""
+        view = memoryview(data)
+        chunks = [hashlib.sha256(view[i:i + chunk_size]).hexdigest() for i in range(0, len(data), chunk_size)]
+        self.send_msg(['offer', name, len(data), hashlib.sha256(data).hexdigest(), chunk_size, chunks])
+        missing = self.wait_for(lambda m: isinstance(m, list) and m[0] == 'need')[2]
+        sent = 0
+        for i in missing:
+            block = view[i * chunk_size:(i + 1) * chunk_size]
+            self.send_data(block)
+            sent += len(block)
+        return self.wait_for(lambda m: isinstance(m, list) and m[0] in ('done', 'bad')), sent
+
+    def download(self, name, size):
+        """load + alr 下载整个文件，返回收到的字节数"""
+        self.send_msg(['load', name])
+        self.recv_msg()
+        self.send_msg('alr')
+        got = 0
+        if self.protocol == 'framed':
+            while got < size:
+                kind, payload = self.recv_frame()
+                got += len(payload)
+            return got
+        buf = bytearray(1024 * 1024)
+        while got < size:
+            n = self.sock.recv_into(buf)
+            if not n:
+                break
+            got += n
+        return got
+
+    def get_range(self, name, offset, length):
+        """分帧协议下用 get 拉取一个区间，返回收到的数据字节数"""
+        self.send_msg(['get', name, offset, length])
+        reply = self.wait_for(lambda m: isinstance(m, list) and m[0] in ('transfer', 'fail', 'busy'))
+        if reply[0] != 'transfer':
+            raise RuntimeError('请求失败: {}'.format(reply))
+        tid = reply[1]
+        got = 0
+        while True:
+            kind, payload = self.recv_frame()
+            if kind == server.FRAME_RANGE:
+                got += len(payload) - server.RANGE_HEADER.size
+            elif kind == server.FRAME_CONTROL and json.loads(payload.decode('utf-8')) == ['end', tid]:
+                return got
+
+    def close(self):
+        self.sock.close()
+
+
+def make_file(name, size):
+    path = os.path.join(server.FILE_DIR, name)
+    with open(path, 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        left = size
+        while left > 0:
+            f.write(block[:left])
+            left -= len(block)
+    return path
+
+
+# (名称, 协议, 服务器参数)；第一项就是改造前的路径：每次读 1024 字节再 send
+DOWNLOAD_CASES = [
+    ('1KB read+send', 'legacy', dict(use_sendfile=False, chunk_size=1024)),
+    ('sendfile', 'legacy', dict(use_sendfile=True, chunk_size=1024)),
+    ('framed copy 256KB', 'framed', dict(use_sendfile=False, chunk_size=256 * 1024)),
+    ('framed sendfile 1MB', 'framed', dict(use_sendfile=True, chunk_size=1024 * 1024)),
+]
+
+
+def bench_download(size_mb=64, repeat=3, modes=('thread', 'event')):
+    """下载吞吐：旧的 1KB 分块路径 vs sendfile / 大块发送"""
+    name = '.bench-download.bin'
+    size = size_mb * 1024 * 1024
+    path = make_file(name, size)
+    results = []
+    try:
+        for mode in modes:
+            for label, protocol, options in DOWNLOAD_CASES:
+                s = ServerProcess(mode=mode, protocol=protocol, **options)
+                best = 0.0
+                cpu_start = s.cpu()
+                for i in range(repeat):
+                    client = Client(s.port, protocol)
+                    start = time.perf_counter()
+                    got = client.download(name, size)
+                    elapsed = time.perf_counter() - start
+                    client.close()
+                    assert got == size, '下载不完整: {}/{}'.format(got, size)
+                    best = max(best, size / elapsed / 1024 / 1024)
+                cpu = s.stop() - cpu_start
+                results.append({
+                    "bench": "download",
+                    "mode": mode,
+                    "case": label,
+                    "size_mb": size_mb,
+                    "mb_per_s": round(best, 1),
+                    "server_cpu_s": round(cpu / repeat, 3),
+                })
+                print("{:<7} {:<20} {:>9.1f} MB/s".format(mode, label, best))
+    finally:
+        os.remove(path)
+    return results
+
+
+def bench_login(clients=32, logins=50, users=100000, modes=('thread', 'event')):
+    """登录延迟：clients 个客户端并发，每个登录 logins 次；用户表预先灌入 users 行"""
+    results = []
+    for mode in modes:
+        for cache in (False, True):
+            with ServerProcess(users=users, mode=mode, protocol='framed', login_cache=cache) as s:
+                conns = [Client(s.port, 'framed') for i in range(clients)]
+                latencies = [[] for i in range(clients)]
+
+                def run(k):
+                    c = conns[k]
+                    c.send_msg(['register', 'bench{}'.format(k), 'pw'])
+                    c.wait_for(lambda m: m == 'sccess')
+                    for i in range(logins):
+                        start = time.perf_counter()
+                        assert c.login('bench{}'.format(k), 'pw')
+                        latencies[k].append((time.perf_counter() - start) * 1000)
+                threads = [threading.Thread(target=run, args=(k,)) for k in range(clients)]
+                cpu_start = s.cpu()
+                start = time.perf_counter()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = time.perf_counter() - start
+                cpu = s.cpu() - cpu_start
+                for c in conns:
+                    c.close()
+            values = sorted(v for lat in latencies for v in lat)
+            result = {
+                "bench": "login",
+                "mode": mode,
+                "login_cache": cache,
+                "clients": clients,
+                "users": users,
+                "logins_per_s": round(len(values) / elapsed, 1),
+                "p50_ms": round(percentile(values, 50), 3),
+                "p90_ms": round(percentile(values, 90), 3),
+                "p99_ms": round(percentile(values, 99), 3),
+                "max_ms": round(values[-1], 3),
+                "server_cpu_s": round(cpu, 3),
+            }
+            results.append(result)
+            print("{:<7} 缓存={:<5} p50 {:>7.2f}ms  p99 {:>7.2f}ms  {:>8.1f} 次/秒".format(
+                mode, str(cache), result["p50_ms"], result["p99_ms"], result["logins_per_s"]))
+    return results
+
+
+def bench_chat(clients=50, messages=200, size=100, modes=('thread', 'event')):
+    """聊天扇出：一个客户端连续发 messages 条，统计所有客户端每秒收到的消息数"""
+    results = []
+    text = 'x' * size
+    for mode in modes:
+        with ServerProcess(mode=mode, protocol='framed') as s:
+            conns = [Client(s.port, 'framed') for i in range(clients)]
+            for k, c in enumerate(conns):
+                c.send_msg(['register', 'chat{}'.format(k), 'pw'])
+                c.wait_for(lambda m: m == 'sccess')
+                assert c.login('chat{}'.format(k), 'pw')
+            time.sleep(0.2)
+            got = [0] * clients
+
+            def read(k):
+                c = conns[k]
+                c.sock.settimeout(10)
+                try:
+                    while got[k] < messages:
+                        kind, payload = c.recv_frame()
+                        if payload.startswith(b'"chat0 '):
+                            got[k] += 1
+                except OSError:
+                    pass
+            threads = [threading.Thread(target=read, args=(k,)) for k in range(clients)]
+            for t in threads:
+                t.start()
+            cpu_start = s.cpu()
+            start = time.perf_counter()
+            for i in range(messages):
+                conns[0].send_msg(text)
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            cpu = s.cpu() - cpu_start
+            for c in conns:
+                c.close()
+        delivered = sum(got)
+        results.append({
+            "bench": "chat",
+            "mode": mode,
+            "clients": clients,
+            "messages": messages,
+            "delivered": delivered,
+            "msgs_per_s": round(delivered / elapsed, 1),
+            "server_cpu_s": round(cpu, 3),
+        })
+        print("{:<7} {} 个客户端  {:>10.1f} 条/秒  送达 {}/{}".format(
+            mode, clients, delivered / elapsed, delivered, clients * messages))
+    return results
+
+
+def bench_workers(clients=32, messages=200, size=100, workers=(1, 2, 4), senders=4, mode='event'):
+    """
+    多进程扩展：senders 个客户端同时发聊天，消息经总线扇出到所有 worker 的客户端，
+    按 worker 数比较所有客户端每秒收到的消息数
+    接收端只数字节（每条消息的帧长度固定），尽量不让客户端进程的 GIL 成为瓶颈
+    """
+    results = []
+    text = 'x' * size
+    sample = 'w000 ' + time.strftime("%Y-%m-%d, %H:%M:%S") + "\n" + text
+    frame_size = len(server.pack_frame(server.FRAME_CONTROL, json.dumps(sample).encode('utf-8')))
+    expected = frame_size * senders * messages
+    for n in workers:
+        with ServerProcess(workers=n, mode=mode, protocol='framed') as s:
+            conns = [Client(s.port, 'framed') for i in range(clients)]
+            for k, c in enumerate(conns):
+                c.send_msg(['register', 'w{:03d}'.format(k), 'pw'])
+                c.wait_for(lambda m: m == 'sccess')
+                assert c.login('w{:03d}'.format(k), 'pw')
+            time.sleep(0.3)
+            # 丢掉登录时的上线广播
+            for c in conns:
+                c.sock.settimeout(0.05)
+                try:
+                    while c.sock.recv(65536):
+                        pass
+                except OSError:
+                    pass
+            got = [0] * clients
+
+            def read(k):
+                sock = conns[k].sock
+                sock.settimeout(10)
+                buf = bytearray(256 * 1024)
+                try:
+                    while got[k] < expected:
+                        n_read = sock.recv_into(buf)
+                        if not n_read:
+                            break
+                        got[k] += n_read
+                except OSError:
+                    pass
+
+            def send(k):
+                for i in range(messages):
+                    conns[k].send_msg(text)
+            threads = [threading.Thread(target=read, args=(k,)) for k in range(clients)]
+            for t in threads:
+                t.start()
+            cpu_start = s.cpu()
+            start = time.perf_counter()
+            writers = [threading.Thread(target=send, args=(k,)) for k in range(senders)]
+            for t in writers:
+                t.start()
+            for t in writers + threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            cpu = s.cpu() - cpu_start
+            for c in conns:
+                c.close()
+        delivered = sum(got) // frame_size
+        results.append({
+            "bench": "workers",
+            "mode": mode,
+            "workers": n,
+            "clients": clients,
+            "senders": senders,
+            "messages": messages,
+            "delivered": delivered,
+            "msgs_per_s": round(delivered / elapsed, 1),
+            "server_cpu_s": round(cpu, 3),
+        })
+        print("{:<7} {} 个 worker  {} 个客户端  {:>10.1f} 条/秒  送达 {}/{}".format(
+            mode, n, clients, delivered / elapsed, delivered, clients * senders * messages))
+    return results
+
+
+def bench_upload(size_mb=64, repeat=3, modes=('thread', 'event')):
+    """流式上传吞吐"""
+    data = os.urandom(size_mb * 1024 * 1024)
+    results = []
+    for mode in modes:
+        with ServerProcess(mode=mode, protocol='framed') as s:
+            best = 0.0
+            cpu_start = s.cpu()
+            for i in range(repeat):
+                c = Client(s.port, 'framed')
+                start = time.perf_counter()
+                reply = c.upload('.bench-upload-{}.bin'.format(i), data)
+                elapsed = time.perf_counter() - start
+                c.close()
+                assert reply[0] == 'done', reply
+                best = max(best, len(data) / elapsed / 1024 / 1024)
+            cpu = s.cpu() - cpu_start
+        for i in range(repeat):
+            os.remove(os.path.join(server.FILE_DIR, '.bench-upload-{}.bin'.format(i)))
+        results.append({
+            "bench": "upload",
+            "mode": mode,
+            "size_mb": size_mb,
+            "mb_per_s": round(best, 1),
+            "server_cpu_s": round(cpu / repeat, 3),
+        })
+        print("{:<7} 上传 {:>9.1f} MB/s".format(mode, best))
+    return results
+
+
+def bench_dedup(size_mb=64, modes=('thread', 'event'), chunk_size=256 * 1024):
+    """
+    去重上传：同一个文件第一次上传、改动约 1% 的块后再传、原样再传一次，
+    比较实际发送的字节数和耗时
+    """
+    size = size_mb * 1024 * 1024
+    results = []
+    for mode in modes:
+        data = bytearray(os.urandom(size))
+        with ServerProcess(mode=mode, protocol='framed', chunk_size=1024 * 1024) as s:
+            client = Client(s.port, 'framed')
+            for step in ('first', 'changed', 'same'):
+                if step == 'changed':
+                    for k in range(max(1, size // chunk_size // 100)):
+                        pos = int.from_bytes(os.urandom(4), 'big') % size
+                        data[pos] ^= 0xff
+                start = time.perf_counter()
+                reply, sent = client.upload_chunks('.bench-dedup.bin', data, chunk_size)
+                elapsed = time.perf_counter() - start
+                assert reply[0] == 'done', reply
+                results.append({
+                    "bench": "dedup",
+                    "mode": mode,
+                    "step": step,
+                    "size_mb": size_mb,
+                    "sent_mb": round(sent / 1024 / 1024, 2),
+                    "mb_per_s": round(size / elapsed / 1024 / 1024, 1),
+                })
+                print("{:<7} {:<8} 发送 {:>8.2f} MB / {} MB  {:>9.1f} MB/s".format(
+                    mode, step, sent / 1024 / 1024, size_mb, size / elapsed / 1024 / 1024))
+            client.close()
+    for d in (server.CHUNK_DIR, server.MANIFEST_DIR):
+        shutil.rmtree(d, ignore_errors=True)
+    return results
+
+
+def bench_idle(connections=1000, seconds=3.0, modes=('thread', 'event')):
+    """空闲连接的开销：保持 connections 条连接 seconds 秒，统计服务器 CPU"""
+    results = []
+    for mode in modes:
+        with ServerProcess(mode=mode, protocol='framed') as s:
+            conns = [Client(s.port, 'framed') for i in range(connections)]
+            time.sleep(0.5)
+            cpu_start = s.cpu()
+            time.sleep(seconds)
+            cpu = s.cpu() - cpu_start
+            for c in conns:
+                c.close()
+        per_conn = cpu / connections / seconds * 1000
+        results.append({
+            "bench": "idle",
+            "mode": mode,
+            "connections": connections,
+            "server_cpu_s": round(cpu, 4),
+            "cpu_ms_per_conn": round(per_conn, 5),
+        })
+        print("{:<7} {} 条空闲连接  服务器 CPU {:.3f}s / {:.0f}s".format(mode, connections, cpu, seconds))
+    return results
+
+
+def bench_parallel(size_mb=64, repeat=3, streams=(1, 2, 4, 8), modes=('thread', 'event')):
+    """同一个文件切成 N 个区间，用 N 条连接并行拉取"""
+    name = '.bench-parallel.bin'
+    size = size_mb * 1024 * 1024
+    path = make_file(name, size)
+    results = []
+    try:
+        for mode in modes:
+            s = ServerProcess(mode=mode, protocol='framed', chunk_size=1024 * 1024)
+            port = s.port
+            for n in streams:
+                part = -(-size // n)
+                best = 0.0
+                for i in range(repeat):
+                    clients = [Client(port, 'framed') for k in range(n)]
+                    got = [0] * n
+
+                    def fetch(k):
+                        got[k] = clients[k].get_range(name, k * part, part)
+                    threads = [threading.Thread(target=fetch, args=(k,)) for k in range(n)]
+                    start = time.perf_counter()
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+                    elapsed = time.perf_counter() - start
+                    for c in clients:
+                        c.close()
+                    assert sum(got) == size, '下载不完整: {}/{}'.format(sum(got), size)
+                    best = max(best, size / elapsed / 1024 / 1024)
+                results.append({
+                    "bench": "parallel",
+                    "mode": mode,
+                    "streams": n,
+                    "size_mb": size_mb,
+                    "mb_per_s": round(best, 1),
+                })
+                print("{:<7} {:>2} 条并行   {:>9.1f} MB/s".format(mode, n, best))
+            s.stop()
+    finally:
+        os.remove(path)
+    return results
+
+
+def make_text_file(name, size):
+    """文本为主的文件（类似日志），数字取自 os.urandom，压缩比接近真实数据"""
+    path = os.path.join(server.FILE_DIR, name)
+    words = ['上传', '下载', '登录', '聊天', 'INFO', 'WARN', 'report', 'data', '我的文件']
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            noise = os.urandom(4096)
+            lines = []
+            for i in range(0, len(noise), 8):
+                a, b, c, d = noise[i:i + 4]
+                lines.append('2026-01-{:02d} {:02d}:{:02d}:{:02d} {} 用户 user{} {} 文件 {}-{}.txt 大小 {} 字节\n'.format(
+                    a % 28 + 1, b % 24, c % 60, d % 60, words[a % 9], b * 7 + c, words[d % 9],
+                    words[c % 9], a * b, int.from_bytes(noise[i + 4:i + 8], 'big') % 10000000))
+            data = ''.join(lines).encode('utf-8')[:size - written]
+            f.write(data)
+            written += len(data)
+    return path
+
+
+def bench_compress(size_mb=16, repeat=3, modes=('thread', 'event')):
+    """
+    协商压缩：文本文件、随机数据（.bin，按首帧压缩比自动放弃）和已压缩类型（.zip，按扩展名跳过）
+    各下载一遍，比较线上字节数、吞吐和服务器 CPU
+    """
+    size = size_mb * 1024 * 1024
+    files = [('text', '.bench-compress.log'), ('random', '.bench-compress.bin'), ('zip', '.bench-compress.zip')]
+    paths = [make_text_file(files[0][1], size), make_file(files[1][1], size), make_file(files[2][1], size)]
+    results = []
+    try:
+        for mode in modes:
+            for compress in (None, ['zlib', 'none']):
+                s = ServerProcess(mode=mode, protocol='framed', chunk_size=256 * 1024)
+                c = Client(s.port, 'framed')
+                c.send_msg(['register', 'zip', 'pw'])
+                c.wait_for(lambda m: m == 'sccess')
+                assert c.login('zip', 'pw', compress)
+                for kind, name in files:
+                    best = 0.0
+                    cpu_start = s.cpu()
+                    wire = 0
+                    for i in range(repeat):
+                        before = c.wire_in
+                        start = time.perf_counter()
+                        got = c.get_range(name, 0, size)
+                        elapsed = time.perf_counter() - start
+                        assert got == size, '下载不完整: {}/{}'.format(got, size)
+                        wire = c.wire_in - before
+                        best = max(best, size / elapsed / 1024 / 1024)
+                    cpu = s.cpu() - cpu_start
+                    label = 'zlib' if c.codec is not None else 'none'
+                    results.append({
+                        "bench": "compress",
+                        "mode": mode,
+                        "codec": label,
+                        "file": kind,
+                        "size_mb": size_mb,
+                        "wire_mb": round(wire / 1024 / 1024, 2),
+                        "ratio": round(wire / size, 3),
+                        "mb_per_s": round(best, 1),
+                        "server_cpu_s": round(cpu / repeat, 3),
+                    })
+                    print("{:<7} {:<5} {:<7} 线上 {:>7.2f} MB ({:>5.1%})  {:>8.1f} MB/s  服务器 CPU {:.3f}s".format(
+                        mode, label, kind, wire / 1024 / 1024, wire / size, best, cpu / repeat))
+                c.close()
+                s.stop()
+    finally:
+        for path in paths:
+            os.remove(path)
+    return results
+
+
+def version():
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, timeout=5,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or 'unknown'
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+
+def result_key(result):
+    return tuple(sorted((k, v) for k, v in result.items() if k not in METRICS))
+
+
+def compare(old_file, results):
+    """和之前保存的结果逐项对比，打印变化百分比"""
+    with open(old_file, 'r', encoding='utf-8') as f:
+        old = json.load(f)
+    previous = {result_key(r): r for r in old["results"]}
+    print("\n与 {} ({}) 对比:".format(old_file, old["meta"]["version"]))
+    for r in results:
+        base = previous.get(result_key(r))
+        if base is None:
+            continue
+        changes = []
+        for metric in METRICS:
+            if metric in r and base.get(metric):
+                changes.append("{} {:+.1f}%".format(metric, (r[metric] - base[metric]) / base[metric] * 100))
+        label = ' '.join(str(v) for k, v in result_key(r) if k not in ('size_mb',))
+        print("  {:<50} {}".format(label, ', '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='server.py 基准测试')
+    parser.add_argument('bench', nargs='*', help='要跑的项目 {}，默认全部'.format('/'.join(BENCHES)))
+    parser.add_argument('--mode', choices=server.Server.MODES, help='只测一种服务器模式')
+    parser.add_argument('--clients', type=int, default=32, help='模拟客户端数')
+    parser.add_argument('--users', type=int, default=100000, help='登录测试前灌入的用户数')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--connections', type=int, default=1000, help='空闲连接测试的连接数')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='多进程测试的 worker 数')
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--label', help='结果里的版本标记，默认取 git describe')
+    parser.add_argument('--output', help='把结果写成 JSON 文件')
+    parser.add_argument('--compare', help='和之前 --output 保存的结果对比')
+    args = parser.parse_args()
+    benches = args.bench or list(BENCHES)
+    for name in benches:
+        if name not in BENCHES:
+            parser.error('未知的测试项目: {}'.format(name))
+    modes = (args.mode,) if args.mode else server.Server.MODES
+
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    if not os.path.exists(server.FILE_DIR):
+        os.makedirs(server.FILE_DIR)
+    results = []
+    try:
+        if 'login' in benches:
+            results += bench_login(args.clients, args.messages // 4 or 1, args.users, modes)
+        if 'chat' in benches:
+            results += bench_chat(args.clients, args.messages, modes=modes)
+        if 'workers' in benches:
+            for mode in modes:
+                results += bench_workers(args.clients, args.messages, workers=args.workers, mode=mode)
+        if 'upload' in benches:
+            results += bench_upload(args.size_mb, args.repeat, modes)
+        if 'dedup' in benches:
+            results += bench_dedup(args.size_mb, modes)
+        if 'download' in benches:
+            results += bench_download(args.size_mb, args.repeat, modes)
+        if 'parallel' in benches:
+            results += bench_parallel(args.size_mb, args.repeat, modes=modes)
+        if 'compress' in benches:
+            results += bench_compress(max(args.size_mb // 4, 1), args.repeat, modes)
+        if 'idle' in benches:
+            results += bench_idle(args.connections, modes=modes)
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+    report = {
+        "meta": {
+            "version": args.label or version(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
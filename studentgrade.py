@@ -1,6 +1,793 @@
+import atexit
+import bisect
+import csv
 import json
+import math
+import multiprocessing
 import os
-from typing import Dict, Any
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Any, Iterator, List, Mapping, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class GradeJournal:
+    """
+    追加写的操作日志：每次改动一行紧凑 JSON，不再整份重写 students.json
+    - 按条数（sync_every）或时间（sync_interval 秒）批量 fsync，崩溃最多丢最后一批
+    - 记录都是幂等的（学生已存在就跳过，成绩按最后一次为准），重放多次结果一样
+    - 压缩时先把当前日志改名成 .old 段并开一个新日志，快照写完再删掉旧段；
+      启动时按 快照 -> .old -> 当前日志 的顺序重放，压缩中途崩溃也不会丢数据
+    """
+
+    def __init__(self, path: str, sync_every: int = 64, sync_interval: float = 1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.pending = 0
+        self.records = 0
+        self.last_sync = time.monotonic()
+        self.f = open(path, "ab")
+
+    @property
+    def old_path(self) -> str:
+        return self.path + ".old"
+
+    def append(self, record: List[Any]) -> None:
+        self.f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+        self.pending += 1
+        self.records += 1
+        if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        """把缓冲的记录写到磁盘并 fsync"""
+        if self.pending:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def rotate(self) -> None:
+        """当前日志改名为 .old 段，之后的记录写进新日志（调用方保证上一段已经处理完）"""
+        self.sync()
+        self.f.close()
+        if os.path.exists(self.old_path):
+            # 上一次压缩失败留下的旧段还没进快照，接在它后面，不能覆盖
+            with open(self.path, "rb") as src, open(self.old_path, "ab") as dst:
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.old_path)
+        self.f = open(self.path, "ab")
+        self.records = 0
+
+    def close(self) -> None:
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+    @staticmethod
+    def replay(path: str) -> Iterator[List[Any]]:
+        """按顺序读出日志里的记录；最后一行没写完（崩溃）就忽略"""
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    break
+
+
+def write_snapshot(filename: str, data: Dict[str, Any], indent: int = None) -> None:
+    """原子地写快照：先写临时文件并 fsync，再改名覆盖，最后 fsync 目录"""
+    tmp = filename + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent,
+                  separators=None if indent else (",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class GradeMatrix:
+    """
+    列式成绩存储：学生 × 学科 的 float64 分数矩阵，加一张“有没有成绩”的掩码
+    - ids/subjects 是行、列对应的学生 ID 和学科，rows/cols 是反查行号、列号的索引表
+    - 容量不够时按两倍扩容，新增学生、学科均摊 O(1)
+    - 平均分、均值/中位数/标准差、百分位、排名都是整行/整列的向量运算
+    """
+
+    def __init__(self, capacity: int = 1024, subjects: int = 8):
+        if np is None:
+            raise RuntimeError("列式存储需要安装 numpy")
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.subjects: List[str] = []
+        self.cols: Dict[str, int] = {}
+        self.scores = np.zeros((max(capacity, 1), max(subjects, 1)))
+        self.mask = np.zeros(self.scores.shape, dtype=bool)
+        self.sums = np.zeros(self.scores.shape[0])
+
+    def row(self, sid: str) -> int:
+        """学生所在的行号，没有就新开一行"""
+        r = self.rows.get(sid)
+        if r is None:
+            r = len(self.ids)
+            if r == self.scores.shape[0]:
+                self.__grow(r * 2, self.scores.shape[1])
+            self.ids.append(sid)
+            self.rows[sid] = r
+        return r
+
+    def col(self, subject: str) -> int:
+        """学科所在的列号，没有就新开一列"""
+        c = self.cols.get(subject)
+        if c is None:
+            c = len(self.subjects)
+            if c == self.scores.shape[1]:
+                self.__grow(self.scores.shape[0], c * 2)
+            self.subjects.append(subject)
+            self.cols[subject] = c
+        return c
+
+    def __grow(self, rows: int, cols: int) -> None:
+        n, m = self.scores.shape
+        scores = np.zeros((rows, cols))
+        mask = np.zeros((rows, cols), dtype=bool)
+        scores[:n, :m] = self.scores
+        mask[:n, :m] = self.mask
+        sums = np.zeros(rows)
+        sums[:n] = self.sums
+        self.scores, self.mask, self.sums = scores, mask, sums
+
+    def __resum(self, r: int) -> None:
+        """一行的总分用 math.fsum 重新加一遍，平均分和字典存储下的 get_average 逐位一致"""
+        m = len(self.subjects)
+        self.sums[r] = math.fsum(self.scores[r, :m][self.mask[r, :m]].tolist())
+
+    def set(self, sid: str, subject: str, score: float) -> None:
+        r, c = self.row(sid), self.col(subject)
+        self.scores[r, c] = score
+        self.mask[r, c] = True
+        self.__resum(r)
+
+    def get(self, sid: str, subject: str) -> float:
+        """没有这门成绩时返回 None；整数分按 int 返回，存盘的 JSON 和字典存储一致"""
+        r, c = self.rows.get(sid), self.cols.get(subject)
+        if r is None or c is None or not self.mask[r, c]:
+            return None
+        score = float(self.scores[r, c])
+        return int(score) if score.is_integer() else score
+
+    def delete(self, sid: str, subject: str) -> bool:
+        r, c = self.rows.get(sid), self.cols.get(subject)
+        if r is None or c is None or not self.mask[r, c]:
+            return False
+        self.mask[r, c] = False
+        self.__resum(r)
+        return True
+
+    def clear(self, sid: str) -> None:
+        """清空一个学生的全部成绩（行保留）"""
+        r = self.rows.get(sid)
+        if r is not None:
+            self.mask[r, :] = False
+            self.sums[r] = 0.0
+
+    def subjects_of(self, sid: str) -> List[str]:
+        r = self.rows.get(sid)
+        if r is None:
+            return []
+        return [self.subjects[c] for c in np.flatnonzero(self.mask[r, :len(self.subjects)])]
+
+    def count(self, sid: str) -> int:
+        r = self.rows.get(sid)
+        return 0 if r is None else int(self.mask[r, :len(self.subjects)].sum())
+
+    def averages(self):
+        """每个学生的平均分，按 ids 的顺序；没有成绩的是 nan"""
+        n, m = len(self.ids), len(self.subjects)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums[:n] / self.mask[:n, :m].sum(axis=1)
+
+    def values(self, subject: str = None):
+        """
+        参与统计的 (行号数组, 分数数组)
+        :param subject: 指定学科时取这一列有成绩的格子，否则取有成绩学生的平均分
+        """
+        if subject is None:
+            averages = self.averages()
+            rows = np.flatnonzero(~np.isnan(averages))
+            return rows, averages[rows]
+        c = self.cols.get(subject)
+        if c is None:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        rows = np.flatnonzero(self.mask[:len(self.ids), c])
+        return rows, self.scores[rows, c]
+
+    def stats(self, subject: str = None) -> Dict[str, float]:
+        """人数、均值、中位数、标准差（总体）、最低分、最高分"""
+        values = self.values(subject)[1]
+        if not values.size:
+            return {"count": 0}
+        return {
+            "count": int(values.size),
+            "mean": float(values.mean()),
+            "median": float(np.median(values)),
+            "std": float(values.std()),
+            "min": float(values.min()),
+            "max": float(values.max()),
+        }
+
+    def percentile(self, q: float, subject: str = None) -> float:
+        """第 q 百分位（线性插值）；没有数据时返回 nan"""
+        values = self.values(subject)[1]
+        return float(np.percentile(values, q)) if values.size else float("nan")
+
+    def ranking(self, subject: str = None, top: int = None) -> List[Tuple[str, float]]:
+        """从高到低的 (学生ID, 分数)；同分按入库先后；top 只取前几名（先 partition 找第 top 名，不做全排序）"""
+        rows, values = self.values(subject)
+        if top is not None:
+            if top <= 0:
+                return []
+            if top < values.size:
+                # 第 top 名的分数；比它高的全要，和它同分的按行号取够 top 个
+                kth = -np.partition(-values, top - 1)[top - 1]
+                above = np.flatnonzero(values > kth)
+                tied = np.flatnonzero(values == kth)[:top - above.size]
+                keep = np.concatenate((above, tied))
+                rows, values = rows[keep], values[keep]
+        order = np.lexsort((rows, -values))
+        return [(self.ids[rows[i]], float(values[i])) for i in order]
+
+
+class GradeRow(MutableMapping):
+    """列式存储下 students[sid]["grades"] 的视图：读写直接落到矩阵上，用法和原来的字典一样"""
+    __slots__ = ("matrix", "sid")
+
+    def __init__(self, matrix: GradeMatrix, sid: str):
+        self.matrix = matrix
+        self.sid = sid
+        matrix.row(sid)
+
+    def __getitem__(self, subject: str) -> float:
+        score = self.matrix.get(self.sid, subject)
+        if score is None:
+            raise KeyError(subject)
+        return score
+
+    def __setitem__(self, subject: str, score: float) -> None:
+        self.matrix.set(self.sid, subject, score)
+
+    def __delitem__(self, subject: str) -> None:
+        if not self.matrix.delete(self.sid, subject):
+            raise KeyError(subject)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.matrix.subjects_of(self.sid))
+
+    def __len__(self) -> int:
+        return self.matrix.count(self.sid)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """和 numpy.percentile 默认一致的线性插值百分位（values 已排好序）"""
+    if not values:
+        return float("nan")
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+_MISSING = object()
+
+
+class SortedIndex:
+    """
+    按 key 排好序的 (key, 学生ID) 列表：二分定位起点，再顺序往后扫
+    - current 记录每个学生当前的 key；覆盖写不去列表里删旧条目，扫描时跳过对不上 current 的
+    - 新条目先攒在 pending 里，下次查询前合并：只有几条时逐条 insort（二分 + 一次 memmove），
+      成批录入攒多了再一次性排序合并（Timsort 合并两段有序数据是线性的），不会每条都挪动整个列表
+    - 过期条目比有效条目还多时按 current 整体重建，摊到每次写上是 O(log n)
+    """
+    INSORT_MAX = 32
+
+    def __init__(self):
+        self.entries: List[Tuple[Any, str]] = []
+        self.pending: List[Tuple[Any, str]] = []
+        self.current: Dict[str, Any] = {}
+        self.stale = 0
+
+    def __len__(self) -> int:
+        return len(self.current)
+
+    def set(self, sid: str, key: Any) -> None:
+        old = self.current.get(sid, _MISSING)
+        if old == key:
+            return
+        if old is not _MISSING:
+            self.stale += 1
+        self.current[sid] = key
+        self.pending.append((key, sid))
+
+    def discard(self, sid: str) -> None:
+        if self.current.pop(sid, _MISSING) is not _MISSING:
+            self.stale += 1
+
+    def __flush(self) -> None:
+        if self.stale > len(self.current):
+            self.entries = sorted((key, sid) for sid, key in self.current.items())
+            self.pending = []
+            self.stale = 0
+        elif len(self.pending) <= self.INSORT_MAX:
+            for entry in self.pending:
+                bisect.insort(self.entries, entry)
+            self.pending = []
+        else:
+            self.entries.extend(self.pending)
+            self.entries.sort()
+            self.pending = []
+
+    def scan(self, start: Any = _MISSING) -> Iterator[Tuple[Any, str]]:
+        """从第一个 key >= start 的条目开始，按 key 升序逐个给出有效的 (key, 学生ID)"""
+        self.__flush()
+        entries, current = self.entries, self.current
+        i = 0 if start is _MISSING else bisect.bisect_left(entries, (start,))
+        last = None
+        for j in range(i, len(entries)):
+            entry = entries[j]
+            # 同一个学生改回过原来的分数时会有两条一样的条目，排序后相邻，只给一次
+            if entry != last and current.get(entry[1], _MISSING) == entry[0]:
+                last = entry
+                yield entry
+
+
+class StoredGrades(MutableMapping):
+    """SQLite 存储下 students[sid]["grades"] 的样子：读本地副本，写同时落到数据库（跟着事务批量提交）"""
+    __slots__ = ("store", "sid", "data")
+
+    def __init__(self, store: "SqliteStudents", sid: str, data: Dict[str, float]):
+        self.store = store
+        self.sid = sid
+        self.data = data
+
+    def __getitem__(self, subject: str) -> float:
+        return self.data[subject]
+
+    def __setitem__(self, subject: str, score: float) -> None:
+        self.store.write("insert into grades (student_id, subject, score) values (?, ?, ?) "
+                         "on conflict (student_id, subject) do update set score = excluded.score",
+                         (self.sid, subject, score))
+        self.data[subject] = score
+
+    def __delitem__(self, subject: str) -> None:
+        del self.data[subject]
+        self.store.write("delete from grades where student_id = ? and subject = ?", (self.sid, subject))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return repr(self.data)
+
+
+class SqliteStudents(MutableMapping):
+    """
+    students 的 SQLite 实现，用法和 {学生ID: {"name", "grades", "modified"}} 字典一样，
+    但数据留在磁盘上，打开时什么都不读
+    - 按需读取单个学生，放进有界 LRU 缓存，超过 cache_size 个就淘汰最久没用的
+    - 写操作攒进同一个事务，每 batch_size 条提交一次；flush() 立即提交
+    - 遍历按页读，不进缓存；姓名前缀、单科分数段、单科前几名直接走表上的索引
+    """
+    SCHEMA = (
+        "create table if not exists students (id text primary key, name text not null)",
+        "create table if not exists grades (student_id text not null, subject text not null, "
+        "score numeric not null, primary key (student_id, subject)) without rowid",
+        "create index if not exists students_name on students (name, id)",
+        "create index if not exists grades_subject on grades (subject, score desc, student_id)",
+    )
+    PAGE_SIZE = 1000
+
+    def __init__(self, path: str, cache_size: int = 10000, batch_size: int = 1000):
+        self.path = path
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.pending = 0
+        self.cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("pragma journal_mode = wal")
+        self.conn.execute("pragma synchronous = normal")
+        for sql in self.SCHEMA:
+            self.conn.execute(sql)
+
+    def write(self, sql: str, params=()) -> None:
+        """执行一条写语句，攒够 batch_size 条提交一次"""
+        with self._lock:
+            if not self.pending:
+                self.conn.execute("begin")
+            self.conn.execute(sql, params)
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self.pending:
+                self.conn.execute("commit")
+                self.pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            if self.conn is not None:
+                self.flush()
+                self.conn.close()
+                self.conn = None
+
+    def __remember(self, sid: str, info: Dict[str, Any]) -> None:
+        self.cache[sid] = info
+        self.cache.move_to_end(sid)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def __getitem__(self, sid: str) -> Dict[str, Any]:
+        with self._lock:
+            info = self.cache.get(sid)
+            if info is not None:
+                self.cache.move_to_end(sid)
+                return info
+            row = self.conn.execute("select name from students where id = ?", (sid,)).fetchone()
+            if row is None:
+                raise KeyError(sid)
+            grades = dict(self.conn.execute(
+                "select subject, score from grades where student_id = ?", (sid,)))
+            info = {"name": row[0], "grades": StoredGrades(self, sid, grades), "modified": False}
+            self.__remember(sid, info)
+            return info
+
+    def __contains__(self, sid: object) -> bool:
+        with self._lock:
+            if sid in self.cache:
+                return True
+            return self.conn.execute("select 1 from students where id = ?", (sid,)).fetchone() is not None
+
+    def __setitem__(self, sid: str, info: Dict[str, Any]) -> None:
+        """整条写入（新建或替换），原有成绩先删掉"""
+        grades = dict(info["grades"])
+        with self._lock:
+            self.write("insert into students (id, name) values (?, ?) "
+                       "on conflict (id) do update set name = excluded.name", (sid, info["name"]))
+            self.write("delete from grades where student_id = ?", (sid,))
+            for subject, score in grades.items():
+                self.write("insert into grades (student_id, subject, score) values (?, ?, ?)",
+                           (sid, subject, score))
+            self.__remember(sid, {"name": info["name"], "grades": StoredGrades(self, sid, grades),
+                                  "modified": info.get("modified", False)})
+
+    def __delitem__(self, sid: str) -> None:
+        with self._lock:
+            if sid not in self:
+                raise KeyError(sid)
+            self.write("delete from grades where student_id = ?", (sid,))
+            self.write("delete from students where id = ?", (sid,))
+            self.cache.pop(sid, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("select count(*) from students").fetchone()[0]
+
+    def __iter__(self) -> Iterator[str]:
+        for page in self.__pages():
+            for sid, name in page:
+                yield sid
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """按录入顺序逐页读出所有学生；缓存里有的用缓存（可能有没提交的改动），其余不进缓存"""
+        for page in self.__pages():
+            with self._lock:
+                missing = [sid for sid, name in page if sid not in self.cache]
+                grades: Dict[str, Dict[str, float]] = {sid: {} for sid in missing}
+                if missing:
+                    marks = ",".join("?" * len(missing))
+                    for sid, subject, score in self.conn.execute(
+                            f"select student_id, subject, score from grades where student_id in ({marks})",
+                            missing):
+                        grades[sid][subject] = score
+                infos = [(sid, self.cache.get(sid) or
+                          {"name": name, "grades": StoredGrades(self, sid, grades[sid]), "modified": False})
+                         for sid, name in page]
+            yield from infos
+
+    def __pages(self) -> Iterator[List[Tuple[str, str]]]:
+        # 按 rowid 翻页，每页单独查询，遍历过程中不长期占着锁和游标
+        last = 0
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "select rowid, id, name from students where rowid > ? order by rowid limit ?",
+                    (last, self.PAGE_SIZE)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [(sid, name) for rowid, sid, name in rows]
+
+    def find_by_name(self, prefix: str, limit: int = None) -> List[Tuple[str, str]]:
+        sql, params = "select id, name from students", []
+        if prefix:
+            sql += " where name >= ? and name < ?"
+            params += [prefix, prefix + chr(0x10FFFF)]
+        sql += " order by name, id"
+        if limit is not None:
+            sql += " limit ?"
+            params.append(max(limit, 0))
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def aggregates(self) -> "GradeAggregates":
+        """
+        顺着主键把成绩表扫一遍建出成绩汇总（不走缓存）
+        不用 SQL 的 sum：它的浮点累加有误差，和内存模式算出的平均分会差最后一位
+        """
+        aggregates = GradeAggregates()
+        with self._lock:
+            rows = self.conn.execute("select student_id, subject, score from grades order by student_id")
+            for sid, group in groupby(rows, key=itemgetter(0)):
+                aggregates.add(sid, {subject: score for _, subject, score in group})
+        return aggregates
+
+    def grade_range(self, subject: str, low: float, high: float, limit: int = None) -> List[Tuple[str, float]]:
+        sql = ("select student_id, score from grades where subject = ? and score between ? and ? "
+               "order by score desc, student_id limit ?")
+        with self._lock:
+            return self.conn.execute(sql, (subject, low, high, -1 if limit is None else limit)).fetchall()
+
+
+_SCALE = 2 ** 1074  # float 能表示的最小正数是 2**-1074，任何分数乘上它都是整数
+
+
+def _exact(score: float) -> int:
+    """分数按 _SCALE 放大成整数，加减都没有舍入误差"""
+    numerator, denominator = score.as_integer_ratio()
+    return numerator * (_SCALE // denominator)
+
+
+class GradeAggregates:
+    """
+    增量维护的成绩汇总：每个学生、每门学科、全班各一个 [总分, 成绩条数]
+    - 学生只有几门课，每次改动都用 math.fsum 把他的成绩单重新加一遍，
+      平均分和 fsum(grades.values()) / len(grades) 逐位一致，同分的学生永远同分
+    - 学科和全班的总分是 _exact 放大后的整数，覆盖旧成绩时减掉旧分也是精确的，改多少次都不会漂
+    平均分随取随算，O(1)
+    """
+
+    def __init__(self):
+        self.students: Dict[str, List[float]] = {}
+        self.subjects: Dict[str, List[int]] = {}
+        self.total = [0, 0]
+
+    def set(self, sid: str, subject: str, old: Optional[float], new: float, grades: Mapping[str, float]) -> None:
+        """一门成绩从 old（None 表示原来没有）变成 new；grades 是这个学生改完以后的成绩单"""
+        self.students[sid] = [math.fsum(grades.values()), len(grades)]
+        delta = _exact(new) - (0 if old is None else _exact(old))
+        for acc in (self.subjects.setdefault(subject, [0, 0]), self.total):
+            acc[0] += delta
+            if old is None:
+                acc[1] += 1
+
+    def add(self, sid: str, grades: Mapping[str, float]) -> None:
+        if grades:
+            self.students[sid] = [math.fsum(grades.values()), len(grades)]
+        for subject, score in grades.items():
+            exact = _exact(score)
+            for acc in (self.subjects.setdefault(subject, [0, 0]), self.total):
+                acc[0] += exact
+                acc[1] += 1
+
+    def remove(self, sid: str, grades: Mapping[str, float]) -> None:
+        """学生整条记录被替换前先把它原来的成绩减掉"""
+        self.students.pop(sid, None)
+        for subject, score in grades.items():
+            exact = _exact(score)
+            for acc in (self.subjects[subject], self.total):
+                acc[0] -= exact
+                acc[1] -= 1
+
+    def student_average(self, sid: str) -> Optional[float]:
+        acc = self.students.get(sid)
+        return acc[0] / acc[1] if acc and acc[1] else None
+
+    @staticmethod
+    def mean(acc: List[int]) -> Optional[float]:
+        """放大后的总分除回去（整数除法是正确舍入的，等于 fsum）再除以条数"""
+        return acc[0] / _SCALE / acc[1] if acc and acc[1] else None
+
+    def subject_average(self, subject: str) -> Optional[float]:
+        return self.mean(self.subjects.get(subject))
+
+    def class_average(self) -> Optional[float]:
+        return self.mean(self.total)
+
+
+def render_report(sid: str, name: str, grades: Mapping[str, float], average: float,
+                  rank: Optional[int] = None, total: int = 0, fmt: str = "text") -> str:
+    """
+    一个学生的成绩单：text 是 show_student 打印的格式，json 是一行 JSON
+    :param rank: 班级排名，0 表示没有成绩不参与排名；None 时不输出排名（show_student）
+    """
+    if fmt == "json":
+        return json.dumps({"student_id": sid, "name": name, "grades": dict(grades), "average": average,
+                           "rank": rank or None, "total": total}, ensure_ascii=False) + "\n"
+    lines = [f"\n🔍 学生ID: {sid}", f"├── 姓名: {name}", "├── 成绩单："]
+    lines += [f"│   ├── {subject}: {score}" for subject, score in grades.items()]
+    if rank is None:
+        lines.append(f"└── 平均分: {average:.1f}\n")
+    else:
+        lines.append(f"├── 平均分: {average:.1f}")
+        lines.append(f"└── 班级排名: {f'{rank}/{total}' if rank else '-'}\n")
+    return "\n".join(lines) + "\n"
+
+
+def _render_chunk(records: List[Tuple], total: int, fmt: str, directory: str = None) -> Tuple[int, str]:
+    """
+    工作进程里渲染一批成绩单
+    :param directory: 指定时每个学生单独写一个文件，返回空字符串；否则返回拼好的整批文本
+    """
+    if directory is None:
+        return len(records), "".join(render_report(*record, total, fmt) for record in records)
+    suffix = ".json" if fmt == "json" else ".txt"
+    for record in records:
+        with open(os.path.join(directory, record[0] + suffix), "w", encoding="utf-8") as f:
+            f.write(render_report(*record, total, fmt))
+    return len(records), ""
+
+
+# fork 出来的导出进程从这里拿主进程的学生数据和排名，只按下标分批，不用把每批成绩序列化过去
+_EXPORT: Dict[str, Any] = {}
+
+
+def _report_record(sid: str, info: Mapping[str, Any], aggregates: Optional[GradeAggregates],
+                   rank: int) -> Tuple:
+    """render_report 需要的 (学生ID, 姓名, 成绩, 平均分, 名次)"""
+    grades = dict(info["grades"])
+    if not grades:
+        average = 0.0
+    elif aggregates is not None:
+        average = aggregates.student_average(sid)
+    else:
+        average = math.fsum(grades.values()) / len(grades)
+    return sid, info["name"], grades, average, rank
+
+
+def _render_slice(start: int, stop: int, total: int, fmt: str, directory: str = None) -> Tuple[int, str]:
+    """fork 出的工作进程里渲染第 start 到 stop 个学生（数据继承自主进程的 _EXPORT）"""
+    students, aggregates, ranks = _EXPORT["students"], _EXPORT["aggregates"], _EXPORT["ranks"]
+    records = [_report_record(sid, students[sid], aggregates, ranks.get(sid, 0))
+               for sid in _EXPORT["sids"][start:stop]]
+    return _render_chunk(records, total, fmt, directory)
+
+
+class ImportReport:
+    """批量导入的结果：行数、新增学生/成绩数、出错的行，以及耗时和峰值内存"""
+    MAX_ERRORS = 1000
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rows = 0
+        self.students = 0
+        self.grades = 0
+        self.failed = 0
+        self.errors: List[Tuple[int, str]] = []
+        self.seconds = 0.0
+        self.peak_memory = None
+        self.memory_source = None
+
+    def error(self, line: int, message: str) -> None:
+        """记一行错误；只保留前 MAX_ERRORS 条明细，failed 照常计数"""
+        self.failed += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append((line, message))
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        lines = [f"📥 {self.path}: {self.rows} 行，新增学生 {self.students}，录入成绩 {self.grades}，"
+                 f"出错 {self.failed} 行",
+                 f"⏱️ {self.seconds:.2f}s，{self.rows_per_sec:.0f} 行/秒"]
+        if self.peak_memory is not None:
+            lines[-1] += f"，峰值内存 {self.peak_memory / 2 ** 20:.1f}MB（{self.memory_source}）"
+        lines += [f"   第 {line} 行：{message}" for line, message in self.errors[:20]]
+        if self.failed > 20:
+            lines.append(f"   …… 其余 {self.failed - 20} 行错误见 report.errors")
+        return "\n".join(lines)
+
+
+IMPORT_FIELDS = ("student_id", "name", "subject", "score")
+
+
+def _read_rows(path: str, fmt: str) -> Iterator[Tuple[int, Any]]:
+    """
+    逐行读出 (行号, 记录)；记录是 {字段: 值}，这一行本身读不出来时是错误信息字符串
+    csv 要有表头；jsonl 每行一个对象。字段见 IMPORT_FIELDS，name/subject/score 可以为空
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            if "student_id" not in (reader.fieldnames or ()):
+                yield 1, "表头缺少 student_id 字段"
+                return
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line, text in enumerate(f, 1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError:
+                yield line, "不是合法的 JSON"
+                continue
+            yield line, row if isinstance(row, dict) else "每行必须是一个 JSON 对象"
+
+
+def _parse_score(value: Any) -> float:
+    """分数转成数字，保留整数；不是数字时返回 nan（JSON 的 true/false 也算不是数字，不能当成 1/0）"""
+    if isinstance(value, bool):
+        return float("nan")
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def _scores_in_range(scores: List[float]) -> List[bool]:
+    """一批分数一次判断是否在 0-100 之间（nan 不合法）；有 numpy 时走向量比较"""
+    if np is not None:
+        values = np.asarray(scores, dtype=float)
+        return ((values >= 0) & (values <= 100)).tolist()
+    return [0 <= score <= 100 for score in scores]
+
 
 class StudentGradeManager:
     """
@@ -8,21 +795,205 @@ class StudentGradeManager:
     使用示例：
     >>> manager = StudentGradeManager()
     >>> manager.add_student("001", "张三")
+    >>> manager.enable_journal()  # 可选：之后的改动只追加到 students.json.journal
+    >>> manager.enable_numpy()    # 可选：成绩改用 NumPy 列式存储，班级统计走向量运算
+    >>> manager.grade_range("数学", 0, 59.9)  # 按学科/分数段、姓名前缀查询走二级索引
+    >>> print(manager.import_file("期末成绩.csv"))  # 批量导入，错误汇总在报告里
+    >>> manager.use_sqlite()      # 可选：数据搬进 students.db，之后启动不再整份读入内存
     """
     _instance = None
     DEFAULT_FILE = "students.json"
+    DEFAULT_DB = "students.db"
+    JOURNAL_SUFFIX = ".journal"
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance.students: Dict[str, Dict[str, Any]] = {}
+            cls._instance._lock = threading.RLock()
+            cls._instance._journal = None
+            cls._instance._snapshot_file = cls.DEFAULT_FILE
+            cls._instance._compact_after = 0
+            cls._instance._compactor = None
+            cls._instance._journal_hooked = False
+            cls._instance._matrix = None
+            cls._instance._by_name = SortedIndex()
+            cls._instance._by_subject: Dict[str, SortedIndex] = {}
+            cls._instance._store = None
+            cls._instance._aggregates = GradeAggregates()
+            cls._instance._ranks = None
+            cls._instance._distributions: Dict[int, Dict[str, int]] = {}
             cls._instance.__load_initial_data()
         return cls._instance
 
     def __load_initial_data(self):
-        """初始化时尝试自动加载数据"""
+        """
+        初始化时尝试自动加载数据；上次用日志模式留下的日志也一并重放
+        已经有 students.db 时直接打开数据库，什么都不预先读
+        """
+        if os.path.exists(self.DEFAULT_DB):
+            self.use_sqlite()
+            return
         if os.path.exists(self.DEFAULT_FILE):
             self.load_from_file()
+        self.__replay_journal(self.DEFAULT_FILE)
+
+    def enable_journal(self, filename: str = DEFAULT_FILE, sync_every: int = 64,
+                       sync_interval: float = 1.0, compact_after: int = 100000) -> None:
+        """
+        开启日志模式：之后每次 add_student/add_grade 只往 filename.journal 追加一条记录
+        :param filename: 快照文件，日志文件名是它加上 .journal
+        :param sync_every: 攒够多少条记录 fsync 一次
+        :param sync_interval: 距上次 fsync 超过多少秒时，下一条记录立即 fsync
+        :param compact_after: 日志超过多少条记录时在后台压缩成新快照（0 表示只手动 compact）
+        """
+        if self._store is not None:
+            print("❌ 使用 SQLite 存储时不需要日志模式")
+            return
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+            if filename != self.DEFAULT_FILE:
+                if os.path.exists(filename):
+                    self.load_from_file(filename)
+                self.__replay_journal(filename)
+            self._snapshot_file = filename
+            self._compact_after = compact_after
+            self._journal = GradeJournal(filename + self.JOURNAL_SUFFIX, sync_every, sync_interval)
+            if not self._journal_hooked:
+                atexit.register(self.close_journal)
+                self._journal_hooked = True
+
+    def compact(self, wait: bool = True) -> None:
+        """
+        把内存里的当前数据写成新快照，然后丢掉已经包含在快照里的日志
+        :param wait: False 时在后台线程里写快照，不阻塞调用方
+        """
+        with self._lock:
+            if self._journal is None:
+                return
+            if self._compactor is not None and self._compactor.is_alive():
+                if not wait:
+                    return
+                self._compactor.join()
+            # 换日志和复制数据在同一把锁里，快照正好包含 .old 段及之前的所有记录
+            self._journal.rotate()
+            data = {sid: {**info, "grades": dict(info["grades"]), "modified": False}
+                    for sid, info in self.students.items()}
+            self._compactor = threading.Thread(target=self.__write_compacted, args=(data,), daemon=True)
+            self._compactor.start()
+        if wait:
+            self._compactor.join()
+
+    def __write_compacted(self, data: Dict[str, Any]) -> None:
+        try:
+            write_snapshot(self._snapshot_file, data)
+            os.remove(self._journal.old_path)
+        except OSError as e:
+            print(f"❌ 压缩失败：{str(e)}")
+
+    def close_journal(self) -> None:
+        """写完没 fsync 的记录并等后台压缩结束（退出时自动调用）"""
+        with self._lock:
+            compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def use_sqlite(self, path: str = DEFAULT_DB, cache_size: int = 10000, batch_size: int = 1000) -> None:
+        """
+        改用 SQLite 存储（SqliteStudents）：学生按需从数据库读取，内存里只留 LRU 缓存
+        内存里已有的数据（包括从 JSON、日志加载的）会先整体写进数据库；
+        students.db 存在时下次启动直接打开它，不再读 students.json
+        :param cache_size: 最多缓存多少个学生
+        :param batch_size: 每攒多少条写操作提交一次事务（崩溃时最多丢这么多条）
+        """
+        with self._lock:
+            if self._store is not None:
+                return
+            self.close_journal()
+            store = SqliteStudents(path, cache_size, batch_size)
+            if self.students:
+                for sid, info in self.students.items():
+                    store[sid] = info
+                store.flush()
+                print(f"💾 已把 {len(self.students)} 个学生写入 {path}")
+            self.students = self._store = store
+            # 查询改走数据库，内存里的索引和列式存储都不再需要；
+            # 汇总第一次用到时再用 SQL 建（__totals），之后和内存模式一样增量维护
+            self._matrix = None
+            self._by_name = SortedIndex()
+            self._by_subject = {}
+            self._aggregates = None
+            self.__invalidate()
+        atexit.register(store.close)
+
+    def enable_numpy(self, capacity: int = 1024) -> bool:
+        """
+        成绩改用 NumPy 列式存储（GradeMatrix），已有数据整体搬进矩阵
+        之后 students[sid]["grades"] 是矩阵上的视图，add_grade/get_average 等接口照常可用
+        :param capacity: 预留的学生行数，不够时自动翻倍
+        :return: 没装 numpy 时返回 False，继续用字典存储
+        """
+        if np is None:
+            print("❌ 未安装 numpy，继续使用字典存储")
+            return False
+        if self._store is not None:
+            print("❌ 使用 SQLite 存储时不能再把成绩整体搬进内存")
+            return False
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = GradeMatrix(max(capacity, len(self.students)))
+                for sid in self.students:
+                    self.__attach(sid)
+        return True
+
+    def __attach(self, sid: str) -> None:
+        """列式存储下把学生的成绩字典换成矩阵视图（重新加载的学生先清掉旧成绩）"""
+        info = self.students[sid]
+        if self._matrix is None or isinstance(info["grades"], GradeRow):
+            return
+        self._matrix.clear(sid)
+        row = GradeRow(self._matrix, sid)
+        row.update(info["grades"])
+        info["grades"] = row
+
+    def __replay_journal(self, filename: str) -> None:
+        journal = filename + self.JOURNAL_SUFFIX
+        count = 0
+        for path in (journal + ".old", journal):
+            for record in GradeJournal.replay(path):
+                self.__apply(record)
+                count += 1
+        if count:
+            print(f"🔃 已从 {journal} 重放 {count} 条记录")
+
+    def __drop_journal(self, filename: str) -> None:
+        journal = filename + self.JOURNAL_SUFFIX
+        for path in (journal + ".old", journal):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __apply(self, record: List[Any]) -> None:
+        """重放一条日志记录（不校验、不打印）"""
+        if record[0] == "s":
+            if record[1] not in self.students:
+                self.__insert_student(record[1], record[2])
+        elif record[0] == "g" and record[1] in self.students:
+            self.__set_grade(record[1], record[2], record[3])
+
+    def __log(self, record: List[Any]) -> None:
+        if self._journal is None:
+            return
+        with self._lock:
+            self._journal.append(record)
+            if self._compact_after and self._journal.records >= self._compact_after:
+                self.compact(wait=False)
 
     def add_student(self, student_id: str, name: str) -> None:
         """
@@ -38,11 +1009,8 @@ class StudentGradeManager:
         if student_id in self.students:
             print(f"⚠️ 学生ID {student_id} 已存在！")
         else:
-            self.students[student_id] = {
-                "name": name.strip(),
-                "grades": {},
-                "modified": False
-            }
+            self.__insert_student(student_id, name.strip())
+            self.__log(["s", student_id, name.strip()])
             print(f"✅ 学生 {name} (ID: {student_id}) 添加成功！")
 
     def add_grade(self, student_id: str, subject: str, score: float) -> None:
@@ -59,10 +1027,102 @@ class StudentGradeManager:
         if not self.__validate_score(score):
             return
 
-        self.students[student_id]["grades"][subject.strip()] = score
-        self.students[student_id]["modified"] = True
+        self.__set_grade(student_id, subject.strip(), score)
+        self.__log(["g", student_id, subject.strip(), score])
         print(f"✅ {self.__get_student_name(student_id)} 的 {subject} 成绩录入成功！")
 
+    def __insert_student(self, sid: str, name: str) -> None:
+        self.students[sid] = {
+            "name": name,
+            "grades": {},
+            "modified": False
+        }
+        self.__attach(sid)
+        if self._store is None:
+            self._by_name.set(sid, name)
+        self.__invalidate()
+
+    def __set_grade(self, sid: str, subject: str, score: float) -> None:
+        info = self.students[sid]
+        old = info["grades"].get(subject)
+        info["grades"][subject] = score
+        info["modified"] = True
+        if self._store is None:
+            self.__subject_index(subject).set(sid, -score)
+        if self._aggregates is not None:
+            self._aggregates.set(sid, subject, old, score, info["grades"])
+        self.__invalidate()
+
+    def __invalidate(self) -> None:
+        """数据有改动，缓存的排名和分数段分布作废"""
+        self._ranks = None
+        self._distributions = {}
+
+    def __subject_index(self, subject: str) -> SortedIndex:
+        # 学科索引的 key 存负分，升序扫描就是分数从高到低
+        index = self._by_subject.get(subject)
+        if index is None:
+            index = self._by_subject[subject] = SortedIndex()
+        return index
+
+    def __reindex(self, sid: str) -> None:
+        """学生整条记录被替换（从文件加载）后重建它在各个索引和汇总里的条目"""
+        info = self.students[sid]
+        if self._aggregates is not None:
+            self._aggregates.add(sid, info["grades"])
+        if self._store is not None:
+            return
+        self._by_name.set(sid, info["name"])
+        for subject, index in self._by_subject.items():
+            if subject not in info["grades"]:
+                index.discard(sid)
+        for subject, score in info["grades"].items():
+            self.__subject_index(subject).set(sid, -score)
+
+    def find_by_name(self, prefix: str, limit: int = None) -> List[Tuple[str, str]]:
+        """
+        按姓名前缀查找（传完整姓名就是精确查找）
+        :param limit: 最多返回几条
+        :return: 按姓名排序的 [(学生ID, 姓名), ...]
+        """
+        if self._store is not None:
+            return self._store.find_by_name(prefix, limit)
+        found = []
+        for name, sid in self._by_name.scan(prefix):
+            if not name.startswith(prefix) or (limit is not None and len(found) >= limit):
+                break
+            found.append((sid, name))
+        return found
+
+    def grade_range(self, subject: str, low: float = 0, high: float = 100) -> List[Tuple[str, float]]:
+        """
+        某科分数在 [low, high] 之间的学生
+        :return: 分数从高到低、同分按学生ID排序的 [(学生ID, 分数), ...]
+        """
+        if self._store is not None:
+            return self._store.grade_range(subject, low, high)
+        found = []
+        index = self._by_subject.get(subject)
+        if index is not None:
+            for key, sid in index.scan(-high):
+                if key > -low:
+                    break
+                found.append((sid, -key))
+        return found
+
+    def top_grades(self, subject: str, k: int = 10) -> List[Tuple[str, float]]:
+        """某科前 k 名，分数从高到低、同分按学生ID排序"""
+        if self._store is not None:
+            return self._store.grade_range(subject, float("-inf"), float("inf"), max(k, 0))
+        found = []
+        index = self._by_subject.get(subject)
+        if index is not None and k > 0:
+            for key, sid in index.scan():
+                found.append((sid, -key))
+                if len(found) >= k:
+                    break
+        return found
+
     def get_average(self, student_id: str, subject: str = None) -> float:
         """
         计算平均分
@@ -80,7 +1140,115 @@ class StudentGradeManager:
         if not grades:
             print(f"⚠️ {self.__get_student_name(student_id)} 尚无成绩！")
             return 0.0
-        return sum(grades.values()) / len(grades)
+        if self._aggregates is not None:
+            return self._aggregates.student_average(student_id)
+        return math.fsum(grades.values()) / len(grades)
+
+    def __totals(self) -> GradeAggregates:
+        """成绩汇总；SQLite 存储下第一次用到时才从数据库建"""
+        with self._lock:
+            if self._aggregates is None:
+                self._aggregates = self._store.aggregates()
+            return self._aggregates
+
+    def subject_average(self, subject: str) -> float:
+        """某科全班平均分（没有成绩时返回 0.0）"""
+        return self.__totals().subject_average(subject) or 0.0
+
+    def class_average(self) -> float:
+        """全班所有成绩的平均分（没有成绩时返回 0.0）"""
+        return self.__totals().class_average() or 0.0
+
+    def class_averages(self) -> Dict[str, float]:
+        """所有有成绩学生的平均分 {学生ID: 平均分}"""
+        if self._matrix is not None:
+            matrix = self._matrix
+            rows, values = matrix.values()
+            return {matrix.ids[r]: v for r, v in zip(rows.tolist(), values.tolist())}
+        averages = self.__totals().students
+        if self._store is not None:
+            # 不为了保持录入顺序去把每个学生读一遍
+            return {sid: acc[0] / acc[1] for sid, acc in averages.items() if acc[1]}
+        return {sid: averages[sid][0] / averages[sid][1] for sid in self.students if sid in averages}
+
+    def class_rank(self, student_id: str) -> Tuple[int, int]:
+        """
+        按平均分的班级排名（同分同名次）
+        :return: (名次, 有成绩的人数)；学生没有成绩时名次是 0
+        """
+        ranks = self.__ranks()
+        return ranks.get(student_id, 0), len(ranks)
+
+    def __ranks(self) -> Dict[str, int]:
+        if self._ranks is None:
+            ordered = sorted(self.class_averages().items(), key=lambda item: -item[1])
+            ranks, last = {}, None
+            for i, (sid, average) in enumerate(ordered, 1):
+                if average != last:
+                    rank, last = i, average
+                ranks[sid] = rank
+            self._ranks = ranks
+        return self._ranks
+
+    def distribution(self, width: int = 10) -> Dict[str, int]:
+        """
+        学生平均分的分数段分布，结果缓存到下次数据改动
+        :param width: 每段的宽度，最后一段包含 100 分
+        :return: {"0-9": 人数, ..., "90-100": 人数}
+        """
+        cached = self._distributions.get(width)
+        if cached is not None:
+            return cached
+        bands = list(range(0, 100, width))
+        labels = [f"{low}-{low + width - 1}" for low in bands]
+        labels[-1] = f"{bands[-1]}-100"
+        counts = [0] * len(bands)
+        for average in self.class_averages().values():
+            counts[min(int(average // width), len(bands) - 1)] += 1
+        self._distributions[width] = result = dict(zip(labels, counts))
+        return result
+
+    def __scores(self, subject: str = None) -> Dict[str, float]:
+        if subject is None:
+            return self.class_averages()
+        return {sid: info["grades"][subject]
+                for sid, info in self.students.items() if subject in info["grades"]}
+
+    def subject_stats(self, subject: str = None) -> Dict[str, float]:
+        """
+        单科（或不指定学科时按学生平均分）的统计
+        :return: {"count", "mean", "median", "std", "min", "max"}，std 是总体标准差；没有数据时只有 count
+        """
+        if self._matrix is not None:
+            return self._matrix.stats(subject)
+        values = list(self.__scores(subject).values())
+        if not values:
+            return {"count": 0}
+        return {
+            "count": len(values),
+            "mean": statistics.fmean(values),
+            "median": float(statistics.median(values)),
+            "std": statistics.pstdev(values),
+            "min": float(min(values)),
+            "max": float(max(values)),
+        }
+
+    def percentile(self, q: float, subject: str = None) -> float:
+        """单科（或平均分）的第 q 百分位，0-100，线性插值"""
+        if self._matrix is not None:
+            return self._matrix.percentile(q, subject)
+        return float(_percentile(sorted(self.__scores(subject).values()), q))
+
+    def ranking(self, subject: str = None, top: int = None) -> List[Tuple[str, float]]:
+        """
+        按单科（或平均分）从高到低排名，同分按录入先后（只要单科前几名时 top_grades 更快）
+        :param top: 只要前几名
+        :return: [(学生ID, 分数), ...]
+        """
+        if self._matrix is not None:
+            return self._matrix.ranking(subject, top)
+        ranked = sorted(self.__scores(subject).items(), key=lambda item: -item[1])
+        return ranked if top is None else ranked[:max(top, 0)]
 
     def show_student(self, student_id: str) -> None:
         """显示学生详细信息"""
@@ -88,20 +1256,110 @@ class StudentGradeManager:
             return
 
         student = self.students[student_id]
-        print(f"\n🔍 学生ID: {student_id}")
-        print(f"├── 姓名: {student['name']}")
-        print("├── 成绩单：")
-        for subject, score in student["grades"].items():
-            print(f"│   ├── {subject}: {score}")
-        print(f"└── 平均分: {self.get_average(student_id):.1f}\n")
+        average = self.get_average(student_id)
+        # 排名要看全班，不在这里算（show_student 保持 O(1)），需要时调 class_rank
+        print(render_report(student_id, student["name"], student["grades"], average), end="")
+
+    def export_reports(self, out: Any = sys.stdout, fmt: str = "text", workers: int = None,
+                       chunk_size: int = 1000, progress: bool = True) -> int:
+        """
+        批量生成所有学生的成绩单（格式同 show_student，或每行一个 JSON）
+        学生按 chunk_size 分批交给进程池渲染，主进程按原顺序整批写出；
+        同时在途的批次有上限，学生再多内存也不会涨。
+        能 fork 时工作进程直接继承学生数据，主进程只发下标；不能 fork（或 SQLite 存储，连接不能跨进程）
+        时才把每批成绩序列化过去，这时主进程的开销大头在序列化上，多进程提速有限
+        :param out: 可写的文本流，或文件路径（全部写进这个文件），或已存在的目录（每个学生一个文件）
+        :param fmt: "text" 或 "json"
+        :param workers: 进程数，默认 CPU 核数；1 表示在当前进程里渲染
+        :param progress: 在 stderr 上显示进度
+        :return: 生成的成绩单份数
+        """
+        workers = workers or os.cpu_count() or 1
+        directory = out if isinstance(out, str) and os.path.isdir(out) else None
+        own = isinstance(out, str) and directory is None
+        stream = open(out, "w", encoding="utf-8", buffering=1 << 20) if own else out
+        ranks = self.__ranks()
+        expected = len(self.students)
+        start = last_progress = time.perf_counter()
+        done = 0
+        fork = workers > 1 and self._store is None and "fork" in multiprocessing.get_all_start_methods()
+        if fork:
+            sids = list(self.students)
+            _EXPORT.update(students=self.students, sids=sids, aggregates=self._aggregates, ranks=ranks)
+            pool = multiprocessing.get_context("fork").Pool(workers)
+            tasks = ((_render_slice, (i, i + chunk_size, len(ranks), fmt, directory))
+                     for i in range(0, len(sids), chunk_size))
+        else:
+            pool = multiprocessing.Pool(workers) if workers > 1 else None
+            tasks = ((_render_chunk, (chunk, len(ranks), fmt, directory))
+                     for chunk in self.__report_chunks(ranks, chunk_size))
+        try:
+            in_flight = deque()
+
+            def collect(result) -> None:
+                nonlocal done, last_progress
+                count, text = result
+                if text:
+                    stream.write(text)
+                done += count
+                if progress and time.perf_counter() - last_progress >= 0.2:
+                    last_progress = time.perf_counter()
+                    print(f"\r📄 已生成 {done}/{expected}", end="", file=sys.stderr, flush=True)
+
+            for func, args in tasks:
+                if pool is None:
+                    collect(func(*args))
+                    continue
+                in_flight.append(pool.apply_async(func, args))
+                if len(in_flight) >= workers * 2:
+                    collect(in_flight.popleft().get())
+            while in_flight:
+                collect(in_flight.popleft().get())
+        finally:
+            if pool is not None:
+                pool.terminate()
+            _EXPORT.clear()
+            if own:
+                stream.close()
+            elif directory is None:
+                stream.flush()
+        seconds = time.perf_counter() - start
+        if progress:
+            print(f"\r✅ 已生成 {done} 份成绩单，{seconds:.2f}s，{done / seconds if seconds else 0:.0f} 份/秒",
+                  file=sys.stderr)
+        return done
+
+    def __report_chunks(self, ranks: Dict[str, int], chunk_size: int) -> Iterator[List[Tuple]]:
+        """按录入顺序把学生切成批，每条是 render_report 需要的 (学生ID, 姓名, 成绩, 平均分, 名次)"""
+        chunk = []
+        for sid, info in self.students.items():
+            chunk.append(_report_record(sid, info, self._aggregates, ranks.get(sid, 0)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
     def save_to_file(self, filename: str = DEFAULT_FILE) -> None:
-        """保存数据到JSON文件"""
+        """
+        保存数据到JSON文件（先写临时文件再改名，不会留下写了一半的文件）
+        日志模式下保存到快照文件只需要把日志 fsync，不再整份重写；SQLite 存储下只需要提交事务
+        整份写快照时，该文件以前留下的日志已经过时，一并删掉，免得下次启动把旧记录重放到新快照上
+        """
         try:
-            with open(filename, "w", encoding="utf-8") as f:
-                data = {sid: {**info, "modified": False} 
-                       for sid, info in self.students.items()}
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            if self._store is not None and filename == self.DEFAULT_FILE:
+                self._store.flush()
+                print(f"💾 数据已保存到 {self._store.path}")
+                return
+            if self._journal is not None and filename == self._snapshot_file:
+                with self._lock:
+                    self._journal.sync()
+                print(f"💾 数据已保存到 {filename}{self.JOURNAL_SUFFIX}")
+                return
+            data = {sid: {**info, "grades": dict(info["grades"]), "modified": False}
+                    for sid, info in self.students.items()}
+            write_snapshot(filename, data, indent=2)
+            self.__drop_journal(filename)
             print(f"💾 数据已保存到 {filename}")
         except (IOError, TypeError) as e:
             print(f"❌ 保存失败：{str(e)}")
@@ -111,13 +1369,116 @@ class StudentGradeManager:
         try:
             with open(filename, "r", encoding="utf-8") as f:
                 data = json.load(f)
-                self.students.update(data)
+            if self._aggregates is not None:
+                for sid in data:
+                    if sid in self.students:
+                        self._aggregates.remove(sid, self.students[sid]["grades"])
+            self.students.update(data)
+            self.__invalidate()
+            for sid in data:
+                self.__attach(sid)
+                self.__reindex(sid)
             print(f"🔃 已从 {filename} 加载数据")
         except FileNotFoundError:
             print(f"❌ 文件 {filename} 不存在")
         except json.JSONDecodeError:
             print(f"❌ 文件 {filename} 格式错误")
 
+    def import_file(self, path: str, fmt: str = None, batch_size: int = 10000,
+                    save: bool = True, trace_memory: bool = False) -> ImportReport:
+        """
+        流式批量导入 CSV/JSONL：按批读取、整批校验后直接写入，不逐条打印，最后只保存一次
+        每行一条记录，字段 student_id,name,subject,score：
+        学生不存在时按 name 新建；subject 和 score 都有时录入这门成绩
+        :param fmt: "csv" 或 "jsonl"，不填按扩展名判断
+        :param batch_size: 每批处理的行数，内存占用只和它有关
+        :param save: 导入完是否保存到快照文件（日志模式下只 fsync 日志）
+        :param trace_memory: 用 tracemalloc 统计本次导入的 Python 内存峰值（更准但会慢不少），
+                             否则报告进程的峰值 RSS
+        :return: ImportReport，出错的行记在 errors 里，不会中断导入
+        """
+        fmt = fmt or ("csv" if path.lower().endswith(".csv") else "jsonl")
+        report = ImportReport(path)
+        tracing = trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        line = 0
+        try:
+            batch = []
+            for line, row in _read_rows(path, fmt):
+                batch.append((line, row))
+                if len(batch) >= batch_size:
+                    self.__import_batch(batch, report)
+                    batch = []
+            if batch:
+                self.__import_batch(batch, report)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            report.error(line, f"读取中断：{str(e)}")
+        report.seconds = time.perf_counter() - start
+        report.errors.sort()
+        if trace_memory:
+            report.peak_memory = tracemalloc.get_traced_memory()[1]
+            report.memory_source = "tracemalloc"
+            if tracing:
+                tracemalloc.stop()
+        elif resource is not None:
+            # Linux 上 ru_maxrss 的单位是 KB，macOS 上是字节
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report.peak_memory = rss if os.uname().sysname == "Darwin" else rss * 1024
+            report.memory_source = "进程 RSS"
+        if save and (report.students or report.grades):
+            self.save_to_file(self._snapshot_file)
+        return report
+
+    def __import_batch(self, batch: List[Tuple[int, Any]], report: ImportReport) -> None:
+        """校验并写入一批记录：先逐行检查字段，分数整批判断范围，再在一把锁里写入"""
+        report.rows += len(batch)
+        rows = []
+        for line, row in batch:
+            if isinstance(row, str):
+                report.error(line, row)
+                continue
+            sid = str(row.get("student_id") or "").strip()
+            name = str(row.get("name") or "").strip()
+            subject = str(row.get("subject") or "").strip()
+            score = row.get("score")
+            if score == "":
+                score = None
+            if not sid:
+                report.error(line, "学生ID不能为空")
+            elif not sid.isalnum():
+                report.error(line, f"学生ID {sid} 只能包含字母和数字")
+            elif name and len(name) < 2:
+                report.error(line, "姓名至少需要2个字符")
+            elif (subject == "") != (score is None):
+                report.error(line, "学科和分数要同时填写")
+            else:
+                rows.append((line, sid, name, subject, score))
+        graded = [i for i, row in enumerate(rows) if row[3]]
+        scores = {i: _parse_score(rows[i][4]) for i in graded}
+        valid = _scores_in_range(list(scores.values()))
+        bad = {i for i, ok in zip(graded, valid) if not ok}
+        with self._lock:
+            for i, (line, sid, name, subject, raw) in enumerate(rows):
+                if i in bad:
+                    report.error(line, f"分数 {raw} 必须是0-100之间的数字")
+                    continue
+                if sid not in self.students:
+                    if not name:
+                        report.error(line, f"学生ID {sid} 不存在，且没有填写姓名")
+                        continue
+                    self.__insert_student(sid, name)
+                    self.__log(["s", sid, name])
+                    report.students += 1
+                if subject:
+                    score = scores[i]
+                    self.__set_grade(sid, subject, score)
+                    self.__log(["g", sid, subject, score])
+                    report.grades += 1
+
     # 验证方法私有化
     def __validate_student_id(self, sid: str) -> bool:
         if not sid.strip():
@@ -156,7 +1517,37 @@ class StudentGradeManager:
         return self.students[sid]["name"]
 
 
+def benchmark_reports(manager: "StudentGradeManager", workers: Tuple[int, ...] = (1, 2, 4),
+                      fmt: str = "text", out: str = os.devnull) -> None:
+    """
+    不同进程数下导出全部成绩单的耗时
+    主进程 CPU 是按顺序切批、收结果、写出的开销，进程再多也省不掉；
+    核数足够时 1 进程耗时 / 主进程 CPU 就是并行导出最多能快几倍
+    """
+    print(f"{len(manager.students)} 个学生，{os.cpu_count()} 个 CPU，格式 {fmt}")
+    print(f"{'进程数':<6}{'耗时s':>10}{'主进程CPU s':>14}{'份/秒':>10}")
+    for n in workers:
+        start, cpu = time.perf_counter(), time.process_time()
+        done = manager.export_reports(out, fmt, workers=n, progress=False)
+        seconds, cpu = time.perf_counter() - start, time.process_time() - cpu
+        print(f"{n:<6}{seconds:>10.2f}{cpu:>14.2f}{done / seconds:>10.0f}")
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        # python studentgrade.py bench [学生数]：在临时目录里造数据，不碰当前目录的存档
+        import random
+        import tempfile
+        os.chdir(tempfile.mkdtemp())
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        subjects = ("语文", "数学", "英语", "物理", "化学")
+        with open(StudentGradeManager.DEFAULT_FILE, "w", encoding="utf-8") as f:
+            json.dump({f"S{i:07d}": {"name": f"学生{i}", "modified": False,
+                                     "grades": {s: random.randint(0, 100) for s in subjects}}
+                       for i in range(count)}, f, ensure_ascii=False)
+        benchmark_reports(StudentGradeManager())
+        sys.exit()
+
     # 测试用例
     manager = StudentGradeManager()
     
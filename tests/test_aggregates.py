@@ -0,0 +1,113 @@
+import math
+import random
+
+import pytest
+
+import studentgrade
+from studentgrade import StudentGradeManager
+
+SUBJECTS = ("语文", "数学", "英语")
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(StudentGradeManager, "_instance", None)
+    manager = StudentGradeManager()
+    yield manager
+    if manager._store is not None:
+        manager._store.close()
+
+
+def set_mode(manager, mode):
+    if mode == "numpy":
+        if studentgrade.np is None:
+            pytest.skip("numpy 未安装")
+        manager.enable_numpy(capacity=8)
+    elif mode == "sqlite":
+        manager.use_sqlite("grades.db", cache_size=16, batch_size=7)
+
+
+def recompute(manager):
+    """不靠增量汇总，从成绩单整个重算一遍"""
+    averages = {sid: math.fsum(info["grades"].values()) / len(info["grades"])
+                for sid, info in manager.students.items() if len(info["grades"])}
+    ordered = sorted(averages.values(), reverse=True)
+    ranks = {sid: ordered.index(average) + 1 for sid, average in averages.items()}
+    bands = [0] * 10
+    for average in averages.values():
+        bands[min(int(average // 10), 9)] += 1
+    return averages, ranks, bands
+
+
+def check(manager):
+    averages, ranks, bands = recompute(manager)
+    for sid, average in averages.items():
+        assert manager.get_average(sid) == average
+        assert manager.class_rank(sid) == (ranks[sid], len(ranks))
+    assert list(manager.distribution().values()) == bands
+    scores = [(subject, score) for info in manager.students.values() for subject, score in info["grades"].items()]
+    for subject in SUBJECTS:
+        column = [score for name, score in scores if name == subject]
+        assert manager.subject_average(subject) == (math.fsum(column) / len(column) if column else 0.0)
+    assert manager.class_average() == math.fsum(score for _, score in scores) / len(scores)
+    return averages, ranks
+
+
+@pytest.mark.parametrize("mode", ["dict", "numpy", "sqlite"])
+def test_tied_averages_survive_overwrites(manager, capsys, mode):
+    set_mode(manager, mode)
+    rng = random.Random(90)
+    for i in range(201):
+        manager.add_student(f"S{i:03d}", f"学生{i}")
+    for _ in range(5):
+        for i in range(201):
+            for subject in SUBJECTS:
+                manager.add_grade(f"S{i:03d}", subject, round(rng.uniform(0, 100), 2))
+    # 最后一轮三门成绩加起来正好 270：平均分都是 90，名次都是 1
+    for i in range(201):
+        a, b = round(rng.uniform(85, 95), 1), round(rng.uniform(85, 95), 1)
+        for subject, score in zip(SUBJECTS, (a, b, round(270 - a - b, 1))):
+            manager.add_grade(f"S{i:03d}", subject, score)
+    capsys.readouterr()
+    averages, ranks = check(manager)
+    assert set(averages.values()) == {90.0}
+    assert set(ranks.values()) == {1}
+    assert manager.distribution()["90-100"] == 201
+
+
+@pytest.mark.parametrize("mode", ["dict", "numpy", "sqlite"])
+def test_random_overwrites_match_recompute(manager, capsys, mode):
+    set_mode(manager, mode)
+    rng = random.Random(mode)
+    for i in range(60):
+        manager.add_student(f"S{i:02d}", f"学生{i}")
+    for step in range(3000):
+        manager.add_grade(f"S{rng.randrange(60):02d}", rng.choice(SUBJECTS),
+                          rng.choice((rng.randrange(101), rng.uniform(0, 100), round(rng.uniform(0, 100), 1))))
+        if step % 500 == 499:
+            check(manager)
+    capsys.readouterr()
+    check(manager)
+    if manager._matrix is not None:
+        # 列式存储下的排名和 get_average 用的是同一个平均分
+        for sid, average in manager.ranking():
+            assert manager.get_average(sid) == average
+
+
+def test_sqlite_reopen_builds_same_aggregates(manager, capsys, monkeypatch):
+    manager.use_sqlite("grades.db")
+    rng = random.Random(1)
+    for i in range(50):
+        manager.add_student(f"S{i:02d}", f"学生{i}")
+        for subject in SUBJECTS:
+            for _ in range(3):
+                manager.add_grade(f"S{i:02d}", subject, rng.uniform(0, 100))
+    before = check(manager)
+    manager._store.close()
+    monkeypatch.setattr(StudentGradeManager, "_instance", None)
+    reopened = StudentGradeManager()
+    reopened.use_sqlite("grades.db")
+    capsys.readouterr()
+    assert check(reopened) == before
+    reopened._store.close()
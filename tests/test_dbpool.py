@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+
+import pytest
+
+from dbpool import ConnectionPool, PoolTimeout
+
+
+@pytest.fixture
+def pool(tmp_path):
+    path = str(tmp_path / 'users.db')
+    db = sqlite3.connect(path)
+    db.execute('create table users (username text primary key, password text)')
+    db.commit()
+    db.close()
+    pool = ConnectionPool(lambda: sqlite3.connect(path, check_same_thread=False),
+                          dialect='sqlite', maxconn=2, timeout=0.2)
+    pool.prepare('register', 'insert into users values (%s, %s)')
+    pool.prepare('password', 'select password from users where username = %s')
+    pool.prepare('count', 'select count(*) from users')
+    yield pool
+    pool.close()
+
+
+def test_prepare_and_query(pool):
+    pool.execute('register', ('张三', '123'), commit=True)
+    pool.execute('register', ('李四', '456'), commit=True)
+    assert pool.execute('password', ('张三',), fetch='one') == ('123',)
+    assert pool.execute('password', ('王五',), fetch='one') is None
+    assert pool.execute('count', fetch='all') == [(2,)]
+
+
+def test_uncommitted_write_is_rolled_back(pool):
+    pool.execute('register', ('张三', '123'))
+    assert pool.execute('count', fetch='one') == (0,)
+    pool.execute('register', ('张三', '123'), commit=True)
+    assert pool.execute('count', fetch='one') == (1,)
+
+
+def test_connection_returned_without_open_transaction(pool):
+    with pool.connection() as conn:
+        pool._run(conn, 'register', ('张三', '123'))
+        assert conn.raw.in_transaction
+    with pool.connection() as again:
+        assert again is conn
+        assert not again.raw.in_transaction
+
+
+def test_error_rolls_back_and_returns_connection(pool):
+    pool.execute('register', ('张三', '123'), commit=True)
+    with pytest.raises(sqlite3.IntegrityError):
+        pool.execute('register', ('张三', '456'), commit=True)
+    stats = pool.stats()
+    assert stats['in_use'] == 0 and stats['idle'] == 1
+    assert pool.execute('password', ('张三',), fetch='one') == ('123',)
+
+
+def test_exhaustion_times_out(pool):
+    with pool.connection(), pool.connection():
+        assert pool.stats()['in_use'] == 2
+        with pytest.raises(PoolTimeout):
+            pool.execute('count', fetch='one')
+    stats = pool.stats()
+    assert stats['timeouts'] == 1
+    assert stats['in_use'] == 0 and stats['idle'] == 2
+    assert pool.execute('count', fetch='one') == (0,)
+
+
+def test_waiter_gets_returned_connection(pool):
+    result = []
+    with pool.connection(), pool.connection():
+        waiter = threading.Thread(target=lambda: result.append(pool.execute('count', fetch='one')))
+        waiter.start()
+        waiter.join(0.05)
+        assert waiter.is_alive()
+    waiter.join()
+    assert result == [(0,)]
+    stats = pool.stats()
+    assert stats['created'] == 2 and stats['waits'] == 1
+
+
+def test_unhealthy_connection_is_replaced(pool):
+    with pool.connection() as conn:
+        pass
+    conn.raw.close()
+    pool.check_after = 0
+    assert pool.execute('count', fetch='one') == (0,)
+    stats = pool.stats()
+    assert stats['health_failures'] == 1 and stats['discarded'] == 1
+
+
+def test_closed_pool_rejects():
+    pool = ConnectionPool(lambda: sqlite3.connect(':memory:'), dialect='sqlite')
+    pool.close()
+    with pytest.raises(PoolTimeout):
+        pool.execute('count')
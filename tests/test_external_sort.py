@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+import quiksort
+from quiksort import external_sort
+
+
+def write_lines(path, lines, sep="\n"):
+    path.write_bytes("".join(line + sep for line in lines).encode("utf-8"))
+
+
+def read_lines(path):
+    data = path.read_bytes().decode("utf-8")
+    assert data == "" or data.endswith("\n")
+    return data.split("\n")[:-1]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("reverse", [False, True])
+def test_strings_keep_bare_cr(tmp_path, workers, reverse):
+    lines = ["b\rx", "a", "a\rb", "\r", "c\x1cd", "中文", "a\r", ""]
+    src, dst = tmp_path / "in.txt", tmp_path / "out.txt"
+    write_lines(src, lines)
+    stats = external_sort(str(src), str(dst), workers=workers, reverse=reverse, tmpdir=str(tmp_path))
+    # 行尾的 \r 当作 CRLF 去掉，记录中间的 \r 原样保留
+    expected = sorted([line[:-1] if line.endswith("\r") else line for line in lines], reverse=reverse)
+    assert read_lines(dst) == expected
+    assert stats["records"] == len(lines)
+
+
+def test_crlf_input(tmp_path):
+    src, dst = tmp_path / "in.txt", tmp_path / "out.txt"
+    write_lines(src, ["c", "a", "b"], sep="\r\n")
+    external_sort(str(src), str(dst), workers=1, tmpdir=str(tmp_path))
+    assert read_lines(dst) == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+@pytest.mark.parametrize("numeric", ["int", "float"])
+def test_numeric_modes(tmp_path, numeric, use_numpy):
+    rng = random.Random(7)
+    values = [rng.randrange(-10 ** 6, 10 ** 6) for _ in range(2000)]
+    if numeric == "float":
+        values = [v / 7 for v in values]
+    lines = [str(v) for v in values] + ["  42 ", "+5", "1_000", ""]
+    src, dst = tmp_path / "in.txt", tmp_path / "out.txt"
+    write_lines(src, lines, sep="\r\n")
+    external_sort(str(src), str(dst), workers=1, numeric=numeric, tmpdir=str(tmp_path), use_numpy=use_numpy)
+    parse = quiksort.NUMERIC_TYPES[numeric]
+    assert read_lines(dst) == [str(v) for v in sorted(parse(line) for line in lines if line.strip())]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_big_ints(tmp_path, use_numpy):
+    lines = [str(2 ** 63), "1", str(-2 ** 70), str(10 ** 30), "３"]
+    src, dst = tmp_path / "in.txt", tmp_path / "out.txt"
+    write_lines(src, lines)
+    external_sort(str(src), str(dst), workers=1, numeric="int", tmpdir=str(tmp_path), use_numpy=use_numpy)
+    assert read_lines(dst) == [str(v) for v in sorted(int(line) for line in lines)]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+@pytest.mark.parametrize("bad", ["2 3", "x", "1\r2"])
+def test_bad_numbers_raise(tmp_path, use_numpy, bad):
+    src, dst = tmp_path / "in.txt", tmp_path / "out.txt"
+    write_lines(src, ["1", bad])
+    with pytest.raises(ValueError):
+        external_sort(str(src), str(dst), workers=1, numeric="int", tmpdir=str(tmp_path), use_numpy=use_numpy)
+
+
+@pytest.mark.parametrize("numeric", [None, "int"])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_multi_pass_merge(tmp_path, monkeypatch, numeric, workers):
+    monkeypatch.setattr(quiksort, "MAX_FAN_IN", 2)
+    rng = random.Random(workers)
+    values = [rng.randrange(10 ** 9) for _ in range(60000)]
+    src, dst = tmp_path / "in.txt", tmp_path / "out.txt"
+    write_lines(src, [str(v) for v in values])
+    # 预算最小时每块 64KB，约 10 个有序段，MAX_FAN_IN=2 要归并好几轮
+    stats = external_sort(str(src), str(dst), memory_budget=1, workers=workers, numeric=numeric,
+                          tmpdir=str(tmp_path))
+    assert stats["runs"] > 4
+    assert stats["records"] == len(values)
+    expected = sorted(values) if numeric else sorted(str(v) for v in values)
+    assert read_lines(dst) == [str(v) for v in expected]
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith("extsort-")] == []
+
+
+def test_rejects_unknown_numeric(tmp_path):
+    with pytest.raises(ValueError):
+        external_sort(str(tmp_path / "in.txt"), str(tmp_path / "out.txt"), numeric="decimal")
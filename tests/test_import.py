@@ -0,0 +1,121 @@
+import json
+import math
+
+import pytest
+
+from studentgrade import ImportReport, StudentGradeManager, _parse_score
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(StudentGradeManager, "_instance", None)
+    return StudentGradeManager()
+
+
+def write_jsonl(path, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(row if isinstance(row, str) else json.dumps(row, ensure_ascii=False))
+            f.write("\n")
+
+
+@pytest.mark.parametrize("value, expected", [(90, 90), (87.5, 87.5), ("88", 88), (" 7.25 ", 7.25)])
+def test_parse_score_numbers(value, expected):
+    score = _parse_score(value)
+    assert score == expected and type(score) is type(expected)
+
+
+@pytest.mark.parametrize("value", [True, False, None, "abc", "", [90], {"v": 1}])
+def test_parse_score_rejects(value):
+    assert math.isnan(_parse_score(value))
+
+
+def test_boolean_score_is_an_error(manager, tmp_path):
+    path = str(tmp_path / "in.jsonl")
+    write_jsonl(path, [
+        {"student_id": "A1", "name": "张三"},
+        {"student_id": "A1", "subject": "数学", "score": True},
+        {"student_id": "A1", "subject": "语文", "score": False},
+        {"student_id": "A1", "subject": "英语", "score": 1},
+    ])
+    report = manager.import_file(path, save=False)
+    assert (report.rows, report.students, report.grades, report.failed) == (4, 1, 1, 2)
+    assert [line for line, _ in report.errors] == [2, 3]
+    assert dict(manager.students["A1"]["grades"]) == {"英语": 1}
+
+
+CSV = """student_id,name,subject,score
+A1,张三,数学,90
+A1,,语文,85.5
+,李四,数学,70
+A 2,李四,数学,70
+A3,王,数学,70
+A4,王五,数学,
+A5,赵六,,80
+A6,孙七,数学,101
+A7,周八,数学,abc
+A8,,数学,60
+A9,"吴
+九",数学,66
+A1,,英语,-0
+"""
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 10000])
+def test_csv_report_counts_and_lines(manager, tmp_path, batch_size):
+    path = str(tmp_path / "in.csv")
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(CSV)
+    report = manager.import_file(path, batch_size=batch_size, save=False)
+    assert (report.rows, report.students, report.grades, report.failed) == (12, 2, 4, 8)
+    # 行号是文件里的物理行（引号里换行的记录算到结束的那一行）
+    assert [line for line, _ in report.errors] == [4, 5, 6, 7, 8, 9, 10, 11]
+    messages = dict(report.errors)
+    assert "学生ID不能为空" in messages[4]
+    assert "只能包含字母和数字" in messages[5]
+    assert "姓名至少需要2个字符" in messages[6]
+    assert "同时填写" in messages[7] and "同时填写" in messages[8]
+    assert "0-100" in messages[9] and "0-100" in messages[10]
+    assert "不存在" in messages[11]
+    assert dict(manager.students["A1"]["grades"]) == {"数学": 90, "语文": 85.5, "英语": 0}
+    assert manager.students["A9"]["name"] == "吴\n九"
+    text = str(report)
+    assert "12 行" in text and "出错 8 行" in text and "第 4 行" in text
+
+
+def test_jsonl_report(manager, tmp_path):
+    path = str(tmp_path / "in.jsonl")
+    write_jsonl(path, [
+        {"student_id": "B1", "name": "张三", "subject": "数学", "score": "88"},
+        "{not json",
+        "[1, 2]",
+        "",
+        {"student_id": 12, "name": "数字学号", "subject": "数学", "score": 59.5},
+        {"student_id": "B1", "subject": "数学", "score": None},
+    ])
+    report = manager.import_file(path, save=False)
+    assert (report.rows, report.students, report.grades, report.failed) == (5, 2, 2, 3)
+    assert report.errors == [(2, "不是合法的 JSON"), (3, "每行必须是一个 JSON 对象"), (6, "学科和分数要同时填写")]
+    assert manager.students["12"]["grades"] == {"数学": 59.5}
+
+
+def test_error_details_are_capped(manager, tmp_path, monkeypatch):
+    monkeypatch.setattr(ImportReport, "MAX_ERRORS", 5)
+    path = str(tmp_path / "in.jsonl")
+    write_jsonl(path, [{"student_id": f"C{i}", "subject": "数学", "score": 1} for i in range(30)])
+    report = manager.import_file(path, batch_size=7, save=False)
+    assert report.failed == 30 and len(report.errors) == 5
+    assert "其余 10 行错误" in str(report)
+
+
+def test_missing_header_and_save(manager, tmp_path):
+    bad = tmp_path / "bad.csv"
+    bad.write_text("id,name\n1,张三\n", encoding="utf-8")
+    report = manager.import_file(str(bad))
+    assert report.errors == [(1, "表头缺少 student_id 字段")] and report.students == 0
+    good = tmp_path / "good.csv"
+    good.write_text("student_id,name,subject,score\nD1,张三,数学,77\n", encoding="utf-8")
+    manager.import_file(str(good))
+    with open(StudentGradeManager.DEFAULT_FILE, encoding="utf-8") as f:
+        assert json.load(f)["D1"]["grades"] == {"数学": 77}
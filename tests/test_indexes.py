@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+from studentgrade import SortedIndex, StudentGradeManager
+
+
+def expected_scan(current, start=None):
+    return sorted((key, sid) for sid, key in current.items() if start is None or key >= start)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_set_discard_scan_matches_dict(seed):
+    rng = random.Random(seed)
+    index, current = SortedIndex(), {}
+    for step in range(4000):
+        sid = f"S{rng.randrange(80):02d}"
+        op = rng.random()
+        if op < 0.6:
+            key = rng.randrange(20)
+            index.set(sid, key)
+            current[sid] = key
+        elif op < 0.75:
+            index.discard(sid)
+            current.pop(sid, None)
+        elif op < 0.8:
+            # 成批录入：一次攒超过 INSORT_MAX 条，走整体排序合并
+            for _ in range(SortedIndex.INSORT_MAX + rng.randrange(10)):
+                sid, key = f"S{rng.randrange(80):02d}", rng.randrange(20)
+                index.set(sid, key)
+                current[sid] = key
+        else:
+            start = rng.choice((None, rng.randrange(-1, 22)))
+            got = list(index.scan() if start is None else index.scan(start))
+            assert got == expected_scan(current, start), step
+        assert len(index) == len(current)
+    assert list(index.scan()) == expected_scan(current)
+
+
+def test_rebuild_drops_stale_entries():
+    index = SortedIndex()
+    for round_ in range(10):
+        for i in range(50):
+            index.set(f"S{i}", (i * 7 + round_) % 13)
+        list(index.scan())
+    assert len(index.entries) <= 2 * len(index)
+    assert list(index.scan()) == expected_scan({f"S{i}": (i * 7 + 9) % 13 for i in range(50)})
+
+
+def test_string_keys_prefix_scan():
+    index = SortedIndex()
+    for sid, name in [("1", "张三"), ("2", "张三丰"), ("3", "李四"), ("4", "张"), ("5", "王五")]:
+        index.set(sid, name)
+    index.set("5", "张五")
+    assert [sid for name, sid in index.scan("张") if name.startswith("张")] == ["4", "1", "2", "5"]
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(StudentGradeManager, "_instance", None)
+    manager = StudentGradeManager()
+    rng = random.Random(3)
+    for i in range(200):
+        manager.add_student(f"S{i:03d}", rng.choice(["张三", "张伟", "李四", "王五"]) + str(i % 7))
+        for subject in ("数学", "语文"):
+            if rng.random() < 0.8:
+                manager.add_grade(f"S{i:03d}", subject, rng.choice((rng.randrange(101), round(rng.uniform(0, 100), 1))))
+    for _ in range(300):
+        manager.add_grade(f"S{rng.randrange(200):03d}", "数学", rng.randrange(101))
+    capsys.readouterr()
+    return manager
+
+
+def test_manager_queries_match_brute_force(manager):
+    scores = {sid: info["grades"]["数学"] for sid, info in manager.students.items() if "数学" in info["grades"]}
+    by_score = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    assert manager.grade_range("数学", 60, 89.5) == [(sid, s) for sid, s in by_score if 60 <= s <= 89.5]
+    assert manager.top_grades("数学", 15) == by_score[:15]
+    assert manager.top_grades("数学", 0) == []
+    names = sorted((info["name"], sid) for sid, info in manager.students.items())
+    assert manager.find_by_name("张") == [(sid, name) for name, sid in names if name.startswith("张")]
+    assert manager.find_by_name("李四3", limit=3) == [(sid, name) for name, sid in names if name == "李四3"][:3]
@@ -0,0 +1,139 @@
+import json
+import os
+
+import pytest
+
+import studentgrade
+from studentgrade import StudentGradeManager
+
+FILE = StudentGradeManager.DEFAULT_FILE
+JOURNAL = FILE + StudentGradeManager.JOURNAL_SUFFIX
+
+
+@pytest.fixture
+def fresh(tmp_path, monkeypatch, capsys):
+    """每次调用都模拟一次进程重启：丢掉单例，从磁盘重新加载"""
+    monkeypatch.chdir(tmp_path)
+
+    def start():
+        monkeypatch.setattr(StudentGradeManager, "_instance", None)
+        return StudentGradeManager()
+    yield start
+    capsys.readouterr()
+
+
+def crash(manager):
+    """不压缩、不走正常关闭，只保证已经写出的记录落盘"""
+    manager._journal.sync()
+    manager._journal.f.close()
+    manager._journal = None
+
+
+def state(manager):
+    return {sid: (info["name"], dict(info["grades"])) for sid, info in manager.students.items()}
+
+
+def test_replay_after_crash(fresh):
+    manager = fresh()
+    manager.enable_journal(sync_every=1000, compact_after=0)
+    manager.add_student("A1", "张三")
+    manager.add_grade("A1", "数学", 80)
+    manager.add_grade("A1", "数学", 91.5)
+    manager.add_student("A2", "李四")
+    expected = state(manager)
+    crash(manager)
+    assert not os.path.exists(FILE)
+    assert state(fresh()) == expected
+
+
+def test_torn_last_record_is_ignored(fresh):
+    manager = fresh()
+    manager.enable_journal(compact_after=0)
+    manager.add_student("A1", "张三")
+    manager.add_grade("A1", "数学", 80)
+    expected = state(manager)
+    crash(manager)
+    with open(JOURNAL, "ab") as f:
+        f.write(b'["g","A1","\xe6\x95')
+    assert state(fresh()) == expected
+
+
+def test_failed_compaction_keeps_old_segment(fresh, monkeypatch):
+    manager = fresh()
+    manager.enable_journal(compact_after=0)
+    manager.add_student("A1", "张三")
+    manager.add_grade("A1", "数学", 70)
+
+    def fail(filename, data, indent=None):
+        raise OSError("disk full")
+    with monkeypatch.context() as patch:
+        patch.setattr(studentgrade, "write_snapshot", fail)
+        manager.compact()
+        assert os.path.exists(JOURNAL + ".old") and not os.path.exists(FILE)
+        manager.add_grade("A1", "数学", 75)
+        manager.add_student("A2", "李四")
+        # 第二次压缩也失败：新的记录接在旧段后面，不能覆盖
+        manager.compact()
+        manager.add_grade("A2", "语文", 60)
+        expected = state(manager)
+        crash(manager)
+        assert state(fresh()) == expected
+
+    manager = fresh()
+    manager.enable_journal(compact_after=0)
+    manager.compact()
+    assert not os.path.exists(JOURNAL + ".old")
+    with open(FILE, encoding="utf-8") as f:
+        assert {sid: (info["name"], info["grades"]) for sid, info in json.load(f).items()} == expected
+    crash(manager)
+    assert state(fresh()) == expected
+
+
+def test_crash_between_snapshot_and_removing_old_segment(fresh):
+    manager = fresh()
+    manager.enable_journal(compact_after=0)
+    manager.add_student("A1", "张三")
+    manager.add_grade("A1", "数学", 50)
+    manager._journal.sync()
+    with open(JOURNAL, "rb") as f:
+        compacted = f.read()
+    manager.compact()
+    manager.add_grade("A1", "数学", 99)
+    expected = state(manager)
+    crash(manager)
+    # 快照写好了、旧段还没删：旧段里的记录再重放一遍，结果不变
+    with open(JOURNAL + ".old", "wb") as f:
+        f.write(compacted)
+    assert state(fresh()) == expected
+
+
+def test_background_compaction(fresh):
+    manager = fresh()
+    manager.enable_journal(compact_after=10)
+    for i in range(35):
+        manager.add_student(f"A{i}", f"学生{i}")
+        manager.add_grade(f"A{i}", "数学", i)
+    manager.close_journal()
+    expected = state(manager)
+    # 后台压缩过：日志里只剩最后一次换段之后的记录
+    with open(JOURNAL, "rb") as f:
+        assert sum(1 for _ in f) < 70
+    assert os.path.exists(FILE) and not os.path.exists(JOURNAL + ".old")
+    assert state(fresh()) == expected
+
+
+def test_full_save_drops_stale_journal(fresh):
+    manager = fresh()
+    manager.enable_journal(compact_after=0)
+    manager.add_student("A1", "张三")
+    manager.add_grade("A1", "数学", 80)
+    # 日志模式下保存只 fsync 日志
+    manager.save_to_file()
+    assert os.path.exists(JOURNAL) and not os.path.exists(FILE)
+    manager.close_journal()
+    manager = fresh()
+    manager.add_grade("A1", "数学", 90)
+    manager.save_to_file()
+    # 整份快照已经包含日志里的改动，旧日志不能在下次启动时把 80 重放回来
+    assert not os.path.exists(JOURNAL) and not os.path.exists(JOURNAL + ".old")
+    assert fresh().students["A1"]["grades"] == {"数学": 90}
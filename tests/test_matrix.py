@@ -0,0 +1,104 @@
+import json
+import os
+import random
+
+import pytest
+
+import studentgrade
+from studentgrade import GradeMatrix, GradeRow, StudentGradeManager
+
+pytestmark = pytest.mark.skipif(studentgrade.np is None, reason="numpy 未安装")
+
+SUBJECTS = [f"科目{i}" for i in range(11)]
+
+
+@pytest.fixture
+def fresh(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+
+    def start():
+        monkeypatch.setattr(StudentGradeManager, "_instance", None)
+        return StudentGradeManager()
+    yield start
+    capsys.readouterr()
+
+
+def fill(manager, seed=5):
+    rng = random.Random(seed)
+    for i in range(120):
+        manager.add_student(f"S{i:03d}", f"学生{i}")
+    for _ in range(1500):
+        score = rng.choice((rng.randrange(101), round(rng.uniform(0, 100), 1), rng.uniform(0, 100)))
+        manager.add_grade(f"S{rng.randrange(110):03d}", rng.choice(SUBJECTS), score)
+
+
+def snapshot(manager):
+    """两种存储下应该完全一致的结果"""
+    result = {
+        "grades": {sid: dict(info["grades"]) for sid, info in manager.students.items()},
+        "averages": {sid: manager.get_average(sid) for sid in manager.students if len(manager.students[sid]["grades"])},
+        "class_averages": manager.class_averages(),
+        "ranks": {sid: manager.class_rank(sid) for sid in manager.students},
+        "distribution": manager.distribution(),
+        "ranking": manager.ranking(),
+        "top": manager.ranking(top=7),
+        "class_average": manager.class_average(),
+    }
+    for subject in SUBJECTS[:3] + ["没有的科目"]:
+        result["ranking", subject] = manager.ranking(subject)
+        result["top", subject] = manager.ranking(subject, top=5)
+        result["average", subject] = manager.subject_average(subject)
+    return result
+
+
+def stats(manager):
+    return {subject: (manager.subject_stats(subject), [manager.percentile(q, subject) for q in (0, 10, 50, 99, 100)])
+            for subject in SUBJECTS[:3] + [None, "没有的科目"]}
+
+
+def test_matrix_matches_dict_store(fresh):
+    manager = fresh()
+    fill(manager)
+    expected, expected_stats = snapshot(manager), stats(manager)
+    manager.save_to_file()
+    with open(StudentGradeManager.DEFAULT_FILE, encoding="utf-8") as f:
+        saved = json.load(f)
+
+    manager = fresh()
+    assert manager.enable_numpy(capacity=8)
+    assert isinstance(manager.students["S000"]["grades"], GradeRow)
+    assert snapshot(manager) == expected
+    for subject, (subject_stats, percentiles) in stats(manager).items():
+        assert subject_stats == pytest.approx(expected_stats[subject][0], nan_ok=True)
+        assert percentiles == pytest.approx(expected_stats[subject][1], nan_ok=True)
+
+    # 矩阵模式下新录入的成绩、存盘结果也和字典模式一致
+    os.remove(StudentGradeManager.DEFAULT_FILE)
+    manager = fresh()
+    manager.enable_numpy(capacity=8)
+    fill(manager)
+    assert snapshot(manager) == expected
+    manager.save_to_file()
+    with open(StudentGradeManager.DEFAULT_FILE, encoding="utf-8") as f:
+        assert json.load(f) == saved
+
+
+def test_grade_row_behaves_like_dict():
+    matrix = GradeMatrix(capacity=1, subjects=1)
+    row = GradeRow(matrix, "S1")
+    plain = {}
+    for subject, score in [("数学", 90), ("语文", 85.5), ("英语", 70), ("数学", 60.25), ("物理", 100)]:
+        row[subject] = plain[subject] = score
+    del row["英语"], plain["英语"]
+    assert dict(row) == plain and len(row) == len(plain) and list(row) == list(plain)
+    assert type(row["数学"]) is float and type(row["物理"]) is int
+    with pytest.raises(KeyError):
+        row["英语"]
+    with pytest.raises(KeyError):
+        del row["化学"]
+    other = GradeRow(matrix, "S2")
+    other.update({"化学": 1})
+    assert dict(other) == {"化学": 1} and dict(row) == plain
+    matrix.clear("S1")
+    assert dict(row) == {} and len(row) == 0
+    assert matrix.averages()[matrix.rows["S2"]] == 1
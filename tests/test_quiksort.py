@@ -0,0 +1,104 @@
+import array
+import random
+
+import pytest
+
+import quiksort
+from quiksort import introsort, quicksort
+
+
+def distributions(n, rng):
+    values = [rng.randrange(n * 4 + 1) for _ in range(n)]
+    return {
+        "random": values,
+        "sorted": sorted(values),
+        "reversed": sorted(values, reverse=True),
+        "few_values": [rng.randrange(3) for _ in range(n)],
+        "all_equal": [7] * n,
+        "organ_pipe": list(range(n // 2)) + list(range(n - n // 2, 0, -1)),
+        "sawtooth": [i % 5 for i in range(n)],
+    }
+
+
+@pytest.mark.parametrize("n", list(range(0, 81)) + [257, 1000])
+def test_sizes_and_distributions(n):
+    rng = random.Random(n)
+    for label, values in distributions(n, rng).items():
+        data = list(values)
+        assert introsort(data) is None
+        assert data == sorted(values), label
+
+
+@pytest.mark.parametrize("distinct", [1, 2, 10, 1000])
+def test_many_duplicates(distinct):
+    rng = random.Random(distinct)
+    values = [rng.randrange(distinct) for _ in range(20000)]
+    data = list(values)
+    introsort(data)
+    assert data == sorted(values)
+
+
+def test_key_and_reverse_are_stable():
+    rng = random.Random(1)
+    records = [(rng.randrange(20), i) for i in range(3000)]
+    for reverse in (False, True):
+        data = list(records)
+        introsort(data, key=lambda r: r[0], reverse=reverse)
+        assert data == sorted(records, key=lambda r: r[0], reverse=reverse)
+
+
+def test_key_never_compares_items():
+    class Opaque:
+        def __init__(self, k):
+            self.k = k
+
+        def __lt__(self, other):
+            raise AssertionError("元素本身不应该参与比较")
+
+    items = [Opaque(k % 7) for k in range(500)]
+    introsort(items, key=lambda o: o.k)
+    assert [o.k for o in items] == sorted(k % 7 for k in range(500))
+
+
+def test_reverse_without_key():
+    values = list(range(200)) * 3
+    random.Random(2).shuffle(values)
+    introsort(values, reverse=True)
+    assert values == sorted(values, reverse=True)
+
+
+def test_other_mutable_sequences():
+    rng = random.Random(3)
+    ints = array.array("i", [rng.randrange(-1000, 1000) for _ in range(5000)])
+    introsort(ints)
+    assert list(ints) == sorted(ints)
+    data = bytearray(rng.randrange(256) for _ in range(5000))
+    introsort(data)
+    assert data == bytearray(sorted(data))
+
+
+def test_heapsort_fallback(monkeypatch):
+    # 总选第一个元素当 pivot，有序输入每轮只剥掉一个元素，必须靠深度限制切到堆排序
+    calls = []
+    heapsort = quiksort._heapsort
+    monkeypatch.setattr(quiksort, "_choose_pivot", lambda a, lo, hi: lo)
+    monkeypatch.setattr(quiksort, "_heapsort", lambda a, lo, hi: calls.append(hi - lo) or heapsort(a, lo, hi))
+    values = list(range(5000))
+    for data in (list(values), values[::-1]):
+        introsort(data)
+        assert data == values
+    assert calls
+
+
+def test_heapsort_directly():
+    rng = random.Random(4)
+    values = [rng.randrange(100) for _ in range(1000)]
+    data = list(values)
+    quiksort._heapsort(data, 100, 900)
+    assert data[:100] == values[:100] and data[900:] == values[900:]
+    assert data[100:900] == sorted(values[100:900])
+
+
+def test_quicksort_unchanged():
+    values = [3, 6, 8, 10, 1, 2, 1]
+    assert quicksort(values) == [1, 1, 2, 3, 6, 8, 10]
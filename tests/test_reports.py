@@ -0,0 +1,81 @@
+import io
+import json
+import os
+
+import pytest
+
+from studentgrade import StudentGradeManager, render_report
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(StudentGradeManager, "_instance", None)
+    subjects = ("语文", "数学", "英语")
+    data = {f"S{i:04d}": {"name": f"学生{i}", "modified": False,
+                          "grades": {s: (i * 7 + j * 13) % 101 for j, s in enumerate(subjects[:i % 4])}}
+            for i in range(2500)}
+    with open(StudentGradeManager.DEFAULT_FILE, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    return StudentGradeManager()
+
+
+def export(manager, out, **kwargs):
+    return manager.export_reports(out, chunk_size=97, progress=False, **kwargs)
+
+
+def test_show_student_format_unchanged(manager, capsys):
+    manager.add_student("X1", "张三")
+    manager.add_grade("X1", "数学", 85)
+    manager.add_grade("X1", "物理", 92)
+    capsys.readouterr()
+    manager.show_student("X1")
+    assert capsys.readouterr().out == (
+        "\n🔍 学生ID: X1\n"
+        "├── 姓名: 张三\n"
+        "├── 成绩单：\n"
+        "│   ├── 数学: 85\n"
+        "│   ├── 物理: 92\n"
+        "└── 平均分: 88.5\n\n"
+    )
+
+
+def test_render_report_with_rank():
+    text = render_report("S1", "张三", {"数学": 90}, 90.0, 2, 10)
+    assert text.endswith("├── 平均分: 90.0\n└── 班级排名: 2/10\n\n")
+    record = json.loads(render_report("S1", "张三", {"数学": 90}, 90.0, 0, 10, fmt="json"))
+    assert record["rank"] is None and record["total"] == 10
+
+
+@pytest.mark.parametrize("fmt", ["text", "json"])
+def test_pool_output_matches_in_process(manager, tmp_path, fmt):
+    local = io.StringIO()
+    assert export(manager, local, fmt=fmt, workers=1) == len(manager.students)
+    for workers in (2, 3):
+        path = str(tmp_path / f"out{workers}.{fmt}")
+        assert export(manager, path, fmt=fmt, workers=workers) == len(manager.students)
+        with open(path, encoding="utf-8") as f:
+            assert f.read() == local.getvalue()
+    if fmt == "json":
+        lines = local.getvalue().splitlines()
+        assert [json.loads(line)["student_id"] for line in lines] == list(manager.students)
+
+
+def test_directory_output_matches_stream(manager, tmp_path):
+    stream = io.StringIO()
+    export(manager, stream, workers=1)
+    directory = tmp_path / "cards"
+    directory.mkdir()
+    export(manager, str(directory), workers=2)
+    assert len(os.listdir(directory)) == len(manager.students)
+    joined = "".join((directory / f"{sid}.txt").read_text(encoding="utf-8") for sid in manager.students)
+    assert joined == stream.getvalue()
+
+
+def test_export_ranks_match_class_rank(manager):
+    stream = io.StringIO()
+    export(manager, stream, fmt="json", workers=2)
+    for line in stream.getvalue().splitlines()[:200]:
+        record = json.loads(line)
+        rank, total = manager.class_rank(record["student_id"])
+        assert (record["rank"] or 0, record["total"]) == (rank, total)
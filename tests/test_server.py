@@ -0,0 +1,417 @@
+import hashlib
+import json
+import os
+import socket
+import time
+
+import pytest
+
+import server
+
+
+def frames_of(reader):
+    return [(kind, bytes(payload)) for kind, payload in reader.frames()]
+
+
+def test_frames_split_across_feeds():
+    reader = server.FrameReader(size=64)
+    data = server.pack_frame(server.FRAME_CONTROL, b'["hello"]') + server.pack_frame(server.FRAME_DATA, b"x" * 40)
+    got = []
+    for i in range(len(data)):
+        reader.feed(data[i:i + 1])
+        got += frames_of(reader)
+    assert got == [(server.FRAME_CONTROL, b'["hello"]'), (server.FRAME_DATA, b"x" * 40)]
+    assert reader.start == reader.end
+
+
+def test_coalesced_frames_in_one_feed():
+    reader = server.FrameReader(size=64)
+    payloads = [bytes([i]) * i for i in range(10)]
+    reader.feed(b"".join(server.pack_frame(server.FRAME_DATA, p) for p in payloads) + b"\x01\x00")
+    assert [p for _, p in frames_of(reader)] == payloads
+    assert reader.end - reader.start == 2    # 半个帧头留在缓冲区里等下一次
+
+
+def test_buffer_grows_for_large_frame():
+    reader = server.FrameReader(size=16)
+    payload = bytes(range(256)) * 40
+    frame = server.pack_frame(server.FRAME_DATA, payload)
+    reader.feed(frame[:10])
+    assert frames_of(reader) == []
+    # 看到帧头后缓冲区就扩到能放下整个帧
+    assert len(reader.buf) >= len(frame)
+    reader.feed(frame[10:])
+    assert frames_of(reader) == [(server.FRAME_DATA, payload)]
+
+
+def test_recv_from_compacts_and_grows():
+    a, b = socket.socketpair()
+    try:
+        reader = server.FrameReader(size=32)
+        sent = [bytes([i % 251]) * (i * 7) for i in range(1, 30)]
+        a.sendall(b"".join(server.pack_frame(server.FRAME_DATA, p) for p in sent))
+        a.close()
+        got = []
+        while reader.recv_from(b):
+            got += [p for _, p in frames_of(reader)]
+        assert got == sent
+    finally:
+        b.close()
+
+
+def test_oversize_frame_rejected():
+    reader = server.FrameReader()
+    reader.feed(server.FRAME_HEADER.pack(server.FRAME_DATA, server.MAX_FRAME_SIZE + 1))
+    with pytest.raises(server.FrameError):
+        frames_of(reader)
+
+
+def test_history_keeps_batch_when_write_fails(tmp_path, caplog):
+    path = tmp_path / "history" / "chat.log"
+    history = server.ChatHistory(str(path), size=10)
+    history.add("lobby", "m0")
+    history.add("lobby", "m1")
+    with pytest.raises(OSError):
+        history.flush()
+    assert "2 条消息等待重试" in caplog.text
+    history.add("lobby", "m2")
+    path.parent.mkdir()
+    history.flush()
+    assert [json.loads(line)["msg"] for line in path.read_text(encoding="utf-8").splitlines()] == ["m0", "m1", "m2"]
+    assert history.pending == [] and history.written == 3
+
+
+def test_history_drops_oldest_past_max_pending(tmp_path, caplog):
+    history = server.ChatHistory(str(tmp_path / "missing" / "chat.log"), max_pending=3)
+    for i in range(5):
+        history.add("lobby", f"m{i}")
+    with pytest.raises(OSError):
+        history.flush()
+    assert [msg for _, msg in history.pending] == ["m2", "m3", "m4"]
+    assert "丢弃最旧的 2 条" in caplog.text
+
+
+def test_history_replays_tail(tmp_path):
+    path = str(tmp_path / "chat.log")
+    history = server.ChatHistory(path, size=3)
+    for i in range(5):
+        history.add("lobby" if i % 2 else "r2", f"m{i}")
+    history.close()
+    reloaded = server.ChatHistory(path, size=3)
+    assert reloaded.recent("lobby") == ["m1", "m3"]
+    assert reloaded.recent("r2", 2) == ["m2", "m4"]
+
+
+class FakeConn():
+    def __init__(self):
+        self.sent = []
+
+    def send_msg(self, msg):
+        self.sent.append(msg)
+
+
+def make_catalog(root, names):
+    root.mkdir()
+    for name in names:
+        (root / name).write_bytes(b"x" * 10)
+    return server.FileCatalog(str(root), chunk_size=4)
+
+
+def list_files(catalog, *args):
+    conn = FakeConn()
+    handler = type("Handler", (), {"catalog": catalog, "MAX_PAGE_SIZE": server.Server.MAX_PAGE_SIZE})()
+    server.Server.on_list(handler, conn, ["list", *args])
+    (reply,) = conn.sent
+    assert reply[0] == "files"
+    return reply[1], [entry[0] for entry in reply[2]]
+
+
+@pytest.mark.parametrize("page, page_size, expected", [
+    (-1, 2, ["b1", "b2"]),
+    (-5, 3, ["b1", "b2", "b3"]),
+    (0, 0, ["b1"]),
+    (1, -4, ["b2"]),
+    (0, 10 ** 9, ["b1", "b2", "b3"]),
+])
+def test_list_clamps_paging(tmp_path, page, page_size, expected):
+    catalog = make_catalog(tmp_path / "files", ["a1", "a2", "b1", "b2", "b3", "c1"])
+    assert list_files(catalog, "b", page, page_size) == (3, expected)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / server.FILE_DIR).mkdir()
+    return tmp_path
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_upload_resumes_from_part(workdir):
+    data = bytes(range(256)) * 400
+    upload = server.Upload("a.bin", len(data), sha256(data), buffer_size=1000)
+    upload.write(data[:30000])
+    upload.close()
+    # 断线重连：同一内容从已收到的位置续传
+    upload = server.Upload("a.bin", len(data), sha256(data).upper(), buffer_size=1000)
+    assert upload.received == 30000 and upload.remaining == len(data) - 30000
+    upload.write(data[30000:])
+    assert upload.finish()
+    assert (workdir / server.FILE_DIR / "a.bin").read_bytes() == data
+    assert list((workdir / server.PARTIAL_DIR).iterdir()) == []
+
+
+def test_upload_truncates_oversized_part(workdir):
+    data = b"0123456789" * 10
+    upload = server.Upload("a.bin", len(data), sha256(data))
+    part = upload.part
+    upload.close()
+    with open(part, "wb") as f:
+        f.write(data + b"extra")
+    upload = server.Upload("a.bin", len(data), sha256(data))
+    assert upload.remaining == 0
+    assert upload.finish()
+    assert (workdir / server.FILE_DIR / "a.bin").read_bytes() == data
+
+
+def test_upload_digest_mismatch_discards_part(workdir):
+    data = b"hello world"
+    upload = server.Upload("../a.bin", len(data), sha256(b"something else"))
+    assert upload.name == "a.bin"
+    upload.write(data)
+    with pytest.raises(ValueError):
+        upload.write(b"!")
+    assert not upload.finish()
+    assert list((workdir / server.PARTIAL_DIR).iterdir()) == []
+    assert not (workdir / server.FILE_DIR / "a.bin").exists()
+
+
+@pytest.mark.parametrize("name, size, digest", [
+    ("a.bin", 1, "../../etc/passwd"),
+    ("a.bin", 1, "ab" * 31),
+    ("a.bin", -1, "ab" * 32),
+    ("", 1, "ab" * 32),
+])
+def test_upload_rejects_bad_parameters(workdir, name, size, digest):
+    with pytest.raises(ValueError):
+        server.Upload(name, size, digest)
+
+
+def test_catalog_pages_within_prefix(tmp_path):
+    names = ["a{:02d}".format(i) for i in range(25)] + ["b1", "ab", "中文.txt"]
+    catalog = make_catalog(tmp_path / "files", names)
+    pages = [list_files(catalog, "a", page, 10) for page in range(4)]
+    assert [total for total, _ in pages] == [26] * 4
+    assert sum((page for _, page in pages), []) == sorted(n for n in names if n.startswith("a"))
+    assert pages[3][1] == []
+    assert list_files(catalog, "a0", 0, 100) == (10, ["a{:02d}".format(i) for i in range(10)])
+    assert list_files(catalog, "中", 0, 100) == (1, ["中文.txt"])
+    assert list_files(catalog, "zz", 0, 100) == (0, [])
+    assert list_files(catalog)[0] == len(names)
+    entry = catalog.get("b1")
+    assert (entry["size"], entry["chunks"]) == (10, 3)
+
+
+def test_catalog_rejects_paths_outside_root(tmp_path):
+    (tmp_path / "secret").write_bytes(b"s")
+    catalog = make_catalog(tmp_path / "files", ["ok"])
+    (tmp_path / "files" / "sub").mkdir()
+    (tmp_path / "files" / "sub" / "inner").write_bytes(b"i")
+    for name in ("../secret", "sub/inner", "sub", ".", "..", "", "/etc/passwd", None, 3):
+        assert catalog.get(name) is None, name
+        assert catalog.update(name) is None, name
+    assert list_files(catalog) == (1, ["ok"])
+
+
+def test_catalog_sees_new_files_and_caches_misses(tmp_path):
+    root = tmp_path / "files"
+    root.mkdir()
+    catalog = server.FileCatalog(str(root), chunk_size=4, refresh_interval=3600, full_interval=3600)
+    (root / "new").write_bytes(b"123456")
+    # 轮询间隔内出现的文件第一次 get 时直接 stat
+    assert catalog.get("new")["size"] == 6
+    assert catalog.get("later") is None
+    (root / "later").write_bytes(b"1")
+    assert catalog.get("later") is None
+    catalog.refresh(force=True)
+    assert catalog.get("later")["size"] == 1
+    (root / "new").unlink()
+    catalog.refresh(force=True)
+    assert catalog.get("new") is None
+    assert list_files(catalog) == (1, ["later"])
+
+
+def test_catalog_lists_manifests(tmp_path):
+    root, manifests = tmp_path / "files", tmp_path / "manifests"
+    root.mkdir()
+    manifests.mkdir()
+    (root / "plain").write_bytes(b"abc")
+    (manifests / "deduped.json").write_text(json.dumps({"size": 9, "chunks": []}), encoding="utf-8")
+    catalog = server.FileCatalog(str(root), chunk_size=4, manifests=str(manifests))
+    assert list_files(catalog) == (2, ["deduped", "plain"])
+    assert catalog.get("deduped")["size"] == 9
+
+
+CHUNK = server.ChunkStore.MIN_CHUNK
+
+
+def split(data, size=CHUNK):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def offer(store, name, data):
+    chunks = [sha256(c) for c in split(data)]
+    return server.ChunkedUpload(store, name, len(data), sha256(data), CHUNK, chunks)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return server.ChunkStore(str(tmp_path / "chunks"), str(tmp_path / "manifests"))
+
+
+def test_chunked_upload_needs_only_new_chunks(store):
+    a, b, c = (bytes([i]) * CHUNK for i in (1, 2, 3))
+    first = offer(store, "first", a + b + a + c[:100])
+    # 重复的块只要一次
+    assert first.missing == [0, 1, 3]
+    assert first.remaining == 2 * CHUNK + 100
+    for i in first.missing:
+        first.write(split(a + b + a + c[:100])[i])
+    assert first.remaining == 0
+    assert first.finish()
+    second = offer(store, "second", b + c + a)
+    assert second.missing == [1]
+    assert second.remaining == CHUNK
+
+
+def test_chunk_reader_reassembles(store):
+    data = bytes(range(256)) * 70
+    upload = offer(store, "f.bin", data)
+    for i in upload.missing:
+        upload.write(split(data)[i])
+    assert upload.finish()
+    reader = store.open("f.bin")
+    try:
+        assert reader.read() == data
+        assert reader.seek(CHUNK - 10) == CHUNK - 10
+        assert reader.read(30) == data[CHUNK - 10:CHUNK + 20]
+        reader.seek(-5, os.SEEK_END)
+        assert reader.read(100) == data[-5:]
+        assert reader.read(1) == b""
+    finally:
+        reader.close()
+
+
+def test_chunked_upload_rejects_bad_data(store):
+    data = b"x" * (CHUNK + 1)
+    upload = offer(store, "f", data)
+    with pytest.raises(ValueError):
+        upload.write(b"y" * CHUNK)
+    upload.write(data[:CHUNK])
+    upload.write(data[CHUNK:])
+    with pytest.raises(ValueError):
+        upload.write(b"x")
+    # 块都对但整体摘要不对：不写清单
+    chunks = [sha256(c) for c in split(data)]
+    wrong = server.ChunkedUpload(store, "g", len(data), sha256(b"other"), CHUNK, chunks)
+    assert wrong.missing == []
+    assert not wrong.finish()
+    assert store.manifest("g") is None
+
+
+@pytest.mark.parametrize("size, chunk_size, chunks", [
+    (10, CHUNK, []),
+    (10, CHUNK, ["ab" * 32, "ab" * 32]),
+    (10, CHUNK // 2, ["ab" * 32]),
+    (10, CHUNK, ["../../x"]),
+])
+def test_chunked_upload_rejects_bad_offer(store, size, chunk_size, chunks):
+    with pytest.raises(ValueError):
+        server.ChunkedUpload(store, "f", size, "ab" * 32, chunk_size, chunks)
+
+
+def test_missing_chunk_fails_finish_and_collect(store):
+    data = bytes([7]) * CHUNK + bytes([8]) * CHUNK
+    upload = offer(store, "f", data)
+    for i in upload.missing:
+        upload.write(split(data)[i])
+    os.remove(store.path(sha256(split(data)[1])))
+    assert not upload.finish()
+    store.put(sha256(b"orphan"), b"orphan")
+    store.put(sha256(split(data)[1]), split(data)[1])
+    assert upload.finish()
+    assert store.collect() == 1
+    assert not store.has(sha256(b"orphan"))
+    reader = store.open("f")
+    assert reader.read() == data
+    reader.close()
+
+
+def test_timer_wheel_expiry_and_rescheduling():
+    wheel = server.TimerWheel(tick=1.0, slots=8)
+    now = wheel.current * 1.0
+    wheel.add("a", now + 2.5)
+    wheel.add("b", now + 2.5)
+    wheel.add("lap", now + 20)      # 超过一圈，留在槽里等下一圈
+    wheel.add("past", now - 5)      # 已经过期的放进下一个槽
+    assert wheel.size == 4
+    assert wheel.advance(now + 0.5) == []
+    assert wheel.advance(now + 1) == ["past"]
+    assert wheel.advance(now + 2.9) == []
+    assert sorted(wheel.advance(now + 3)) == ["a", "b"]
+    # 到期后由调用方重新排期
+    wheel.add("a", now + 5)
+    for t in range(4, 20):
+        assert wheel.advance(now + t) == (["a"] if t == 5 else [])
+    assert wheel.advance(now + 20) == ["lap"]
+    assert wheel.size == 0
+
+
+def test_timer_wheel_large_jump():
+    wheel = server.TimerWheel(tick=0.5, slots=4)
+    now = wheel.current * 0.5
+    for i in range(20):
+        wheel.add(i, now + i * 0.3)
+    assert sorted(wheel.advance(now + 3)) == [i for i in range(20) if i * 0.3 <= 3]
+    assert sorted(wheel.advance(now + 100)) == [i for i in range(20) if i * 0.3 > 3]
+    assert wheel.size == 0
+
+
+@pytest.mark.parametrize("mode", ["thread", "event"])
+def test_heartbeat_spares_slow_download_and_reaps_stuck_reader(workdir, mode):
+    import server_bench
+    (workdir / server_bench.BENCH_DIR).mkdir()
+    size = 6 * 1024 * 1024
+    (workdir / server.FILE_DIR / "big.bin").write_bytes(os.urandom(size))
+    s, port = server_bench.start_server(mode=mode, protocol="framed", ping_interval=1, grace=1, timer_tick=0.2)
+    clients = []
+    try:
+        def client():
+            c = server_bench.Client(port, "framed")
+            c.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+            c.send_msg(["get", "big.bin"])
+            assert c.recv_msg()[0] == "transfer"
+            clients.append(c)
+            return c
+
+        stuck = client()
+        slow = client()
+        # 约 2MB/s 地读，整段要 3 秒，超过 ping_interval + grace
+        got, start = 0, time.monotonic()
+        while got < size:
+            data = slow.sock.recv(65536)
+            assert data, "慢速下载被当成死连接断开了"
+            got += len(data)
+            time.sleep(max(0.0, got / (2 * 1024 * 1024) - (time.monotonic() - start)))
+        assert time.monotonic() - start > 2.5
+        # 完全不读的连接还是要被断开
+        deadline = time.monotonic() + 5
+        while s.stats.snapshot(s)["reaped"].get("dead", 0) < 1 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert s.stats.snapshot(s)["reaped"] == {"dead": 1}
+    finally:
+        for c in clients:
+            c.close()
+        s.stop()
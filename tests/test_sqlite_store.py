@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from studentgrade import SqliteStudents, StoredGrades, StudentGradeManager
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SqliteStudents(str(tmp_path / "s.db"), cache_size=3, batch_size=1000)
+    yield store
+    store.close()
+
+
+def reopen(store):
+    store.close()
+    return SqliteStudents(store.path, cache_size=store.cache_size, batch_size=store.batch_size)
+
+
+def test_lru_eviction_keeps_writes(store):
+    for i in range(10):
+        store[f"S{i}"] = {"name": f"学生{i}", "grades": {"数学": i}}
+    assert list(store.cache) == ["S7", "S8", "S9"]
+    held = store["S0"]
+    assert isinstance(held["grades"], StoredGrades) and list(store.cache) == ["S8", "S9", "S0"]
+    for i in range(1, 5):
+        store[f"S{i}"]["grades"]["语文"] = 50 + i
+    # S0 已经被挤出缓存，手里的引用照样写到数据库
+    assert "S0" not in store.cache
+    held["grades"]["语文"] = 99
+    del store["S2"]["grades"]["数学"]
+    assert store["S0"]["grades"] is not held["grades"]
+    assert dict(store["S0"]["grades"]) == {"数学": 0, "语文": 99}
+    assert store.pending > 0
+
+    store = reopen(store)
+    assert len(store) == 10 and "S2" in store and "S10" not in store
+    assert dict(store["S0"]["grades"]) == {"数学": 0, "语文": 99}
+    assert dict(store["S2"]["grades"]) == {"语文": 52}
+    assert dict(store["S4"]["grades"]) == {"数学": 4, "语文": 54}
+    assert store["S9"]["name"] == "学生9"
+    with pytest.raises(KeyError):
+        store["missing"]
+    store.close()
+
+
+def test_replace_and_delete_student(store):
+    store["A"] = {"name": "张三", "grades": {"数学": 1, "语文": 2}}
+    store["A"] = {"name": "张三丰", "grades": {"英语": 3}}
+    store["B"] = {"name": "李四", "grades": {}}
+    del store["B"]
+    with pytest.raises(KeyError):
+        del store["B"]
+    store = reopen(store)
+    assert list(store) == ["A"]
+    assert store["A"]["name"] == "张三丰" and dict(store["A"]["grades"]) == {"英语": 3}
+    store.close()
+
+
+def test_items_pages_and_prefers_cache(store, monkeypatch):
+    monkeypatch.setattr(SqliteStudents, "PAGE_SIZE", 4)
+    for i in range(11):
+        store[f"S{i:02d}"] = {"name": f"学生{i}", "grades": {"数学": i}}
+    store["S10"]["grades"]["数学"] = 100
+    items = list(store.items())
+    assert [sid for sid, _ in items] == [f"S{i:02d}" for i in range(11)]
+    assert {sid: dict(info["grades"]) for sid, info in items}["S10"] == {"数学": 100}
+    assert len(store.cache) == 3
+
+
+def test_manager_reopens_database(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(StudentGradeManager, "_instance", None)
+    data = {f"S{i:02d}": {"name": f"学生{i}", "grades": {"数学": i * 3, "语文": 100 - i}, "modified": False}
+            for i in range(30)}
+    with open(StudentGradeManager.DEFAULT_FILE, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    manager = StudentGradeManager()
+    manager.use_sqlite(cache_size=4, batch_size=5)
+    manager.add_student("N1", "新同学")
+    manager.add_grade("N1", "数学", 61.5)
+    manager.add_grade("S01", "数学", 77)
+    top = manager.top_grades("数学", 3)
+    manager.save_to_file()
+    manager._store.close()
+
+    # students.db 存在时启动直接打开数据库，不再读 students.json
+    monkeypatch.setattr(StudentGradeManager, "_instance", None)
+    reopened = StudentGradeManager()
+    assert isinstance(reopened.students, SqliteStudents)
+    assert len(reopened.students) == 31
+    assert dict(reopened.students["S01"]["grades"]) == {"数学": 77, "语文": 99}
+    assert reopened.students["N1"]["grades"]["数学"] == 61.5
+    assert reopened.top_grades("数学", 3) == top
+    assert reopened.grade_range("数学", 60, 62) == [("N1", 61.5), ("S20", 60)]
+    assert reopened.find_by_name("新") == [("N1", "新同学")]
+    assert reopened.get_average("S01") == 88
+    reopened._store.close()
+    capsys.readouterr()